@@ -0,0 +1,288 @@
+"""
+Measure import and query throughput of the lambda handlers end to end without deploying to AWS.
+
+The import and query handlers run in process against local stand-ins:
+- S3 is mocked with moto, or any S3 compatible endpoint (e.g. MinIO) is used with --s3-endpoint-url
+- Bedrock is replaced by a deterministic stub returning seeded embeddings / answers after a configurable latency
+
+A synthetic corpus of --n-chunks chunks is imported through SQS like events, then --n-queries distinct queries
+are answered by a fresh query handler (as in a new container). Reported are documents / chunks per second,
+cold start, p50 / p99 query latency (also per stage out of the instrumentation spans), peak RSS and DB file size.
+
+Requires moto (next to the lambda requirements).
+
+Usage (from this directory):
+    python e2e_benchmark.py --n-chunks 1000 --n-queries 100
+    python e2e_benchmark.py --n-chunks 100000 --embedding-latency-ms 0 --llm-latency-ms 0 --json results.json
+"""
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import importlib
+import io
+import json
+import os
+import pathlib
+import resource
+import shutil
+import string
+import sys
+import threading
+import time
+
+import numpy as np
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+sys.path.append(str(SRC_DIR_PATH))
+
+BUCKET = "rag-benchmark"
+INPUT_PREFIX = "input"
+DB_KEY = "output/db.sqlite3"
+
+
+class StubBedrockRuntime:
+    """
+    Deterministic stand-in of the bedrock-runtime client: embeddings are seeded by the text, answers are echoes,
+    each call sleeps for the configured latency
+    """
+
+    def __init__(self, embedding_size: int, embedding_latency_seconds: float, llm_latency_seconds: float):
+        self.embedding_size = embedding_size
+        self.embedding_latency_seconds = embedding_latency_seconds
+        self.llm_latency_seconds = llm_latency_seconds
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def get_embedding(self, text: str) -> list[float]:
+        seed = int(hashlib.sha1(text.encode()).hexdigest()[:8], 16)
+        embedding = np.random.RandomState(seed).randn(self.embedding_size)
+        return (embedding / np.linalg.norm(embedding)).tolist()
+
+    def get_response_body(self, body: dict) -> dict:
+        if "texts" in body:
+            time.sleep(self.embedding_latency_seconds)
+            return {"embeddings": [self.get_embedding(text) for text in body["texts"]]}
+        if "textGenerationConfig" not in body:
+            time.sleep(self.embedding_latency_seconds)
+            return {"embedding": self.get_embedding(body["inputText"])}
+        time.sleep(self.llm_latency_seconds)
+        return {"results": [{"outputText": f"Answer based on {len(body['inputText'])} chars of context"}]}
+
+    def invoke_model(self, body: str, modelId: str, accept: str = None, contentType: str = None) -> dict:
+        with self.lock:
+            self.calls += 1
+        response_body = self.get_response_body(json.loads(body))
+        return {"body": io.BytesIO(json.dumps(response_body).encode())}
+
+    def invoke_model_with_response_stream(self, body: str, modelId: str, accept: str = None, contentType: str = None):
+        text = self.get_response_body(json.loads(body))["results"][0]["outputText"]
+        return {"body": [{"chunk": {"bytes": json.dumps({"outputText": text}).encode()}}]}
+
+
+def get_vocabulary(size: int = 5000, seed: int = 0) -> list[str]:
+    rnd = np.random.RandomState(seed)
+    letters = np.array(list(string.ascii_lowercase))
+    return ["".join(rnd.choice(letters, size=rnd.randint(3, 10))) for _ in range(size)]
+
+
+def generate_documents(n_documents: int, document_size: int, seed: int = 0) -> list[str]:
+    """
+    Documents of random words out of a fixed vocabulary with a zipf like distribution, of about document_size chars
+    """
+    rnd = np.random.RandomState(seed)
+    vocabulary = get_vocabulary(seed=seed)
+    weights = 1 / np.arange(1, len(vocabulary) + 1)
+    weights /= weights.sum()
+    n_words = document_size // 7 + 1
+    return [" ".join(rnd.choice(vocabulary, size=n_words, p=weights)) for _ in range(n_documents)]
+
+
+def generate_queries(documents: list[str], n_queries: int, seed: int = 1) -> list[str]:
+    """
+    Distinct queries made of a few consecutive words of random documents
+    """
+    rnd = np.random.RandomState(seed)
+    queries = []
+    for i in range(n_queries):
+        words = documents[rnd.randint(len(documents))].split()
+        start = rnd.randint(max(1, len(words) - 6))
+        queries.append(f"What is known about {' '.join(words[start : start + 6])}? ({i})")
+    return queries
+
+
+def get_import_event(object_keys: list[str], bucket: str = BUCKET) -> dict:
+    """
+    SQS event as delivered to the import handler: each message holds a batch of S3 notifications
+    """
+    s3_records = [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}} for key in object_keys]
+    body = json.dumps({"Records": [{"body": json.dumps({"Records": s3_records})}]})
+    return {"Records": [{"messageId": "benchmark", "body": body}]}
+
+
+def get_peak_rss_mb() -> float:
+    # NOTE: ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_percentiles(values: list[float]) -> dict[str, float]:
+    return {"p50": float(np.percentile(values, 50)), "p99": float(np.percentile(values, 99))}
+
+
+def call_handler(handler, event: dict, verbose: bool):
+    if verbose:
+        return handler(event, None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return handler(event, None)
+
+
+def run_benchmark(args) -> dict:
+    import boto3
+
+    from common.clients import CLIENTS
+    from common.config import AWS_REGION_BEDROCK, CHUNK_OVERLAP_SIZE, CHUNK_SIZE, EMBEDDING_SIZE
+    from common.rate_limiter import RATE_LIMITERS, RateLimiter
+
+    bedrock_runtime = StubBedrockRuntime(
+        EMBEDDING_SIZE, args.embedding_latency_ms / 1000, args.llm_latency_ms / 1000
+    )
+    # NOTE: Clients are shared through the clients registry, the handlers pick up the stub on import
+    CLIENTS[("bedrock-runtime", AWS_REGION_BEDROCK)] = bedrock_runtime
+    if args.requests_per_second:
+        from common.config import CHAT_MODEL_ID, EMBEDDING_MODEL_ID
+
+        for model_id in (EMBEDDING_MODEL_ID, CHAT_MODEL_ID):
+            RATE_LIMITERS[model_id] = RateLimiter(model_id, args.requests_per_second)
+
+    s3_client = boto3.client("s3")
+    with contextlib.suppress(s3_client.exceptions.BucketAlreadyOwnedByYou):
+        s3_client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": args.region})
+
+    chunks_per_document = max(1, min(args.chunks_per_document, args.n_chunks))
+    n_documents = max(1, args.n_chunks // chunks_per_document)
+    document_size = chunks_per_document * (CHUNK_SIZE - CHUNK_OVERLAP_SIZE) + CHUNK_OVERLAP_SIZE
+    documents = generate_documents(n_documents, document_size)
+    object_keys = []
+    for i, document in enumerate(documents):
+        object_keys.append(f"{INPUT_PREFIX}/document-{i:07d}.txt")
+        s3_client.put_object(Bucket=BUCKET, Key=object_keys[-1], Body=document.encode())
+
+    results = {"n_documents": n_documents}
+
+    # Import
+    start = time.perf_counter()
+    lambda_import = importlib.import_module("lambda_import.index")
+    for batch_start in range(0, len(object_keys), args.documents_per_invocation):
+        event = get_import_event(object_keys[batch_start : batch_start + args.documents_per_invocation])
+        response = call_handler(lambda_import.lambda_handler, event, args.verbose)
+        if response["batchItemFailures"]:
+            raise RuntimeError(f"Import failed for {response['batchItemFailures']}")
+    import_seconds = time.perf_counter() - start
+
+    n_chunks = lambda_import.DB_CONNECTION.execute("SELECT count(*) FROM documents").fetchone()[0]
+    from common.artifact import get_query_artifact_manifest
+
+    # NOTE: The query artifact downloaded by the query handler is measured, not the write ahead log of the import
+    manifest = get_query_artifact_manifest(BUCKET, lambda_import.SQLITE_QUERY_ARTIFACT_S3_PREFIX)
+    db_objects = s3_client.list_objects_v2(
+        Bucket=BUCKET, Prefix=f"{lambda_import.SQLITE_QUERY_ARTIFACT_S3_PREFIX}/{manifest['version']}/"
+    ).get("Contents", [])
+    results.update(
+        n_chunks=n_chunks,
+        import_seconds=import_seconds,
+        import_documents_per_second=n_documents / import_seconds,
+        import_chunks_per_second=n_chunks / import_seconds,
+        db_size_mb=sum(item["Size"] for item in db_objects) / 1024**2,
+        import_peak_rss_mb=get_peak_rss_mb(),
+        bedrock_calls=bedrock_runtime.calls,
+    )
+
+    # NOTE: The query handler downloads the database like a new container would do
+    lambda_import.DB_CONNECTION.close()
+    for path in glob.glob(f"{lambda_import.LOCAL_DB_URI}*"):
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+    # Query
+    queries = generate_queries(documents, args.n_queries)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext():
+        lambda_query = importlib.import_module("lambda_query.index")
+    from common.instrumentation import get_breakdown
+
+    latencies_ms = []
+    stages_ms: dict[str, list[float]] = {}
+    for i, query in enumerate(queries):
+        query_start = time.perf_counter()
+        call_handler(lambda_query.lambda_handler, {"query": query}, args.verbose)
+        latencies_ms.append((time.perf_counter() - query_start) * 1000)
+        if i == 0:
+            results["cold_start_ms"] = (time.perf_counter() - start) * 1000
+            continue
+        for stage, duration_ms in get_breakdown().items():
+            stages_ms.setdefault(stage, []).append(duration_ms)
+
+    results.update(
+        query_latency_ms=get_percentiles(latencies_ms[1:] or latencies_ms),
+        query_stages_latency_ms={stage: get_percentiles(values) for stage, values in sorted(stages_ms.items())},
+        peak_rss_mb=get_peak_rss_mb(),
+    )
+    return results
+
+
+def print_results(results: dict):
+    print(
+        f"documents: {results['n_documents']}  chunks: {results['n_chunks']}  db size: {results['db_size_mb']:.1f} MB"
+    )
+    print(
+        f"import: {results['import_seconds']:.1f} s  {results['import_documents_per_second']:.1f} docs/s  "
+        f"{results['import_chunks_per_second']:.1f} chunks/s  peak RSS: {results['import_peak_rss_mb']:.0f} MB"
+    )
+    latency = results["query_latency_ms"]
+    print(
+        f"query: cold start {results['cold_start_ms']:.0f} ms  p50 {latency['p50']:.1f} ms  p99 {latency['p99']:.1f} ms"
+        f"  peak RSS: {results['peak_rss_mb']:.0f} MB"
+    )
+    for stage, latency in results["query_stages_latency_ms"].items():
+        print(f"    {stage:<20} p50 {latency['p50']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-chunks", type=int, default=1000, help="e.g. 1000, 100000 or 1000000")
+    parser.add_argument("--chunks-per-document", type=int, default=20)
+    parser.add_argument("--documents-per-invocation", type=int, default=10)
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--embedding-latency-ms", type=float, default=20)
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument(
+        "--requests-per-second", type=float, default=None, help="Rate limit of the stub models (default: quotas)"
+    )
+    parser.add_argument("--s3-endpoint-url", default=None, help="S3 compatible endpoint instead of moto")
+    parser.add_argument("--region", default="eu-central-1")
+    parser.add_argument("--json", default=None, help="Write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs of the handlers")
+    args = parser.parse_args()
+
+    os.environ.update(AWS_DEFAULT_REGION=args.region, SQLITE_DB_S3_BUCKET=BUCKET, SQLITE_DB_S3_KEY=DB_KEY)
+    if args.s3_endpoint_url:
+        # NOTE: Picked up by all boto3 S3 clients, credentials are taken from the environment as usual
+        os.environ["AWS_ENDPOINT_URL_S3"] = args.s3_endpoint_url
+        mock = contextlib.nullcontext()
+    else:
+        from moto import mock_aws
+
+        os.environ.update(AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing")
+        mock = mock_aws()
+
+    with mock:
+        results = run_benchmark(args)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file_out:
+            json.dump(results, file_out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Compare recall@k, query latency and size of the vector indexes with PCA reduced embeddings against
+an exact search of the full embeddings.
+
+The reduction is fitted on a sample of the stored embeddings like on rebuild (EMBEDDING_REDUCTION_COMPONENTS),
+0 components searches the full embeddings with the same backend. Embeddings exported from a database
+(e.g. numpy.save of the embeddings table) can be used instead of the synthetic ones.
+
+Usage (from this directory):
+    python reduction_benchmark.py --n-documents 20000 --embedding-size 1024 --components 0 512 256 128
+    python reduction_benchmark.py --embeddings embeddings.npy --backends flat hnsw
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+sys.path.append(str(SRC_DIR_PATH))
+
+from common.db import initialize_db, save_documents_to_db
+from common.vector_index import FlatIndex, get_vector_index_class
+
+
+def get_synthetic_embeddings(
+    n_embeddings: int, embedding_size: int, n_clusters: int = 100, decay: float = 1.0, seed: int = 0
+) -> np.ndarray:
+    """
+    Clustered gaussian embeddings whose variance decays along the dimensions of a random basis (power law),
+    like text embeddings whose variance is concentrated within a fraction of their dimensions
+    """
+    rnd = np.random.RandomState(seed)
+    scales = (1.0 + np.arange(embedding_size)) ** (-decay / 2)
+    basis, _ = np.linalg.qr(rnd.randn(embedding_size, embedding_size))
+    centers = rnd.randn(n_clusters, embedding_size) * scales
+    assignments = rnd.randint(n_clusters, size=n_embeddings)
+    embeddings = centers[assignments] + 0.5 * rnd.randn(n_embeddings, embedding_size) * scales
+    return (embeddings @ basis.T).astype(np.float32)
+
+
+def measure(index, queries: np.ndarray, ground_truth: list[set[int]], top_n: int):
+    recalls, latencies = [], []
+    for query, expected_ids in zip(queries, ground_truth):
+        start = time.perf_counter()
+        results = index.search(query, top_n)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(expected_ids & {id_ for id_, _ in results}) / len(expected_ids))
+    return np.mean(recalls), np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-documents", type=int, default=20000)
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--embedding-size", type=int, default=1024)
+    parser.add_argument("--decay", type=float, default=1.0, help="Power law decay of the synthetic variance")
+    parser.add_argument("--embeddings", default=None, help="npy file of embeddings instead of synthetic ones")
+    parser.add_argument("--top-n", type=int, default=10)
+    parser.add_argument("--components", type=int, nargs="+", default=None, help="Default: full, 1/2, 1/4, 1/8")
+    parser.add_argument("--backends", nargs="+", default=[FlatIndex.name])
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.load(args.embeddings).astype(np.float32)
+        np.random.RandomState(0).shuffle(embeddings)
+        args.n_documents = len(embeddings) - args.n_queries
+    else:
+        embeddings = get_synthetic_embeddings(
+            args.n_documents + args.n_queries, args.embedding_size, decay=args.decay
+        )
+    embedding_size = embeddings.shape[1]
+    documents, queries = embeddings[: args.n_documents], embeddings[args.n_documents :]
+    components = args.components or [0, embedding_size // 2, embedding_size // 4, embedding_size // 8]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = str(pathlib.Path(tmp_dir, "benchmark.sqlite"))
+        connection = initialize_db(database, embedding_size, vector_index_backend=FlatIndex.name)
+        save_documents_to_db(
+            [{"text": str(idx), "embedding": embedding} for idx, embedding in enumerate(documents)], connection
+        )
+
+        # NOTE: The ground truth is the exact search of the full embeddings
+        exact_index = connection.vector_index
+        exact_index.load()
+        ground_truth = [{id_ for id_, _ in exact_index.search(query, args.top_n)} for query in queries]
+
+        print(f"{len(documents)} documents, {len(queries)} queries, {embedding_size} dimensions, top {args.top_n}")
+        for backend in args.backends:
+            for n_components in components:
+                index = get_vector_index_class(backend)(
+                    connection, database, embedding_size, reduction_components=n_components or None
+                )
+                index.initialize()
+                start = time.perf_counter()
+                index.rebuild()
+                build_seconds = time.perf_counter() - start
+                recall, p50_ms, p95_ms = measure(index, queries, ground_truth, args.top_n)
+                explained = 1.0 if index.reduction is None else index.reduction.explained_variance
+                vectors_mb = len(documents) * index.index_size * np.dtype(np.float32).itemsize / 1024**2
+                print(
+                    f"{backend:<6} dims={index.index_size:<5} explained={explained:6.1%} recall@k={recall:.3f} "
+                    f"p50={p50_ms:.2f}ms p95={p95_ms:.2f}ms vectors={vectors_mb:.1f}MB build={build_seconds:.1f}s"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compare recall@k and query latency of the vector index backends on a synthetic corpus.
+
+The exact flat index is used as ground truth, the ivf index is measured for several nprobe values,
+the hnsw index for several ef values and the vss index for several Faiss factories.
+
+Usage (from this directory):
+    python vector_index_benchmark.py --n-documents 20000 --embedding-size 256
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+sys.path.append(str(SRC_DIR_PATH))
+
+from common.db import initialize_db, save_documents_to_db
+from common.vector_index import FlatIndex, HNSWIndex, IVFIndex, VSSIndex
+
+
+def get_synthetic_embeddings(n_documents: int, embedding_size: int, n_clusters: int = 100, seed: int = 0):
+    """
+    Clustered gaussian embeddings, closer to real text embeddings than uniformly random ones
+    """
+    rnd = np.random.RandomState(seed)
+    centers = rnd.randn(n_clusters, embedding_size).astype(np.float32)
+    assignments = rnd.randint(n_clusters, size=n_documents)
+    return centers[assignments] + 0.3 * rnd.randn(n_documents, embedding_size).astype(np.float32)
+
+
+def measure(index, queries: np.ndarray, ground_truth: list[set[int]], top_n: int, **search_kwargs):
+    recalls, latencies = [], []
+    for query, expected_ids in zip(queries, ground_truth):
+        start = time.perf_counter()
+        results = index.search(query, top_n, **search_kwargs)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(expected_ids & {id_ for id_, _ in results}) / len(expected_ids))
+    return np.mean(recalls), np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
+
+
+def print_result(name: str, recall: float, p50_ms: float, p95_ms: float):
+    print(f"{name:<40} recall@k={recall:.3f} p50={p50_ms:.2f}ms p95={p95_ms:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-documents", type=int, default=20000)
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--embedding-size", type=int, default=256)
+    parser.add_argument("--top-n", type=int, default=10)
+    parser.add_argument("--nprobes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--efs", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--vss-factories", nargs="*", default=["Flat,IDMap2", "IVF256,Flat,IDMap2"])
+    args = parser.parse_args()
+
+    embeddings = get_synthetic_embeddings(args.n_documents + args.n_queries, args.embedding_size)
+    documents, queries = embeddings[: args.n_documents], embeddings[args.n_documents :]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = str(pathlib.Path(tmp_dir, "benchmark.sqlite"))
+        connection = initialize_db(database, args.embedding_size, vector_index_backend=FlatIndex.name)
+        save_documents_to_db(
+            [{"text": str(idx), "embedding": embedding} for idx, embedding in enumerate(documents)], connection
+        )
+
+        flat_index = connection.vector_index
+        flat_index.load()
+        ground_truth = [{id_ for id_, _ in flat_index.search(query, args.top_n)} for query in queries]
+        print_result("flat", *measure(flat_index, queries, ground_truth, args.top_n))
+
+        ivf_index = IVFIndex(connection, database, args.embedding_size)
+        start = time.perf_counter()
+        ivf_index.rebuild()
+        print(f"ivf: {len(ivf_index.centroids)} lists trained in {time.perf_counter() - start:.1f}s")
+        for nprobe in args.nprobes:
+            print_result(f"ivf nprobe={nprobe}", *measure(ivf_index, queries, ground_truth, args.top_n, nprobe=nprobe))
+
+        hnsw_index = HNSWIndex(connection, database, args.embedding_size)
+        hnsw_index.rebuild()
+        for ef in args.efs:
+            hnsw_index.index.set_ef(ef)
+            print_result(f"hnsw ef={ef}", *measure(hnsw_index, queries, ground_truth, args.top_n))
+
+        for factory in args.vss_factories:
+            vss_index = VSSIndex(connection, database, args.embedding_size, factory=factory)
+            vss_index.initialize()
+            start = time.perf_counter()
+            vss_index.rebuild()
+            print(f"vss {factory}: built in {time.perf_counter() - start:.1f}s")
+            print_result(f"vss {factory}", *measure(vss_index, queries, ground_truth, args.top_n))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,8 @@ from aws_cdk import (
     aws_glue,
     aws_lambda_event_sources,
     aws_s3_notifications,
+    aws_events,
+    aws_events_targets,
 )
 import aws_cdk as cdk
 from constructs import Construct
@@ -26,8 +28,16 @@ class RAGStack(Stack):
 
         output_prefix = "output"
         sqlite_db_s3_key = os.path.join(output_prefix, "db.sqlite3")
+        sqlite_query_artifact_s3_prefix = os.path.join(output_prefix, "query-artifact")
 
         tmp_prefix = "tmp"
+        answer_cache_prefix = os.path.join(tmp_prefix, "answer-cache")
+
+        output_bucket.add_lifecycle_rule(
+            prefix=os.path.join(tmp_prefix, ""),
+            noncurrent_version_expiration=cdk.Duration.days(1),
+            expiration=cdk.Duration.days(7),
+        )
 
         sqlite_db_s3_uri = f"s3://{output_bucket.bucket_name}/{sqlite_db_s3_key}"
 
@@ -45,6 +55,7 @@ class RAGStack(Stack):
                 "OUTPUT_PREFIX": output_prefix,
                 "SQLITE_DB_S3_BUCKET": output_bucket.bucket_name,
                 "SQLITE_DB_S3_KEY": sqlite_db_s3_key,
+                "SQLITE_QUERY_ARTIFACT_S3_PREFIX": sqlite_query_artifact_s3_prefix,
             },
             memory_size=1024,
             timeout=cdk.Duration.minutes(10),
@@ -62,7 +73,9 @@ class RAGStack(Stack):
             ),
             environment={
                 "SQLITE_DB_S3_BUCKET": output_bucket.bucket_name,
-                "SQLITE_DB_S3_KEY": sqlite_db_s3_key,
+                "SQLITE_QUERY_ARTIFACT_S3_PREFIX": sqlite_query_artifact_s3_prefix,
+                "ANSWER_CACHE_S3_BUCKET": output_bucket.bucket_name,
+                "ANSWER_CACHE_S3_PREFIX": answer_cache_prefix,
             },
             memory_size=1024,
             timeout=cdk.Duration.minutes(5),
@@ -83,7 +96,14 @@ class RAGStack(Stack):
 
         s3_queue = aws_sqs.Queue(self, "S3Queue", visibility_timeout=cdk.Duration.minutes(15))
 
-        import_fifo_queue = aws_sqs.Queue(self, "LambdaQueue", fifo=True, visibility_timeout=cdk.Duration.minutes(10))
+        # NOTE: Content based deduplication is required for the messages of the scheduled rule below
+        import_fifo_queue = aws_sqs.Queue(
+            self,
+            "LambdaQueue",
+            fifo=True,
+            content_based_deduplication=True,
+            visibility_timeout=cdk.Duration.minutes(10),
+        )
 
         lambda_queue_filler = aws_lambda.Function(
             self,
@@ -103,11 +123,30 @@ class RAGStack(Stack):
         )
 
         import_fifo_queue.grant_send_messages(lambda_queue_filler)
+        # NOTE: The import lambda re-enqueues the documents it could not import before its timeout
+        import_fifo_queue.grant_send_messages(lambda_import)
+        lambda_import.add_environment("SQS_QUEUE_URL", import_fifo_queue.queue_url)
+
+        for event_type in (aws_s3.EventType.OBJECT_CREATED, aws_s3.EventType.OBJECT_REMOVED):
+            input_bucket.add_event_notification(
+                event_type,
+                aws_s3_notifications.SqsDestination(s3_queue),
+                aws_s3.NotificationKeyFilter(prefix=os.path.join(input_prefix, "")),
+            )
 
-        input_bucket.add_event_notification(
-            aws_s3.EventType.OBJECT_CREATED,
-            aws_s3_notifications.SqsDestination(s3_queue),
-            aws_s3.NotificationKeyFilter(prefix=os.path.join(input_prefix, "")),
+        # NOTE: Deleted documents are only filtered out of searches, the rows are removed once a day
+        # through the import queue, so that the database is never written concurrently
+        aws_events.Rule(
+            self,
+            "RAGDocumentCompaction",
+            schedule=aws_events.Schedule.rate(cdk.Duration.days(1)),
+            targets=[
+                aws_events_targets.SqsQueue(
+                    import_fifo_queue,
+                    message=aws_events.RuleTargetInput.from_object({"action": "compact_documents"}),
+                    message_group_id="SINGLETON",
+                )
+            ],
         )
 
         lambda_queue_filler.add_event_source(
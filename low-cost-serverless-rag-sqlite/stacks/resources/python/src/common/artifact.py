@@ -0,0 +1,244 @@
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+
+from .clients import get_client
+from .config import (
+    SQLITE_DB_TRANSFER_CONCURRENCY,
+    SQLITE_QUERY_ARTIFACT_MANIFEST,
+    SQLITE_QUERY_ARTIFACT_OPTIMIZE_CHANGE_RATIO,
+    SQLITE_QUERY_ARTIFACT_RETENTION_SECONDS,
+)
+from .db import SQL_QUERY_METADATA, DBConnection, compact_db, get_metadata_value, initialize_db, set_metadata_value
+from .helpers import get_s3_file_locally, upload_file
+
+# NOTE: The query artifact is a directory holding the database and the sidecar files of its vector index,
+# which is published under "<prefix>/<version>/" and becomes visible once "<prefix>/<manifest>" points to it
+QUERY_ARTIFACT_DB_NAME = "db.sqlite3"
+
+# NOTE: Merges the b-trees of the full text search index into one, so that searches read a single segment
+SQL_OPTIMIZE_FTS_DOCUMENTS = """
+INSERT INTO fts_documents(fts_documents) VALUES('optimize')
+"""
+
+SQL_QUERY_DOCUMENTS_MAX_ID_AND_COUNT = """
+SELECT coalesce(max(id), 0), count(*) FROM documents
+"""
+
+# NOTE: Largest id and count of the documents at the last optimization, stored within the database metadata
+OPTIMIZED_DOCUMENTS_KEY = "optimized_documents"
+
+SQL_DELETE_METADATA_VALUE = """
+DELETE FROM metadata WHERE key = :key
+"""
+
+# NOTE: Tables only used by the import, the query lambdas only read documents, their embeddings and metadata
+QUERY_ARTIFACT_DROPPED_TABLES = ("import_checkpoints", "tombstones")
+
+s3_client = get_client("s3")
+
+
+def get_artifact_version() -> str:
+    """
+    Return a new artifact version, sorted by creation time
+    """
+    return f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S%fZ}-{uuid.uuid4().hex[:8]}"
+
+
+def optimize_db(connection: sqlite3.Connection):
+    """
+    Optimize the database for reading: merge the full text search index and collect the statistics
+    of the query planner
+    """
+    with connection:
+        connection.execute(SQL_OPTIMIZE_FTS_DOCUMENTS)
+        connection.execute("ANALYZE")
+
+
+def optimize_db_if_changed(
+    connection: sqlite3.Connection, change_ratio: float = SQLITE_QUERY_ARTIFACT_OPTIMIZE_CHANGE_RATIO
+) -> bool:
+    """
+    Optimize the database once the documents inserted or removed since the last optimization exceed change_ratio
+    of the documents. Return True if it was optimized.
+    """
+    max_id, count = connection.execute(SQL_QUERY_DOCUMENTS_MAX_ID_AND_COUNT).fetchone()
+    optimized_documents = get_metadata_value(connection, OPTIMIZED_DOCUMENTS_KEY)
+    if optimized_documents is not None:
+        optimized_max_id, optimized_count = map(int, optimized_documents.split(","))
+        # NOTE: Ids are never reused, rows above the last largest id are inserted ones, the others are removed ones
+        inserted_count = max(0, max_id - optimized_max_id)
+        removed_count = max(0, optimized_count + inserted_count - count)
+        if inserted_count + removed_count <= change_ratio * max(count, 1):
+            return False
+    optimize_db(connection)
+    set_metadata_value(connection, OPTIMIZED_DOCUMENTS_KEY, f"{max_id},{count}")
+    return True
+
+
+def build_query_artifact(
+    connection: DBConnection, directory: str, snapshot_path: str, sidecar_paths: list[str]
+) -> dict:
+    """
+    Build the read-optimized artifact used by the query lambdas out of the snapshot of the database (taken after
+    optimize_db_if_changed) and the sidecar files of its vector index, in a pass of its own: the rows of deleted
+    documents and the import bookkeeping are removed, the database is vacuumed and its vector index saved next to it
+    in the form loaded by the query lambdas (memory-mapped npy files for the flat / ivf / vss indexes).
+    Return the manifest.
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    database = os.path.join(directory, QUERY_ARTIFACT_DB_NAME)
+
+    vector_index = connection.vector_index
+    os.replace(snapshot_path, database)
+    # NOTE: Indexes are refreshed out of their copied sidecar files, e.g. the ivf lists keep their trained centroids
+    for sidecar_path in sidecar_paths:
+        shutil.copyfile(sidecar_path, f"{database}{sidecar_path.removeprefix(vector_index.database)}")
+
+    artifact_connection = initialize_db(
+        database, embedding_size=vector_index.embedding_size, vector_index_backend=vector_index.name
+    )
+    try:
+        deleted_count = compact_db(artifact_connection)
+        print("QUERY ARTIFACT DELETED DOCUMENTS: ", deleted_count)
+        with artifact_connection:
+            for table_name in QUERY_ARTIFACT_DROPPED_TABLES:
+                artifact_connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+            artifact_connection.execute(SQL_DELETE_METADATA_VALUE, {"key": OPTIMIZED_DOCUMENTS_KEY})
+        artifact_connection.execute("VACUUM")
+        artifact_vector_index = artifact_connection.vector_index
+        artifact_vector_index.save_for_queries()
+
+        metadata = dict(artifact_connection.execute(SQL_QUERY_METADATA).fetchall())
+        manifest = {
+            "version": get_artifact_version(),
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "embedding_model_id": metadata.get("embedding_model_id"),
+            "embedding_size": artifact_vector_index.embedding_size,
+            "vector_index_size": artifact_vector_index.index_size,
+            "vector_index_backend": artifact_vector_index.name,
+            "documents_count": artifact_connection.execute("SELECT count(*) FROM documents").fetchone()[0],
+            "embeddings_count": artifact_vector_index.count(),
+        }
+    finally:
+        artifact_connection.close()
+    manifest["files"] = {name: os.path.getsize(os.path.join(directory, name)) for name in sorted(os.listdir(directory))}
+    return manifest
+
+
+def get_query_artifact_key(prefix: str, version: str, name: str) -> str:
+    return f"{prefix}/{version}/{name}"
+
+
+def get_query_artifact_versions(bucket: str, prefix: str) -> dict[str, datetime.datetime]:
+    """
+    Return the versions stored under the prefix and the time their last file was uploaded
+    """
+    versions = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/"):
+        for item in page.get("Contents", []):
+            name = item["Key"].removeprefix(f"{prefix}/")
+            if "/" in name:
+                version = name.split("/", 1)[0]
+                versions[version] = max(versions.get(version, item["LastModified"]), item["LastModified"])
+    return versions
+
+
+def delete_query_artifact_version(bucket: str, prefix: str, version: str):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/{version}/"):
+        objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={"Objects": objects})
+
+
+def publish_query_artifact(
+    bucket: str,
+    prefix: str,
+    directory: str,
+    manifest: dict,
+    retention_seconds: float = SQLITE_QUERY_ARTIFACT_RETENTION_SECONDS,
+):
+    """
+    Upload the files of the artifact under its version, then the manifest so that query lambdas switch to it.
+    A query lambda may still be downloading a version it read in a previous manifest, so the manifest records when
+    each version was replaced and a version is only deleted retention_seconds after being replaced.
+    Versions which were never published (e.g. an import failing during the upload) are deleted retention_seconds
+    after their last upload.
+    """
+    version = manifest["version"]
+    for name in manifest["files"]:
+        upload_file(bucket, get_query_artifact_key(prefix, version, name), os.path.join(directory, name))
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    previous_manifest = get_query_artifact_manifest(bucket, prefix)
+    replaced_versions = {}
+    if previous_manifest is not None:
+        replaced_versions = dict(previous_manifest.get("replaced_versions", {}))
+        replaced_versions[previous_manifest["version"]] = now.isoformat()
+    stale_versions = []
+    for stored_version, uploaded_at in get_query_artifact_versions(bucket, prefix).items():
+        if stored_version == version:
+            continue
+        replaced_at = replaced_versions.get(stored_version)
+        age_since = uploaded_at if replaced_at is None else datetime.datetime.fromisoformat(replaced_at)
+        if (now - age_since).total_seconds() >= retention_seconds:
+            stale_versions.append(stored_version)
+        elif replaced_at is not None:
+            manifest.setdefault("replaced_versions", {})[stored_version] = replaced_at
+
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f"{prefix}/{SQLITE_QUERY_ARTIFACT_MANIFEST}",
+        Body=json.dumps(manifest).encode(),
+        ContentType="application/json",
+    )
+    for stale_version in stale_versions:
+        delete_query_artifact_version(bucket, prefix, stale_version)
+
+
+def get_query_artifact_manifest(bucket: str, prefix: str) -> dict | None:
+    """
+    Return the manifest of the current query artifact, None if none was published yet
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=f"{prefix}/{SQLITE_QUERY_ARTIFACT_MANIFEST}")
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def download_query_artifact(
+    bucket: str,
+    prefix: str,
+    manifest: dict | None,
+    directory: str,
+    max_workers: int = SQLITE_DB_TRANSFER_CONCURRENCY,
+) -> str:
+    """
+    Download the files of the artifact described by the manifest into the directory (concurrently)
+    and return the path of its database, which does not exist if no artifact was published yet
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    if manifest is not None:
+        names = list(manifest["files"])
+        with ThreadPoolExecutor(max(1, min(max_workers, len(names)))) as executor:
+            for _ in executor.map(
+                lambda name: get_s3_file_locally(
+                    bucket, get_query_artifact_key(prefix, manifest["version"], name), os.path.join(directory, name)
+                ),
+                names,
+            ):
+                pass
+    return os.path.join(directory, QUERY_ARTIFACT_DB_NAME)
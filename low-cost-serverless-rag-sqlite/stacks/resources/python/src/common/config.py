@@ -4,17 +4,94 @@ CONTENT_TYPE = "application/json"
 # NOTE: Leave to None in case you want to query bedrock endpoints within the same region as the lambda function
 AWS_REGION_BEDROCK = "eu-central-1"
 
-# The model we use to generate embeddings
+# AWS clients shared within a container: the pool has to fit concurrent calls of the thread pools (default 10),
+# the read timeout the generation of long answers, retries use the adaptive mode which backs off on throttling.
+# NOTE: Bedrock calls are paced and retried by the rate limiter (see call_model), so that the runtime client makes
+# a single attempt (total attempts, CLIENT_MAX_ATTEMPTS counts retries): throttled calls reach the rate limiter at once,
+# which also retries transient errors
+CLIENT_MAX_POOL_CONNECTIONS = 50
+CLIENT_CONNECT_TIMEOUT_SECONDS = 5
+CLIENT_READ_TIMEOUT_SECONDS = 120
+CLIENT_MAX_ATTEMPTS = 5
+CLIENT_SERVICES_TOTAL_MAX_ATTEMPTS = {"bedrock-runtime": 1}
+
+# The model we use to generate embeddings: a Bedrock model id or "onnx/<name>" for a local model (see below)
+# NOTE: Imported documents and queries must be embedded with the same model, changing it requires a re-import
 EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
 
+# Local embedding models run on CPU with ONNX Runtime, e.g. "onnx/all-MiniLM-L6-v2" is loaded out of
+# LOCAL_EMBEDDING_MODELS_DIR/all-MiniLM-L6-v2 (model.onnx and tokenizer.json) relative to the source directory.
+# Texts are embedded in batches of LOCAL_EMBEDDING_BATCH_SIZE truncated to LOCAL_EMBEDDING_MAX_LENGTH tokens,
+# LOCAL_EMBEDDING_THREADS is the number of threads of an inference (None = one per core)
+LOCAL_EMBEDDING_MODELS_DIR = "models"
+LOCAL_EMBEDDING_BATCH_SIZE = 32
+LOCAL_EMBEDDING_MAX_LENGTH = 256
+LOCAL_EMBEDDING_THREADS = None
+
+# Models accepting multiple texts per request (e.g. cohere.embed-*) embed up to EMBEDDING_BATCH_SIZE texts per request,
+# batches or single text requests of other models (e.g. amazon.titan-embed-*) run EMBEDDING_MAX_CONCURRENCY at a time
+EMBEDDING_BATCH_SIZE = 96
+EMBEDDING_MAX_CONCURRENCY = 8
+
+# How often the status of Bedrock batch inference jobs (used for large backfills) is polled
+BATCH_INFERENCE_POLL_INTERVAL_SECONDS = 60
+
 # The model we use to answer queries based on retrieved documents
 CHAT_MODEL_ID = "amazon.titan-text-express-v1"
 
+# Bedrock quotas paced by the client side rate limiter of each model
+# NOTE: Quotas are per account and region, configure the share of a single container
+# (e.g. account quota / reserved concurrency of the lambda functions)
+BEDROCK_MODEL_QUOTAS = {
+    EMBEDDING_MODEL_ID: {"requests_per_second": 25, "tokens_per_minute": 300000},
+    CHAT_MODEL_ID: {"requests_per_second": 5, "tokens_per_minute": 300000},
+}
+BEDROCK_DEFAULT_QUOTA = {"requests_per_second": 5}
+
+# Calls may burst up to RATE_LIMITER_BURST_SECONDS of quota, throttled calls are retried RATE_LIMITER_MAX_RETRIES times,
+# multiply the request rate by RATE_LIMITER_THROTTLED_FACTOR which then recovers by RATE_LIMITER_RECOVERY_STEP of the
+# quota per successful call. Transient errors (5xx, model timeouts, connection errors) are retried as many times
+# after a random backoff of up to RATE_LIMITER_BACKOFF_SECONDS, doubling per attempt (RATE_LIMITER_MAX_BACKOFF_SECONDS)
+RATE_LIMITER_BURST_SECONDS = 1.0
+RATE_LIMITER_MAX_RETRIES = 5
+RATE_LIMITER_BACKOFF_SECONDS = 0.5
+RATE_LIMITER_MAX_BACKOFF_SECONDS = 8.0
+RATE_LIMITER_THROTTLED_FACTOR = 0.7
+RATE_LIMITER_RECOVERY_STEP = 0.02
+
+# CloudWatch namespace of the metrics logged in embedded metric format (stage latencies, rate limiters)
+METRICS_NAMESPACE = "LowCostServerlessRAG"
+
+# Rough number of chars per token used to estimate the tokens of a request
+CHARS_PER_TOKEN = 4
+
 # How much text the LLM generate is allowed to generate in response to a query (max value specific to CHAT_MODEL_ID)
 MAX_TOKEN_OUTPUT = 1024
 
+# How many tokens of retrieved text can be sent to the LLM as context for a single query
+CONTEXT_MAX_TOKENS = 2048
+
+# Retrieved chunks can be re-ranked before being sent to the LLM: RERANK_METHOD is None (disabled), "mmr" (maximal
+# marginal relevance over the chunk vectors, trading relevance for diversity with MMR_LAMBDA) or "cross_encoder"
+# (local ONNX cross-encoder CROSS_ENCODER_MODEL_ID scoring each query / chunk pair, stored like local embedding models).
+# RERANK_CANDIDATES_FACTOR times the top n documents are retrieved and the best RERANK_TOP_N_DOCUMENTS are kept
+RERANK_METHOD = None
+RERANK_CANDIDATES_FACTOR = 4
+RERANK_TOP_N_DOCUMENTS = 4
+MMR_LAMBDA = 0.7
+CROSS_ENCODER_MODEL_ID = "onnx/ms-marco-MiniLM-L-6-v2"
+CROSS_ENCODER_BATCH_SIZE = 16
+CROSS_ENCODER_MAX_LENGTH = 512
+
 # The dimension of embedding generated by the model configure using EMBEDDING_MODEL_ID
-EMBEDDING_SIZE = 1024 + 512
+EMBEDDING_SIZES = {
+    "amazon.titan-embed-text-v1": 1024 + 512,
+    "amazon.titan-embed-text-v2:0": 1024,
+    "cohere.embed-english-v3": 1024,
+    "cohere.embed-multilingual-v3": 1024,
+    "onnx/all-MiniLM-L6-v2": 384,
+}
+EMBEDDING_SIZE = EMBEDDING_SIZES[EMBEDDING_MODEL_ID]
 
 # How much text we want to import as a single item
 CHUNK_SIZE = 512
@@ -22,6 +99,119 @@ CHUNK_SIZE = 512
 # How much text (chars) should overlap between chunks (50% before, 50% after)
 CHUNK_OVERLAP_SIZE = 128
 
+# Unit used to split text into chunks: "chars" uses CHUNK_SIZE / CHUNK_OVERLAP_SIZE,
+# "tokens" uses CHUNK_SIZE_TOKENS / CHUNK_OVERLAP_SIZE_TOKENS counted with the tokenizer below
+CHUNK_UNIT = "chars"
+CHUNK_SIZE_TOKENS = 384
+CHUNK_OVERLAP_SIZE_TOKENS = 64
+
+# Tokenizer used for token based chunking, the file is looked up relative to the source directory
+# and the tokenizer is only fetched by name from the hugging face hub in case the file does not exist
+# NOTE: The tokenizer of the Titan embedding models is not published, "gpt2" is a proxy counting tokens differently,
+# so that token chunks are CHUNK_TOKENS_SAFETY_MARGIN smaller than CHUNK_SIZE_TOKENS to stay within the model budget.
+# Local models truncate texts to LOCAL_EMBEDDING_MAX_LENGTH tokens, keep CHUNK_SIZE_TOKENS below it for them
+TOKENIZER_NAME = "gpt2"
+TOKENIZER_FILE = "tokenizer.json"
+CHUNK_TOKENS_SAFETY_MARGIN = 0.15
+
+# Vector index used to search embeddings: "vss" (sqlite-vss), "flat" (exact NumPy search), "hnsw" (hnswlib)
+# or "ivf" (NumPy inverted file index)
+# NOTE: The flat index is fast for small to medium corpora, hnsw scales better for large ones
+VECTOR_INDEX_BACKEND = "vss"
+
+# HNSW graph parameters: M and HNSW_EF_CONSTRUCTION are fixed at build time, HNSW_EF is used at query time
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF = 64
+
+# Faiss index factory of the sqlite-vss index, e.g. "IVF4096,Flat,IDMap2" or "IVF4096,PQ32,IDMap2" (None = exact)
+# NOTE: IVF / PQ factories are trained on a sample of the embeddings when the index is rebuilt after an import
+VSS_INDEX_FACTORY = None
+VSS_TRAINING_SAMPLE_SIZE = 50000
+
+# IVF parameters: IVF_N_LISTS (None = 4 * sqrt(embeddings count)) is fixed at training time, IVF_NPROBE is the
+# default number of lists searched at query time
+IVF_N_LISTS = None
+IVF_NPROBE = 8
+IVF_TRAINING_SAMPLE_SIZE = 50000
+
+# Optional PCA reduction of the embeddings searched by the vector index (None = all EMBEDDING_SIZE dimensions):
+# the projection on the EMBEDDING_REDUCTION_COMPONENTS first principal components is fitted on a sample of the stored
+# embeddings when the index is rebuilt, stored within the database and applied to stored and query embeddings
+# NOTE: Full embeddings are kept within the embeddings table, so that the reduction can be changed or disabled later
+EMBEDDING_REDUCTION_COMPONENTS = None
+EMBEDDING_REDUCTION_SAMPLE_SIZE = 20000
+
+# Filtered vector searches: indexes not holding embeddings in memory search up to this many allowed documents exactly,
+# more allowed documents are searched by over-fetching FILTER_OVERFETCH_FACTOR / selectivity times the requested ones
+FILTER_ALLOW_LIST_MAX_SIZE = 20000
+FILTER_OVERFETCH_FACTOR = 2
+
+# Size of the prepared statements cache of sqlite connections, queries only differ by their bound parameters
+# so that they are parsed and planned once per connection
+SQLITE_CACHED_STATEMENTS = 256
+
+# Pragmas of the import database while documents are ingested: write ahead log with fewer fsyncs (a crash may lose the
+# last transactions but never corrupts the database), larger page cache (negative = KiB), memory mapped reads (bytes)
+# and temporary tables / indexes in memory
+SQLITE_IMPORT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# The import database is uploaded as a consistent snapshot: "vacuum" (VACUUM INTO, compacted and defragmented)
+# or "backup" (online backup API, faster on large databases but not compacted)
+SQLITE_SNAPSHOT_METHOD = "vacuum"
+SQLITE_SNAPSHOT_SUFFIX = ".snapshot"
+
+# The database and vector index files are stored in S3 compressed with zstd (SQLITE_DB_COMPRESSION, None stores them
+# uncompressed) under their key with a ".zst" suffix. They are split into independent frames of
+# SQLITE_DB_COMPRESSION_FRAME_SIZE bytes (seekable format), so that they are downloaded as parts of about
+# SQLITE_DB_TRANSFER_PART_SIZE compressed bytes with SQLITE_DB_TRANSFER_CONCURRENCY parallel ranged GETs
+# and decompressed into the local file while downloading
+SQLITE_DB_COMPRESSION = "zstd"
+SQLITE_DB_COMPRESSION_LEVEL = 3
+SQLITE_DB_COMPRESSION_FRAME_SIZE = 4 * 1024 * 1024
+SQLITE_DB_TRANSFER_PART_SIZE = 8 * 1024 * 1024
+SQLITE_DB_TRANSFER_CONCURRENCY = 8
+
+# The import lambda also publishes a read-optimized query artifact (the database snapshot without the rows of deleted
+# documents and the import bookkeeping, vacuumed, with its vector index saved for queries) under a new version prefix,
+# then its manifest (SQLITE_QUERY_ARTIFACT_MANIFEST, version and row counts) which the query lambdas read first.
+# Replaced versions are kept SQLITE_QUERY_ARTIFACT_RETENTION_SECONDS for containers which read the previous manifest
+# and are still loading them, it has to exceed the timeout of the query lambda (5 minutes)
+SQLITE_QUERY_ARTIFACT_MANIFEST = "manifest.json"
+SQLITE_QUERY_ARTIFACT_RETENTION_SECONDS = 10 * 60
+# The full text search index is merged and the planner statistics collected (ANALYZE) only once the documents inserted
+# or removed since the last optimization exceed this ratio of the documents, as both rewrite the whole index
+SQLITE_QUERY_ARTIFACT_OPTIMIZE_CHANGE_RATIO = 0.1
+
+# Documents are imported in slices of IMPORT_SLICE_CHUNKS chunks, each saved with a checkpoint of the import progress.
+# Once the time left is less than the reserve plus the duration of the last slice, the import stops, the database is
+# uploaded and the rest of the documents is re-enqueued to continue where it stopped. The reserve is
+# IMPORT_TAIL_SAFETY_FACTOR times the duration of the last snapshot, uploads and query artifact (it grows with the
+# corpus) and at least IMPORT_TIME_RESERVE_SECONDS
+IMPORT_SLICE_CHUNKS = 256
+IMPORT_TIME_RESERVE_SECONDS = 120
+IMPORT_TAIL_SAFETY_FACTOR = 1.5
+
+# Pragmas of the query lambdas database: pages are read through a memory map instead of being copied into the page cache
+SQLITE_QUERY_PRAGMAS = {
+    "mmap_size": 1024 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
 
 ON_DISK_DATABASE = "/tmp/db.sqlite"
 IN_MEMORY_DATABASE = ":memory:"
+
+# Answers are cached per database version, near duplicate queries reuse an answer above the similarity threshold
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_CACHE_MAX_SIZE = 1024
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95
+# Near duplicate queries are also matched against the ANSWER_CACHE_S3_LOAD_SIZE most recent answers persisted in S3,
+# loaded once per container and version with ANSWER_CACHE_S3_LOAD_CONCURRENCY parallel requests
+ANSWER_CACHE_S3_LOAD_SIZE = 256
+ANSWER_CACHE_S3_LOAD_CONCURRENCY = 16
@@ -1,66 +1,203 @@
 import sqlite3
-import sqlite_vss
 import json
 import datetime
+import math
+import os
+import re
+from collections.abc import Callable
+
 import numpy as np
 
-from .config import EMBEDDING_SIZE, ON_DISK_DATABASE, IN_MEMORY_DATABASE
+from .config import (
+    EMBEDDING_MODEL_ID,
+    EMBEDDING_SIZE,
+    FILTER_ALLOW_LIST_MAX_SIZE,
+    FILTER_OVERFETCH_FACTOR,
+    ON_DISK_DATABASE,
+    IN_MEMORY_DATABASE,
+    SQLITE_CACHED_STATEMENTS,
+    SQLITE_SNAPSHOT_METHOD,
+    VECTOR_INDEX_BACKEND,
+)
+from .vector_index import VectorIndex, get_vector_index_class
+
+SQL_CREATE_METADATA_TABLE = """
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SQL_QUERY_METADATA = """
+SELECT key, value FROM metadata
+"""
+
+SQL_UPSERT_METADATA = """
+INSERT INTO metadata(key, value) VALUES(:key, :value)
+ON CONFLICT(key) DO UPDATE SET value = excluded.value
+"""
+
+SQL_QUERY_EMBEDDING_SAMPLE = """
+SELECT length(embedding) FROM embeddings LIMIT 1
+"""
 
-SQL_CREATE_VSS_DOCUMENTS_TABLE_TEMPLATE = """
-CREATE virtual table IF NOT EXISTS vss_documents using vss0(
-  text_embedding({embedding_size})
+# NOTE: Import progress of each document (S3 uri), documents larger than an invocation are imported in slices
+# of chunks and next_chunk is the first chunk of the next slice (n_chunks once the document is imported)
+SQL_CREATE_IMPORT_CHECKPOINTS_TABLE = """
+CREATE TABLE IF NOT EXISTS import_checkpoints (
+    document_id TEXT PRIMARY KEY,
+    etag TEXT,
+    timestamp DATETIME,
+    next_chunk INTEGER,
+    n_chunks INTEGER
+);
+"""
+
+SQL_QUERY_IMPORT_CHECKPOINT = """
+SELECT document_id, etag, timestamp, next_chunk, n_chunks FROM import_checkpoints WHERE document_id = :document_id
+"""
+
+SQL_UPSERT_IMPORT_CHECKPOINT = """
+INSERT INTO import_checkpoints(document_id, etag, timestamp, next_chunk, n_chunks)
+VALUES(:document_id, :etag, :timestamp, :next_chunk, :n_chunks)
+ON CONFLICT(document_id) DO UPDATE SET
+    etag = excluded.etag, timestamp = excluded.timestamp, next_chunk = excluded.next_chunk, n_chunks = excluded.n_chunks
+"""
+
+SQL_DELETE_IMPORT_CHECKPOINT = """
+DELETE FROM import_checkpoints WHERE document_id = :document_id
+"""
+
+# NOTE: Deleted documents (S3 uri) are recorded as tombstones instead of rewriting the tables: their rows up to last_id
+# are filtered out of searches until the database is compacted, a document imported again gets new ids
+SQL_CREATE_TOMBSTONES_TABLE = """
+CREATE TABLE IF NOT EXISTS tombstones (
+    document_id TEXT PRIMARY KEY,
+    last_id INTEGER,
+    timestamp DATETIME
 );
 """
 
+SQL_UPSERT_TOMBSTONE = """
+INSERT INTO tombstones(document_id, last_id, timestamp)
+SELECT :document_id, max(id), :timestamp FROM documents WHERE document_id = :document_id HAVING count(*) > 0
+ON CONFLICT(document_id) DO UPDATE SET last_id = max(last_id, excluded.last_id), timestamp = excluded.timestamp
+"""
+
+SQL_QUERY_DELETED_IDS = """
+SELECT d.id
+FROM documents d
+JOIN tombstones t ON d.document_id = t.document_id
+WHERE d.id <= t.last_id
+"""
+
+SQL_DELETE_TOMBSTONES = """
+DELETE FROM tombstones
+"""
+
 SQL_CREATE_DOCUMENTS_TABLE = """
 CREATE TABLE IF NOT EXISTS documents (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     text TEXT,
-    timestamp DATETIME
+    timestamp DATETIME,
+    document_id TEXT,
+    "start" INTEGER,
+    "end" INTEGER,
+    start_unique INTEGER,
+    end_unique INTEGER,
+    tags TEXT
 );
 """
 
+# NOTE: Indexes used by metadata filters
+SQL_CREATE_DOCUMENTS_INDEXES = """
+CREATE INDEX IF NOT EXISTS documents_document_id ON documents(document_id);
+CREATE INDEX IF NOT EXISTS documents_timestamp ON documents(timestamp);
+"""
+
+# NOTE: Columns added after the initial release, databases created before are migrated on initialization
+DOCUMENTS_ADDED_COLUMNS = {
+    "document_id": "TEXT",
+    "start": "INTEGER",
+    "end": "INTEGER",
+    "start_unique": "INTEGER",
+    "end_unique": "INTEGER",
+    "tags": "TEXT",
+}
+
 SQL_INSERT_DOCUMENT = """
-INSERT INTO documents(text, timestamp)
-VALUES(:text, :timestamp)
+INSERT INTO documents(text, timestamp, document_id, "start", "end", start_unique, end_unique, tags)
+VALUES(:text, :timestamp, :document_id, :start, :end, :start_unique, :end_unique, :tags)
 """
 
-SQL_INSERT_VSS_DOCUMENT = """
-INSERT INTO vss_documents(rowid, text_embedding)
-VALUES(:rowid, :text_embedding)
+SQL_CREATE_FTS_DOCUMENTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS fts_documents USING fts5(
+    text,
+    content='documents',
+    content_rowid='id'
+);
 """
 
+SQL_REBUILD_FTS_DOCUMENTS = """
+INSERT INTO fts_documents(fts_documents) VALUES('rebuild')
+"""
 
-SQL_QUERY_DOCUMENTS_TEMPLATE = """
-WITH matched_documents (rowid, distance) AS (
-    SELECT
-        rowid,
-        distance
-    FROM vss_documents
-    WHERE
-        vss_search(
-            text_embedding,
-            vss_search_params(
-                ?,
-                {top_n_documents}
-            )
-        )
-    ORDER BY distance ASC
-)
+SQL_INSERT_FTS_DOCUMENT = """
+INSERT INTO fts_documents(rowid, text)
+VALUES(:rowid, :text)
+"""
+
+# NOTE: Rows of an external content table are removed from the full text search index with their original text
+SQL_DELETE_FTS_DOCUMENTS_BY_IDS = """
+INSERT INTO fts_documents(fts_documents, rowid, text)
+SELECT 'delete', id, text FROM documents WHERE id IN (SELECT value FROM json_each(:ids))
+"""
+
+SQL_DELETE_DOCUMENTS_BY_IDS = """
+DELETE FROM documents WHERE id IN (SELECT value FROM json_each(:ids))
+"""
 
+SQL_QUERY_FTS_DOCUMENTS_TEMPLATE = """
 SELECT
     d.*,
-    m.distance
-FROM matched_documents m
-LEFT JOIN documents d ON m.rowid=d.rowid
+    bm25(fts_documents) AS bm25
+FROM fts_documents f
+JOIN documents d ON f.rowid=d.id
 WHERE
-    m.distance <= {distance_threshold}
-ORDER BY m.distance ASC
+    fts_documents MATCH :match_query{filter_conditions}
+ORDER BY bm25 ASC
+LIMIT :top_n_documents
+"""
+
+SQL_QUERY_FILTERED_DOCUMENT_IDS_TEMPLATE = """
+SELECT d.id
+FROM documents d
+WHERE
+    {filter_conditions}
+"""
+
+
+SQL_QUERY_DOCUMENTS_BY_IDS = """
+SELECT d.*
+FROM documents d
+WHERE
+    d.id IN (SELECT value FROM json_each(:ids))
 """
 
 
 MAX_DISTANCE_THRESHOLD = 999999999
 TOP_N_DOCUMENTS = 10
+
+SEARCH_MODE_VECTOR = "vector"
+SEARCH_MODE_FTS = "fts"
+SEARCH_MODE_HYBRID = "hybrid"
+
+# NOTE: Keys of the metadata filters: tags have to all be present within the tags of a document
+FILTER_KEYS = ("document_id_prefix", "timestamp_from", "timestamp_to", "tags")
+
+# NOTE: Constant of the reciprocal rank fusion, it dampens the weight of the first ranks
+RRF_K = 60
+
 EMBEDDING_SAMPLE = np.random.random(EMBEDDING_SIZE).tolist()
 EMBEDDING_SAMPLE_TEST = [idx % 2 for idx in range(EMBEDDING_SIZE)]
 
@@ -69,23 +206,273 @@ SQLITE_VERSION_TUPLE = tuple(int(value) for value in sqlite3.sqlite_version.spli
 print("SQLITE_VERSION: ", SQLITE_VERSION_TUPLE)
 
 
-def initialize_db(database: str | bytes = ON_DISK_DATABASE, embedding_size: int = EMBEDDING_SIZE):
-    db: sqlite3.Connection = sqlite3.connect(database)
-    db.enable_load_extension(True)
-    sqlite_vss.load(db)
-    db.enable_load_extension(False)
+class DBConnection(sqlite3.Connection):
+    """
+    SQLite connection holding the vector index used to search the documents by embedding
+    and the bitmap of deleted document rows filtered out of searches
+    """
+
+    vector_index: VectorIndex
+    deleted_bitmap: np.ndarray | None = None
+
+
+def initialize_db(
+    database: str | bytes = ON_DISK_DATABASE,
+    embedding_size: int = EMBEDDING_SIZE,
+    embedding_model_id: str = EMBEDDING_MODEL_ID,
+    check_same_thread: bool = True,
+    vector_index_backend: str = VECTOR_INDEX_BACKEND,
+    cached_statements: int = SQLITE_CACHED_STATEMENTS,
+    pragmas: dict[str, str | int] | None = None,
+) -> DBConnection:
+    """
+    Open the database, create or migrate its tables and load its vector index.
+    pragmas are applied first, e.g. SQLITE_IMPORT_PRAGMAS to speed up imports.
+    """
+    db: DBConnection = sqlite3.connect(
+        database, check_same_thread=check_same_thread, factory=DBConnection, cached_statements=cached_statements
+    )
+    apply_pragmas(db, pragmas or {})
     db.execute(SQL_CREATE_DOCUMENTS_TABLE)
-    db.execute(SQL_CREATE_VSS_DOCUMENTS_TABLE_TEMPLATE.format(embedding_size=embedding_size))
-    (version,) = db.execute("select vss_version()").fetchone()
-    print("VSS_VERSION: ", version)
+    migrate_documents_table(db)
+    db.executescript(SQL_CREATE_DOCUMENTS_INDEXES)
+    initialize_fts_documents_table(db)
+    db.execute(SQL_CREATE_IMPORT_CHECKPOINTS_TABLE)
+    db.execute(SQL_CREATE_TOMBSTONES_TABLE)
+    db.vector_index = get_vector_index_class(vector_index_backend)(db, database, embedding_size)
+    db.vector_index.initialize()
+    check_embedding_model(db, embedding_model_id, embedding_size)
     return db
 
 
-def get_serialized_embedding(embedding: list[float] | np.ndarray) -> str:
-    if isinstance(embedding, np.ndarray):
-        embedding = embedding.tolist()
+def apply_pragmas(connection: sqlite3.Connection, pragmas: dict[str, str | int]):
+    """
+    Set the pragmas of the connection, e.g. {"journal_mode": "WAL", "synchronous": "NORMAL"}
+    """
+    for name, value in pragmas.items():
+        if not re.fullmatch(r"\w+", name) or not re.fullmatch(r"-?\w+", str(value)):
+            raise ValueError(f"Invalid pragma {name}={value}")
+        connection.execute(f"PRAGMA {name}={value}").fetchall()
+
+
+def snapshot_db(connection: sqlite3.Connection, snapshot_path: str, method: str = SQLITE_SNAPSHOT_METHOD) -> str:
+    """
+    Write a consistent copy of the database to snapshot_path and return it, e.g. to upload it while the database
+    is in WAL mode (the database file alone may miss committed transactions which are still in the write ahead log).
+    "vacuum" writes a compacted copy with VACUUM INTO, "backup" copies the pages with the online backup API.
+    The snapshot uses a rollback journal, so that it is a single self-contained file.
+    """
+    if connection.in_transaction:
+        connection.commit()
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+
+    if method == "vacuum":
+        connection.execute("VACUUM INTO ?", (snapshot_path,))
+    elif method == "backup":
+        with sqlite3.connect(snapshot_path) as snapshot_connection:
+            connection.backup(snapshot_connection)
+            snapshot_connection.execute("PRAGMA journal_mode=DELETE").fetchall()
+        snapshot_connection.close()
+    else:
+        raise ValueError(f"Unknown snapshot method {method}, expected one of ('vacuum', 'backup')")
+    return snapshot_path
+
+
+def check_embedding_model(connection: sqlite3.Connection, embedding_model_id: str, embedding_size: int):
+    """
+    Record the embedding model and size of the database and refuse to use a database whose embeddings were computed
+    with another model, as embeddings of different models can not be compared
+    """
+    connection.execute(SQL_CREATE_METADATA_TABLE)
+    metadata = dict(connection.execute(SQL_QUERY_METADATA).fetchall())
+    if "embedding_size" not in metadata:
+        # NOTE: Databases created before the metadata table are checked against the size of the stored embeddings
+        row = connection.execute(SQL_QUERY_EMBEDDING_SAMPLE).fetchone()
+        if row is not None and row[0] is not None:
+            metadata["embedding_size"] = str(row[0] // np.dtype(np.float32).itemsize)
+
+    stored_model_id = metadata.get("embedding_model_id", embedding_model_id)
+    stored_size = int(metadata.get("embedding_size", embedding_size))
+    if stored_model_id != embedding_model_id or stored_size != embedding_size:
+        raise ValueError(
+            f"The database holds embeddings of {stored_model_id} (size {stored_size}) which can not be searched "
+            f"with embeddings of {embedding_model_id} (size {embedding_size}), re-import the documents"
+        )
+    expected_metadata = {"embedding_model_id": embedding_model_id, "embedding_size": str(embedding_size)}
+    if all(metadata.get(key) == value for key, value in expected_metadata.items()):
+        return
+    with connection:
+        connection.executemany(
+            SQL_UPSERT_METADATA, [{"key": key, "value": value} for key, value in expected_metadata.items()]
+        )
+
+
+def get_metadata_value(connection: sqlite3.Connection, key: str) -> str | None:
+    return dict(connection.execute(SQL_QUERY_METADATA).fetchall()).get(key)
 
-    return json.dumps(embedding)
+
+def set_metadata_value(connection: sqlite3.Connection, key: str, value: str):
+    with connection:
+        connection.execute(SQL_UPSERT_METADATA, {"key": key, "value": value})
+
+
+def migrate_documents_table(connection: sqlite3.Connection):
+    """
+    Add columns missing in databases created with a previous version of the documents table
+    """
+    existing_columns = {row[1] for row in connection.execute("PRAGMA table_info(documents)")}
+    with connection:
+        for column_name, column_type in DOCUMENTS_ADDED_COLUMNS.items():
+            if column_name not in existing_columns:
+                connection.execute(f'ALTER TABLE documents ADD COLUMN "{column_name}" {column_type}')
+
+
+def initialize_fts_documents_table(connection: sqlite3.Connection):
+    """
+    Create the full text search table and index already existing documents in case the table is new
+    """
+    fts_table_exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='fts_documents'"
+    ).fetchone()
+    with connection:
+        connection.execute(SQL_CREATE_FTS_DOCUMENTS_TABLE)
+        if not fts_table_exists:
+            connection.execute(SQL_REBUILD_FTS_DOCUMENTS)
+
+
+def get_fts_match_query(query_text: str) -> str:
+    """
+    Build a FTS5 match query matching any of the words of the text, words are quoted so that
+    FTS5 operators and special chars within the text are searched as is
+    """
+    words = re.findall(r"\w+", query_text)
+    return " OR ".join(f'"{word}"' for word in words)
+
+
+def get_filter_value(value: str | datetime.datetime) -> str:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def get_filter_conditions(filters: dict | None) -> tuple[list[str], dict]:
+    """
+    Translate metadata filters into SQL conditions on the documents table (aliased d) and their parameters:
+    document_id_prefix, timestamp_from / timestamp_to (inclusive, datetime or ISO string) and tags (list of strings).
+    Values are bound parameters, so that the SQL only depends on which filters are set and is reused from the
+    statements cache.
+    """
+    if not filters:
+        return [], {}
+    unknown_keys = set(filters) - set(FILTER_KEYS)
+    if unknown_keys:
+        raise ValueError(f"Unknown filters: {sorted(unknown_keys)}, expected any of {FILTER_KEYS}")
+
+    conditions, parameters = [], {}
+    if filters.get("document_id_prefix"):
+        # NOTE: A range condition so that the index on document_id is used
+        conditions.append("d.document_id >= :filter_prefix AND d.document_id < :filter_prefix || char(1114111)")
+        parameters["filter_prefix"] = filters["document_id_prefix"]
+    if filters.get("timestamp_from") is not None:
+        conditions.append("d.timestamp >= :filter_timestamp_from")
+        parameters["filter_timestamp_from"] = get_filter_value(filters["timestamp_from"])
+    if filters.get("timestamp_to") is not None:
+        conditions.append("d.timestamp <= :filter_timestamp_to")
+        parameters["filter_timestamp_to"] = get_filter_value(filters["timestamp_to"])
+    for idx, tag in enumerate(filters.get("tags") or []):
+        conditions.append(f"EXISTS (SELECT 1 FROM json_each(d.tags) WHERE value = :filter_tag_{idx})")
+        parameters[f"filter_tag_{idx}"] = tag
+    return conditions, parameters
+
+
+def get_deleted_bitmap(connection: DBConnection) -> np.ndarray:
+    """
+    Return the bitmap of the deleted document rows (boolean array indexed by row id), loaded once per connection
+    """
+    if connection.deleted_bitmap is None:
+        ids = np.fromiter((row[0] for row in connection.execute(SQL_QUERY_DELETED_IDS)), dtype=np.int64)
+        bitmap = np.zeros(ids.max() + 1 if len(ids) else 0, dtype=bool)
+        bitmap[ids] = True
+        connection.deleted_bitmap = bitmap
+    return connection.deleted_bitmap
+
+
+def is_deleted(deleted_bitmap: np.ndarray, id_: int) -> bool:
+    return id_ < len(deleted_bitmap) and bool(deleted_bitmap[id_])
+
+
+def get_filtered_document_ids(filters: dict, connection: DBConnection) -> list[int]:
+    conditions, parameters = get_filter_conditions(filters)
+    query = SQL_QUERY_FILTERED_DOCUMENT_IDS_TEMPLATE.format(filter_conditions=" AND ".join(conditions))
+    deleted_bitmap = get_deleted_bitmap(connection)
+    return [row[0] for row in connection.execute(query, parameters) if not is_deleted(deleted_bitmap, row[0])]
+
+
+def search_overfetched(
+    vector_index: VectorIndex,
+    embedding: list[float] | np.ndarray,
+    top_n_documents: int,
+    nprobe: int | None,
+    is_allowed: Callable[[int], bool],
+    allowed_count: int,
+) -> list[tuple[int, float]]:
+    """
+    Search the index for more documents than requested (according to the share of allowed ones)
+    until enough allowed documents are found
+    """
+    count = vector_index.count()
+    if allowed_count <= 0:
+        return []
+    fetch_n = min(count, math.ceil(top_n_documents * FILTER_OVERFETCH_FACTOR * count / allowed_count))
+    while True:
+        matches = [match for match in vector_index.search(embedding, fetch_n, nprobe=nprobe) if is_allowed(match[0])]
+        if len(matches) >= top_n_documents or fetch_n >= count:
+            return matches[:top_n_documents]
+        fetch_n = min(count, 2 * fetch_n)
+
+
+def search_vector_index(
+    embedding: list[float] | np.ndarray,
+    connection: sqlite3.Connection,
+    top_n_documents: int = TOP_N_DOCUMENTS,
+    nprobe: int | None = None,
+    filters: dict | None = None,
+) -> list[tuple[int, float]]:
+    """
+    Return (id, distance) of the top_n_documents closest embeddings of the documents matching the filters.
+
+    Filters are applied during the search, so that filtered searches return as many documents as unfiltered ones:
+    the ids of the allowed documents are passed to indexes supporting it or when there are few of them,
+    otherwise the index is searched for more documents than requested (according to the selectivity of the filters)
+    until enough allowed documents are found.
+    Deleted documents are filtered out the same way, until they are removed from the index by a compaction.
+    """
+    vector_index: VectorIndex = connection.vector_index
+    if not get_filter_conditions(filters)[0]:
+        deleted_bitmap = get_deleted_bitmap(connection)
+        deleted_count = int(np.count_nonzero(deleted_bitmap))
+        if deleted_count == 0:
+            return vector_index.search(embedding, top_n_documents, nprobe=nprobe)
+        return search_overfetched(
+            vector_index,
+            embedding,
+            top_n_documents,
+            nprobe,
+            lambda id_: not is_deleted(deleted_bitmap, id_),
+            vector_index.count() - deleted_count,
+        )
+
+    allowed_ids = get_filtered_document_ids(filters, connection)
+    if not allowed_ids:
+        return []
+    if vector_index.supports_allow_list or len(allowed_ids) <= FILTER_ALLOW_LIST_MAX_SIZE:
+        return vector_index.search_allowed(embedding, top_n_documents, allowed_ids)
+
+    allowed_ids_set = set(allowed_ids)
+    return search_overfetched(
+        vector_index, embedding, top_n_documents, nprobe, allowed_ids_set.__contains__, len(allowed_ids)
+    )
 
 
 def query_db_documents(
@@ -93,63 +480,186 @@ def query_db_documents(
     connection: sqlite3.Connection,
     top_n_documents: int = TOP_N_DOCUMENTS,
     distance_threshold: float = MAX_DISTANCE_THRESHOLD,
+    query_text: str | None = None,
+    search_mode: str = SEARCH_MODE_VECTOR,
+    nprobe: int | None = None,
+    filters: dict | None = None,
 ) -> list[dict]:
-    serialized_embedding = get_serialized_embedding(embedding)
+    """
+    Return the documents matching the query:
+    SEARCH_MODE_VECTOR searches the embedding, SEARCH_MODE_FTS searches the words of query_text (no embedding needed)
+    and SEARCH_MODE_HYBRID runs both and merges the results with reciprocal rank fusion.
+    nprobe overrides the number of inverted lists searched by IVF indexes.
+    filters restrict the search to documents matching metadata (see get_filter_conditions).
+    """
+    if search_mode == SEARCH_MODE_FTS:
+        return query_db_documents_fts(query_text, connection, top_n_documents=top_n_documents, filters=filters)
+    if search_mode == SEARCH_MODE_HYBRID:
+        vector_documents = query_db_documents(
+            embedding, connection, top_n_documents, distance_threshold, nprobe=nprobe, filters=filters
+        )
+        fts_documents = query_db_documents_fts(query_text, connection, top_n_documents=top_n_documents, filters=filters)
+        return fuse_ranked_documents([vector_documents, fts_documents], top_n_documents=top_n_documents)
 
-    SQL_QUERY_VSS_DOCUMENTS_COUNT = """SELECT count(*) FROM vss_documents"""
+    matches = [
+        (rowid, distance)
+        for rowid, distance in search_vector_index(embedding, connection, top_n_documents, nprobe, filters)
+        if distance <= distance_threshold
+    ]
+    return get_documents_by_ids(matches, connection, score_name="distance")
 
-    query = SQL_QUERY_DOCUMENTS_TEMPLATE.format(top_n_documents=top_n_documents, distance_threshold=distance_threshold)
 
+def get_documents_by_ids(
+    ids_scores: list[tuple[int, float]], connection: sqlite3.Connection, score_name: str = "distance"
+) -> list[dict]:
+    """
+    Return the documents with the given ids in the same order, together with their score
+    """
     cursor: sqlite3.Cursor = connection.cursor()
     cursor.row_factory = sqlite3.Row
+    result_rows = cursor.execute(SQL_QUERY_DOCUMENTS_BY_IDS, {"ids": json.dumps([id_ for id_, _ in ids_scores])})
+    documents_by_id = {item["id"]: dict(item) for item in result_rows}
+    return [
+        {**documents_by_id[id_], score_name: score} for id_, score in ids_scores if id_ in documents_by_id
+    ]
 
-    vss_documents_count: int = cursor.execute(SQL_QUERY_VSS_DOCUMENTS_COUNT).fetchone()[0]
 
-    result: list[dict] = []
-
-    # NOTE: The database extension generates an exception for sqlite < 3.41.0 in case the virtual table is empty
-    # see: https://github.com/asg017/sqlite-vss/issues/129
-    if vss_documents_count > 0:
-        result_rows = cursor.execute(query, [serialized_embedding])
-        result = [dict(item) for item in result_rows]
-    return result
+def query_db_documents_fts(
+    query_text: str,
+    connection: sqlite3.Connection,
+    top_n_documents: int = TOP_N_DOCUMENTS,
+    filters: dict | None = None,
+) -> list[dict]:
+    """
+    Return the documents (matching the filters) best matching the words of the query text ranked by BM25
+    """
+    match_query = get_fts_match_query(query_text)
+    if not match_query:
+        return []
+
+    conditions, parameters = get_filter_conditions(filters)
+    query = SQL_QUERY_FTS_DOCUMENTS_TEMPLATE.format(
+        filter_conditions="".join(f" AND {condition}" for condition in conditions)
+    )
+    # NOTE: Enough rows are fetched to still return top_n_documents once deleted documents are filtered out
+    deleted_bitmap = get_deleted_bitmap(connection)
+    cursor: sqlite3.Cursor = connection.cursor()
+    cursor.row_factory = sqlite3.Row
+    result_rows = cursor.execute(
+        query,
+        {
+            "match_query": match_query,
+            "top_n_documents": top_n_documents + int(np.count_nonzero(deleted_bitmap)),
+            **parameters,
+        },
+    )
+    return [dict(item) for item in result_rows if not is_deleted(deleted_bitmap, item["id"])][:top_n_documents]
+
+
+def fuse_ranked_documents(
+    ranked_documents_lists: list[list[dict]], top_n_documents: int = TOP_N_DOCUMENTS, rrf_k: int = RRF_K
+) -> list[dict]:
+    """
+    Merge several ranked lists of documents with reciprocal rank fusion and return the top_n_documents best ones.
+    Documents present in several lists keep the values of all lists (e.g. distance and bm25).
+    """
+    scores: dict[int, float] = {}
+    documents_by_id: dict[int, dict] = {}
+    for documents in ranked_documents_lists:
+        for rank, document in enumerate(documents):
+            document_id = document["id"]
+            scores[document_id] = scores.get(document_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+            documents_by_id[document_id] = {**document, **documents_by_id.get(document_id, {})}
+
+    best_ids = sorted(scores, key=scores.get, reverse=True)[:top_n_documents]
+    return [{**documents_by_id[document_id], "rrf_score": scores[document_id]} for document_id in best_ids]
 
 
 def save_document_into_db(
     document: dict,
     connection: sqlite3.Connection,
     sql_insert_document_query: str = SQL_INSERT_DOCUMENT,
-    sql_insert_vss_document_query: str = SQL_INSERT_VSS_DOCUMENT,
+    sql_insert_fts_document_query: str = SQL_INSERT_FTS_DOCUMENT,
 ):
 
     document_clone = document.copy()
     if "timestamp" not in document_clone:
         document_clone["timestamp"] = datetime.datetime.now()
+    for column_name in DOCUMENTS_ADDED_COLUMNS:
+        document_clone.setdefault(column_name, None)
+    if isinstance(document_clone["tags"], (list, tuple)):
+        document_clone["tags"] = json.dumps(list(document_clone["tags"]))
     embedding: list[float] | np.ndarray = document_clone.pop("embedding")
-    serialized_embedding = get_serialized_embedding(embedding)
 
     document_lastrowid = connection.execute(sql_insert_document_query, document_clone).lastrowid
-    vss_document_lastrowid = connection.execute(
-        sql_insert_vss_document_query, [document_lastrowid, serialized_embedding]
-    ).lastrowid
+    connection.vector_index.add([document_lastrowid], [embedding])
+    connection.execute(sql_insert_fts_document_query, {"rowid": document_lastrowid, "text": document_clone["text"]})
+
+    return document_lastrowid
+
+
+def get_import_checkpoint(connection: sqlite3.Connection, document_id: str) -> dict | None:
+    """
+    Return the import checkpoint of a document, None if its import never started
+    """
+    cursor = connection.execute(SQL_QUERY_IMPORT_CHECKPOINT, {"document_id": document_id})
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+def delete_document(connection: DBConnection, document_id: str, timestamp: str | None = None):
+    """
+    Record the deletion of a document (S3 uri): its rows stored so far are filtered out of searches
+    until the database is compacted, and its import checkpoint is removed so that it can be imported again
+    """
+    if timestamp is None:
+        timestamp = datetime.datetime.now().isoformat(" ", timespec="seconds")
+    with connection:
+        connection.execute(SQL_UPSERT_TOMBSTONE, {"document_id": document_id, "timestamp": timestamp})
+        connection.execute(SQL_DELETE_IMPORT_CHECKPOINT, {"document_id": document_id})
+    connection.deleted_bitmap = None
 
-    return document_lastrowid == vss_document_lastrowid
+
+def compact_db(connection: DBConnection) -> int:
+    """
+    Remove the rows of deleted documents from the documents, full text search and embeddings tables
+    and return their number, the vector index has to be rebuilt afterwards
+    """
+    deleted_ids = np.flatnonzero(get_deleted_bitmap(connection)).tolist()
+    with connection:
+        if deleted_ids:
+            parameters = {"ids": json.dumps(deleted_ids)}
+            connection.execute(SQL_DELETE_FTS_DOCUMENTS_BY_IDS, parameters)
+            connection.vector_index.remove(deleted_ids)
+            connection.execute(SQL_DELETE_DOCUMENTS_BY_IDS, parameters)
+        connection.execute(SQL_DELETE_TOMBSTONES)
+    connection.deleted_bitmap = None
+    return len(deleted_ids)
 
 
 def save_documents_to_db(
     documents: list[dict],
     connection: sqlite3.Connection,
     sql_insert_document_query: str = SQL_INSERT_DOCUMENT,
-    sql_insert_vss_document_query: str = SQL_INSERT_VSS_DOCUMENT,
+    sql_insert_fts_document_query: str = SQL_INSERT_FTS_DOCUMENT,
+    checkpoint: dict | None = None,
 ):
+    """
+    Save the documents within a single transaction, together with the import checkpoint
+    of the slice they belong to (if any), so that a slice is either fully imported or not at all
+    """
     with connection:
         for document in documents:
             save_document_into_db(
                 document=document,
                 connection=connection,
                 sql_insert_document_query=sql_insert_document_query,
-                sql_insert_vss_document_query=sql_insert_vss_document_query,
+                sql_insert_fts_document_query=sql_insert_fts_document_query,
             )
+        if checkpoint is not None:
+            connection.execute(SQL_UPSERT_IMPORT_CHECKPOINT, checkpoint)
 
 
 if __name__ == "__main__":
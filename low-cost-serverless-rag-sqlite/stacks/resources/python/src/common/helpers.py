@@ -1,29 +1,41 @@
 import datetime
 import io
-import boto3
 import json
 import re
+from collections.abc import Iterator
 
 import botocore
-import fitz
 
 
 from .config import (
     ACCEPT,
-    AWS_REGION_BEDROCK,
     CHAT_MODEL_ID,
     CHUNK_OVERLAP_SIZE,
+    CHUNK_OVERLAP_SIZE_TOKENS,
     CHUNK_SIZE,
+    CHUNK_SIZE_TOKENS,
+    CHUNK_TOKENS_SAFETY_MARGIN,
+    CHUNK_UNIT,
     CONTENT_TYPE,
     EMBEDDING_MODEL_ID,
+    MAX_TOKEN_OUTPUT,
+    SQLITE_DB_COMPRESSION,
 )
+from .clients import get_client
+from .embeddings import INPUT_TYPE_DOCUMENT, INPUT_TYPE_QUERY, get_embedding_provider
+from .instrumentation import span
+from .rate_limiter import PRIORITY_BULK, PRIORITY_INTERACTIVE, call_model, estimate_tokens
+from .tokenizer import get_token_offsets
+from .transfer import download_file_seekable, get_compressed_key, upload_file_seekable
 
 DEFAULT_LOCAL_DB_PATH = "/tmp/db.sqlite3"
 
-s3_resource = boto3.resource("s3")
-s3_client = boto3.client("s3")
+# NOTE: S3 user metadata key holding the comma separated tags of a document (x-amz-meta-tags)
+S3_METADATA_TAGS_KEY = "tags"
 
-bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION_BEDROCK)
+s3_client = get_client("s3")
+
+bedrock_runtime = get_client("bedrock-runtime")
 
 
 def get_cleaned_text(text):
@@ -33,6 +45,21 @@ def get_cleaned_text(text):
     return re.sub("(\n\n *)( *\n)*", "\n\n", text)
 
 
+# NOTE: Queries with identifiers like product codes or error numbers, e.g. "ERR-4021" or "X12b"
+IDENTIFIER_PATTERN = re.compile(r"^(?=.*\d)(?=.*[^\d.,])[\w.:/-]+$")
+
+
+def is_keyword_query(query: str) -> bool:
+    """
+    Tell whether a query is a keyword search made of identifiers only (no question), which a full text search
+    answers better than a vector search. Short plain language queries (e.g. "refund policy details") are not.
+    """
+    words = query.split()
+    if not words or "?" in query:
+        return False
+    return all(IDENTIFIER_PATTERN.match(word) for word in words)
+
+
 def get_file_text(document_blob: bytes, filetype: str = None) -> str:
     """
     Extract text from the passed document bytes
@@ -40,6 +67,9 @@ def get_file_text(document_blob: bytes, filetype: str = None) -> str:
     if filetype in {"txt", "md"}:
         document_text = document_blob.decode()
     else:
+        # NOTE: Imported lazily as only the import Lambda parses documents
+        import fitz
+
         document = fitz.open(stream=io.BytesIO(document_blob), filetype=filetype)
         document_text = "\n\n".join(page.get_text() for page in document.pages())
     return document_text
@@ -48,18 +78,36 @@ def get_file_text(document_blob: bytes, filetype: str = None) -> str:
 def get_embedding(
     text: str,
     model_id: str = EMBEDDING_MODEL_ID,
-    content_type: str = CONTENT_TYPE,
-    accept: str = ACCEPT,
+    input_type: str = INPUT_TYPE_QUERY,
+    priority: int = PRIORITY_INTERACTIVE,
 ) -> list[float]:
     """
     Compute an embedding for the given text and return a list of floats.
     The size of the list depends on model_id.
     """
-    body = json.dumps({"inputText": text})
-    response = bedrock_runtime.invoke_model(body=body, modelId=model_id, accept=accept, contentType=content_type)
-    response_body = json.loads(response["body"].read())
-    embedding = response_body.get("embedding")
-    return embedding
+    with span("embedding"):
+        return get_embedding_provider(model_id).get_embedding(text, input_type=input_type, priority=priority)
+
+
+def get_embeddings(
+    texts: list[str],
+    model_id: str = EMBEDDING_MODEL_ID,
+    input_type: str = INPUT_TYPE_DOCUMENT,
+    priority: int = PRIORITY_INTERACTIVE,
+) -> list[list[float]]:
+    """
+    Compute the embeddings of the texts with as few requests as the model allows, in the order of the texts
+    """
+    with span("embedding"):
+        return get_embedding_provider(model_id).get_embeddings(texts, input_type=input_type, priority=priority)
+
+
+def get_llm_request_tokens(body: dict) -> int:
+    """
+    Estimate the tokens counted against the quota for a LLM request: the input and the maximum output
+    """
+    max_output_tokens = body.get("textGenerationConfig", {}).get("maxTokenCount", MAX_TOKEN_OUTPUT)
+    return estimate_tokens(body.get("inputText", "")) + max_output_tokens
 
 
 def get_llm_query_response(
@@ -68,10 +116,16 @@ def get_llm_query_response(
     content_type: str = CONTENT_TYPE,
     accept: str = ACCEPT,
 ) -> dict:
-    response = bedrock_runtime.invoke_model(
-        body=json.dumps(body), modelId=model_id, accept=accept, contentType=content_type
-    )
-    response_body = json.loads(response["body"].read())
+    with span("llm"):
+        response = call_model(
+            bedrock_runtime.invoke_model,
+            model_id,
+            tokens=get_llm_request_tokens(body),
+            body=json.dumps(body),
+            accept=accept,
+            contentType=content_type,
+        )
+        response_body = json.loads(response["body"].read())
     return response_body
 
 
@@ -83,8 +137,51 @@ def get_llm_query_response_text(
     return text
 
 
+def get_llm_query_response_stream(
+    body: dict,
+    model_id: str = CHAT_MODEL_ID,
+    content_type: str = CONTENT_TYPE,
+    accept: str = ACCEPT,
+    client=bedrock_runtime,
+) -> Iterator[dict]:
+    """
+    Stream the LLM response and yield each response chunk as soon as it is generated by the model
+    """
+    response = call_model(
+        client.invoke_model_with_response_stream,
+        model_id,
+        tokens=get_llm_request_tokens(body),
+        body=json.dumps(body),
+        accept=accept,
+        contentType=content_type,
+    )
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk:
+            yield json.loads(chunk["bytes"])
+
+
+def get_llm_query_response_text_stream(
+    body: dict,
+    model_id: str = CHAT_MODEL_ID,
+    content_type: str = CONTENT_TYPE,
+    accept: str = ACCEPT,
+    client=bedrock_runtime,
+) -> Iterator[str]:
+    """
+    Stream the LLM response and yield the generated text pieces as they arrive
+    """
+    for chunk in get_llm_query_response_stream(body, model_id, content_type, accept, client=client):
+        text = chunk.get("outputText")
+        if text:
+            yield text
+
+
 def compute_text_chunks(
-    text: str, chunk_size: int = CHUNK_SIZE, chunk_overlap_size: int = CHUNK_OVERLAP_SIZE
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap_size: int = CHUNK_OVERLAP_SIZE,
+    chunk_unit: str = "chars",
 ) -> tuple[tuple[int], tuple[int], str]:
     """
     Split the text in chunks with overlapping and return chunks with position information:
@@ -93,7 +190,11 @@ def compute_text_chunks(
         the initial text without overlapping
     [(text_start_pos, text_end_pos), (unique_text_start_pos, unique_text_end_pos), text_chunk]
 
+    With chunk_unit="tokens", chunk_size and chunk_overlap_size are counted in tokens instead of chars.
     """
+    if chunk_unit == "tokens":
+        return compute_text_token_chunks(text, chunk_size, chunk_overlap_size)
+
     chunks = []
     single_side_overlap_size = (chunk_overlap_size + 1) // 2
 
@@ -112,8 +213,65 @@ def compute_text_chunks(
     return chunks
 
 
+def compute_text_token_chunks(
+    text: str, chunk_size: int = CHUNK_SIZE_TOKENS, chunk_overlap_size: int = CHUNK_OVERLAP_SIZE_TOKENS
+) -> tuple[tuple[int], tuple[int], str]:
+    """
+    Same as compute_text_chunks but chunk_size and chunk_overlap_size are counted in tokens.
+    Token boundaries are mapped back to char positions, so the positions returned have the same meaning
+    and unique parts of consecutive chunks still rebuild the initial text.
+    """
+    if chunk_size <= chunk_overlap_size:
+        raise ValueError(f"chunk_size ({chunk_size}) must be greater than chunk_overlap_size ({chunk_overlap_size})")
+
+    token_offsets = get_token_offsets(text)
+    tokens_count = len(token_offsets)
+
+    if tokens_count <= chunk_size:
+        return [((0, len(text)), (0, len(text)), text)]
+
+    chunks = []
+    single_side_overlap_size = (chunk_overlap_size + 1) // 2
+    step = chunk_size - chunk_overlap_size
+    for idx in range(single_side_overlap_size, tokens_count, step):
+        chunk_start_token = idx - single_side_overlap_size
+        chunk_end_token = min(idx + chunk_size - single_side_overlap_size, tokens_count)
+        is_last_chunk = chunk_end_token >= tokens_count
+
+        chunk_start_idx = token_offsets[chunk_start_token][0] if chunk_start_token > 0 else 0
+        # NOTE: Chunks end where the next token starts, so that the text between tokens belongs to a chunk
+        chunk_end_idx = len(text) if is_last_chunk else token_offsets[chunk_end_token][0]
+        chunk = text[chunk_start_idx:chunk_end_idx]
+
+        unique_chunk_start_idx = 0
+        if is_last_chunk:
+            unique_chunk_end_idx = len(chunk)
+        else:
+            # The unique part ends where the next chunk starts
+            unique_chunk_end_idx = token_offsets[chunk_start_token + step][0] - chunk_start_idx
+        chunks.append(((chunk_start_idx, chunk_end_idx), (unique_chunk_start_idx, unique_chunk_end_idx), chunk))
+
+        if is_last_chunk:
+            break
+    return chunks
+
+
+def get_configured_text_chunks(text: str, chunk_unit: str = CHUNK_UNIT) -> tuple[tuple[int], tuple[int], str]:
+    """
+    Split the text in chunks using the chunk unit and sizes from the configuration
+    """
+    if chunk_unit == "tokens":
+        chunk_size = int(CHUNK_SIZE_TOKENS * (1 - CHUNK_TOKENS_SAFETY_MARGIN))
+        return compute_text_chunks(text, chunk_size, CHUNK_OVERLAP_SIZE_TOKENS, chunk_unit=chunk_unit)
+    return compute_text_chunks(text, CHUNK_SIZE, CHUNK_OVERLAP_SIZE, chunk_unit=chunk_unit)
+
+
+def get_import_timestamp() -> str:
+    return datetime.datetime.now().isoformat(" ", timespec="seconds")
+
+
 def compute_documents_information(
-    text: str, document_id: str | None = None, timestamp: str | None = None
+    text: str, document_id: str | None = None, timestamp: str | None = None, tags: list[str] | None = None
 ) -> list[dict[str, str | int]]:
     """
     Given a text, split it in chunks and return chunks with corresponding embedding information
@@ -125,18 +283,31 @@ def compute_documents_information(
         "end_unique": end_unique,
         "embedding": text embedding,
         "document_id": document_id,
+        "tags": tags,
         "text": text,
     }]
     """
 
+    return compute_chunks_documents_information(get_configured_text_chunks(text), document_id, timestamp, tags)
+
+
+def compute_chunks_documents_information(
+    chunks: list[tuple[tuple[int], tuple[int], str]],
+    document_id: str | None = None,
+    timestamp: str | None = None,
+    tags: list[str] | None = None,
+) -> list[dict[str, str | int]]:
+    """
+    Embed the chunks (as returned by get_configured_text_chunks) and return their information,
+    see compute_documents_information, e.g. to import a slice of the chunks of a document
+    """
     if timestamp is None:
-        timestamp = datetime.datetime.now().isoformat(" ", timespec="seconds")
+        timestamp = get_import_timestamp()
+    embeddings = get_embeddings([get_cleaned_text(text) for _, _, text in chunks], priority=PRIORITY_BULK)
     items = []
-    for pos, unique_pos, text in compute_text_chunks(text):
+    for (pos, unique_pos, text), embedding in zip(chunks, embeddings):
         start, end = pos
         start_unique, end_unique = unique_pos
-        cleaned_text = get_cleaned_text(text)
-        embedding = get_embedding(cleaned_text)
         item = {
             "timestamp": timestamp,
             "start": start,
@@ -145,13 +316,36 @@ def compute_documents_information(
             "end_unique": end_unique,
             "embedding": embedding,
             "document_id": document_id,
+            "tags": tags,
             "text": text,
         }
         items.append(item)
     return items
 
 
-def get_s3_file_locally(bucket: str, key: str, local_path: str = DEFAULT_LOCAL_DB_PATH):
+def get_s3_object_tags(s3_object: dict) -> list[str]:
+    """
+    Return the tags of an S3 object given as comma separated user metadata, e.g. x-amz-meta-tags: "faq,internal"
+    """
+    tags_metadata = s3_object.get("Metadata", {}).get(S3_METADATA_TAGS_KEY, "")
+    return [tag.strip() for tag in tags_metadata.split(",") if tag.strip()]
+
+
+def get_s3_file_locally(
+    bucket: str, key: str, local_path: str = DEFAULT_LOCAL_DB_PATH, compression: str | None = SQLITE_DB_COMPRESSION
+):
+    """
+    Download the S3 object to local_path, out of its compressed version if there is one
+    """
+    if compression is not None:
+        try:
+            download_file_seekable(s3_client, bucket, get_compressed_key(key, compression), local_path)
+            return local_path
+        except botocore.exceptions.ClientError as err:
+            # NOTE: Objects uploaded before the compression was enabled are downloaded as they are
+            if err.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+
     try:
         s3_client.head_object(Bucket=bucket, Key=key)
         with open(local_path, "wb") as file_out:
@@ -167,5 +361,46 @@ def get_s3_file_locally(bucket: str, key: str, local_path: str = DEFAULT_LOCAL_D
     return local_path
 
 
-def upload_file(bucket: str, key: str, local_path: str = DEFAULT_LOCAL_DB_PATH):
+def get_s3_object_version(bucket: str, key: str, compression: str | None = None) -> str | None:
+    """
+    Return an identifier of the current version of the S3 object (its ETag) or None if it does not exist yet,
+    of its compressed version with a compression
+    """
+    if compression is not None:
+        key = get_compressed_key(key, compression)
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] == "404":
+            return None
+        raise
+    return response["ETag"].strip('"')
+
+
+def upload_file(
+    bucket: str, key: str, local_path: str = DEFAULT_LOCAL_DB_PATH, compression: str | None = SQLITE_DB_COMPRESSION
+):
+    """
+    Upload the file to the S3 object, or to its compressed version with a compression
+    """
+    if compression is not None:
+        upload_file_seekable(s3_client, bucket, get_compressed_key(key, compression), local_path)
+        return
     s3_client.upload_file(local_path, bucket, key)
+
+
+def get_s3_sidecar_files_locally(
+    bucket: str, key: str, suffixes: tuple[str, ...], local_path: str = DEFAULT_LOCAL_DB_PATH
+) -> list[str]:
+    """
+    Download the files stored next to the S3 object (same key with a suffix) next to the local file
+    """
+    return [get_s3_file_locally(bucket, f"{key}{suffix}", f"{local_path}{suffix}") for suffix in suffixes]
+
+
+def upload_sidecar_files(bucket: str, key: str, sidecar_paths: list[str], local_path: str = DEFAULT_LOCAL_DB_PATH):
+    """
+    Upload the files stored next to the local file (same path with a suffix) next to the S3 object
+    """
+    for sidecar_path in sidecar_paths:
+        upload_file(bucket, f"{key}{sidecar_path.removeprefix(local_path)}", sidecar_path)
@@ -0,0 +1,125 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+from .config import METRICS_NAMESPACE
+from .rate_limiter import report_rate_limiters_metrics
+
+# NOTE: Spans recorded while the container is initialized (e.g. database download at import time)
+# are reported with the first invocation, which is flagged as cold start
+COLD_START = True
+
+FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+SPANS: list[dict] = []
+SPANS_LOCK = threading.Lock()
+
+# NOTE: Spans of the last finished invocation, e.g. to check the latency breakdown in tests or benchmarks
+LAST_INVOCATION_SPANS: list[dict] = []
+
+
+def record_span(stage: str, duration_ms: float, **properties):
+    with SPANS_LOCK:
+        SPANS.append({"stage": stage, "duration_ms": duration_ms, **properties})
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """
+    Record the duration of the block as a span of the stage, measured with a monotonic clock
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as err:
+        error = type(err).__name__
+        raise
+    finally:
+        properties = {"error": error} if error is not None else {}
+        record_span(stage, (time.perf_counter() - start) * 1000, **properties)
+
+
+def timed(function, stage: str | None = None):
+    """
+    Wrap the function to record each call as a span of the stage (defaults to the function name)
+    """
+    stage = stage or function.__name__
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        with span(stage):
+            return function(*args, **kwargs)
+
+    return timed_function
+
+
+def get_breakdown(spans: list[dict] | None = None) -> dict[str, float]:
+    """
+    Return the total duration in milliseconds of each stage, of the last finished invocation by default
+    """
+    breakdown: dict[str, float] = {}
+    for item in LAST_INVOCATION_SPANS if spans is None else spans:
+        breakdown[item["stage"]] = breakdown.get(item["stage"], 0.0) + item["duration_ms"]
+    return breakdown
+
+
+def report_spans(namespace: str = METRICS_NAMESPACE, function_name: str = FUNCTION_NAME) -> list[dict]:
+    """
+    Log the spans recorded since the last report in CloudWatch embedded metric format and return them.
+    Each span is logged as a Latency metric of its stage, so that CloudWatch provides p50 / p99 per stage.
+    """
+    global COLD_START
+
+    with SPANS_LOCK:
+        spans = list(SPANS)
+        SPANS.clear()
+    cold_start = COLD_START
+    COLD_START = False
+
+    timestamp = int(time.time() * 1000)
+    for item in spans:
+        print(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": namespace,
+                                "Dimensions": [["FunctionName", "Stage"], ["FunctionName", "Stage", "ColdStart"]],
+                                "Metrics": [{"Name": "Latency", "Unit": "Milliseconds"}],
+                            }
+                        ],
+                    },
+                    "FunctionName": function_name,
+                    "Stage": item["stage"],
+                    "ColdStart": str(cold_start).lower(),
+                    "Latency": item["duration_ms"],
+                    **({"Error": item["error"]} if "error" in item else {}),
+                }
+            )
+        )
+    LAST_INVOCATION_SPANS[:] = spans
+    return spans
+
+
+def instrumented_handler(function):
+    """
+    Decorate a lambda handler to record its duration as the "handler" span and to report all spans
+    and the rate limiters metrics at the end of each invocation
+    """
+
+    @functools.wraps(function)
+    def instrumented_function(*args, **kwargs):
+        try:
+            with span("handler"):
+                return function(*args, **kwargs)
+        finally:
+            report_spans()
+            report_rate_limiters_metrics()
+
+    return instrumented_function
@@ -0,0 +1,284 @@
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+from .config import (
+    BEDROCK_DEFAULT_QUOTA,
+    BEDROCK_MODEL_QUOTAS,
+    CHARS_PER_TOKEN,
+    METRICS_NAMESPACE,
+    RATE_LIMITER_BACKOFF_SECONDS,
+    RATE_LIMITER_BURST_SECONDS,
+    RATE_LIMITER_MAX_BACKOFF_SECONDS,
+    RATE_LIMITER_MAX_RETRIES,
+    RATE_LIMITER_RECOVERY_STEP,
+    RATE_LIMITER_THROTTLED_FACTOR,
+)
+
+# NOTE: Lower values are served first, interactive queries preempt bulk imports waiting for the same model
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException"}
+# NOTE: The Bedrock runtime client does not retry (see CLIENT_SERVICES_TOTAL_MAX_ATTEMPTS), so that call_model retries
+# these errors itself, as well as any 5xx error and connection errors
+TRANSIENT_ERROR_CODES = {
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+}
+TRANSIENT_EXCEPTIONS = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap estimation of the number of tokens of a text, good enough to pace calls against a tokens per minute quota
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class TokenBucket:
+    """
+    Bucket refilled with rate tokens per second up to capacity
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait_seconds(self, amount: float) -> float:
+        # NOTE: Requests larger than the bucket only wait for a full bucket and leave it in debt
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount: float):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    Client side scheduler of the calls to a model: calls are paced by token buckets of requests per second
+    and tokens per minute, and served by priority then in arrival order.
+
+    The request rate is reduced when the service throttles anyway (e.g. because other containers share the quota)
+    and recovers step by step up to the configured rate, so that throughput stays close to the quota.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_second: float,
+        tokens_per_minute: float | None = None,
+        burst_seconds: float = RATE_LIMITER_BURST_SECONDS,
+    ):
+        self.name = name
+        self.max_requests_per_second = requests_per_second
+        self.requests = TokenBucket(requests_per_second, max(1.0, requests_per_second * burst_seconds))
+        self.tokens = None
+        if tokens_per_minute:
+            self.tokens = TokenBucket(tokens_per_minute / 60, max(1.0, tokens_per_minute / 60 * burst_seconds))
+        self.condition = threading.Condition()
+        self.waiters: list[tuple[int, int]] = []
+        self.sequence = itertools.count()
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.calls = 0
+        self.throttles = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def get_wait_seconds(self, tokens: int) -> float:
+        now = time.monotonic()
+        self.requests.refill(now)
+        wait_seconds = self.requests.get_wait_seconds(1)
+        if self.tokens is not None:
+            self.tokens.refill(now)
+            wait_seconds = max(wait_seconds, self.tokens.get_wait_seconds(tokens))
+        return wait_seconds
+
+    def acquire(self, tokens: int = 0, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """
+        Block until a call using tokens can be made and return the time waited in seconds
+        """
+        start = time.monotonic()
+        ticket = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiters, ticket)
+            self.max_queue_depth = max(self.max_queue_depth, len(self.waiters))
+            while True:
+                if self.waiters[0] != ticket:
+                    self.condition.wait()
+                    continue
+                wait_seconds = self.get_wait_seconds(tokens)
+                if wait_seconds <= 0:
+                    break
+                self.condition.wait(wait_seconds)
+
+            heapq.heappop(self.waiters)
+            self.requests.consume(1)
+            if self.tokens is not None:
+                self.tokens.consume(tokens)
+            waited_seconds = time.monotonic() - start
+            self.calls += 1
+            self.wait_seconds += waited_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, waited_seconds)
+            self.condition.notify_all()
+        return waited_seconds
+
+    def on_throttled(self):
+        with self.condition:
+            self.throttles += 1
+            self.requests.rate = max(0.1, self.requests.rate * RATE_LIMITER_THROTTLED_FACTOR)
+            # NOTE: Drop the burst allowance, the next call waits for the reduced rate
+            self.requests.tokens = min(self.requests.tokens, 0.0)
+
+    def on_success(self):
+        if self.requests.rate >= self.max_requests_per_second:
+            return
+        with self.condition:
+            self.requests.rate = min(
+                self.max_requests_per_second,
+                self.requests.rate + self.max_requests_per_second * RATE_LIMITER_RECOVERY_STEP,
+            )
+
+    def get_metrics(self, reset: bool = False) -> dict[str, float]:
+        with self.condition:
+            metrics = {
+                "RateLimiterCalls": self.calls,
+                "RateLimiterThrottles": self.throttles,
+                "RateLimiterQueueDepth": len(self.waiters),
+                "RateLimiterMaxQueueDepth": self.max_queue_depth,
+                "RateLimiterWaitTime": self.wait_seconds * 1000,
+                "RateLimiterMaxWaitTime": self.max_wait_seconds * 1000,
+                "RateLimiterRequestsPerSecond": self.requests.rate,
+            }
+            if reset:
+                self.reset_metrics()
+        return metrics
+
+
+METRICS_UNITS = {
+    "RateLimiterCalls": "Count",
+    "RateLimiterThrottles": "Count",
+    "RateLimiterQueueDepth": "Count",
+    "RateLimiterMaxQueueDepth": "Count",
+    "RateLimiterWaitTime": "Milliseconds",
+    "RateLimiterMaxWaitTime": "Milliseconds",
+    "RateLimiterRequestsPerSecond": "Count/Second",
+}
+
+RATE_LIMITERS: dict[str, RateLimiter] = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(model_id: str) -> RateLimiter:
+    """
+    Return the rate limiter of the model shared within the container
+    """
+    rate_limiter = RATE_LIMITERS.get(model_id)
+    if rate_limiter is None:
+        with RATE_LIMITERS_LOCK:
+            rate_limiter = RATE_LIMITERS.get(model_id)
+            if rate_limiter is None:
+                quota = BEDROCK_MODEL_QUOTAS.get(model_id, BEDROCK_DEFAULT_QUOTA)
+                rate_limiter = RateLimiter(model_id, quota["requests_per_second"], quota.get("tokens_per_minute"))
+                RATE_LIMITERS[model_id] = rate_limiter
+    return rate_limiter
+
+
+def is_transient_error(err: botocore.exceptions.ClientError) -> bool:
+    return (
+        err.response["Error"]["Code"] in TRANSIENT_ERROR_CODES
+        or err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    )
+
+
+def get_backoff_seconds(
+    attempt: int,
+    backoff_seconds: float = RATE_LIMITER_BACKOFF_SECONDS,
+    max_backoff_seconds: float = RATE_LIMITER_MAX_BACKOFF_SECONDS,
+) -> float:
+    """
+    Return a random backoff (full jitter) doubling with each attempt, so that retrying containers do not all
+    call again at the same time
+    """
+    return random.uniform(0, min(max_backoff_seconds, backoff_seconds * 2**attempt))
+
+
+def call_model(
+    method,
+    model_id: str,
+    tokens: int = 0,
+    priority: int = PRIORITY_INTERACTIVE,
+    max_retries: int = RATE_LIMITER_MAX_RETRIES,
+    **kwargs,
+):
+    """
+    Call the client method (e.g. bedrock_runtime.invoke_model) for the model once the rate limiter allows it,
+    throttled calls slow the rate limiter down and transient errors back off, both are retried up to max_retries times
+    """
+    rate_limiter = get_rate_limiter(model_id)
+    for attempt in itertools.count():
+        rate_limiter.acquire(tokens, priority)
+        try:
+            response = method(modelId=model_id, **kwargs)
+        except botocore.exceptions.ClientError as err:
+            if attempt >= max_retries:
+                raise
+            if err.response["Error"]["Code"] in THROTTLING_ERROR_CODES:
+                rate_limiter.on_throttled()
+                continue
+            if not is_transient_error(err):
+                raise
+            time.sleep(get_backoff_seconds(attempt))
+            continue
+        except TRANSIENT_EXCEPTIONS:
+            if attempt >= max_retries:
+                raise
+            time.sleep(get_backoff_seconds(attempt))
+            continue
+        rate_limiter.on_success()
+        return response
+
+
+def report_rate_limiters_metrics(namespace: str = METRICS_NAMESPACE):
+    """
+    Log the metrics of all rate limiters since the last report in CloudWatch embedded metric format
+    """
+    for model_id, rate_limiter in list(RATE_LIMITERS.items()):
+        metrics = rate_limiter.get_metrics(reset=True)
+        if not metrics["RateLimiterCalls"] and not metrics["RateLimiterQueueDepth"]:
+            continue
+        print(
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": int(time.time() * 1000),
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": namespace,
+                                "Dimensions": [["ModelId"]],
+                                "Metrics": [{"Name": name, "Unit": METRICS_UNITS[name]} for name in metrics],
+                            }
+                        ],
+                    },
+                    "ModelId": model_id,
+                    **metrics,
+                }
+            )
+        )
+
@@ -0,0 +1,105 @@
+import sqlite3
+
+import numpy as np
+
+# NOTE: A single row holding the PCA projection of the embeddings searched by the vector index
+SQL_CREATE_EMBEDDING_REDUCTION_TABLE = """
+CREATE TABLE IF NOT EXISTS embedding_reduction (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    embedding_size INTEGER,
+    n_components INTEGER,
+    mean BLOB,
+    components BLOB,
+    explained_variance REAL
+);
+"""
+
+SQL_QUERY_EMBEDDING_REDUCTION = """
+SELECT embedding_size, n_components, mean, components, explained_variance FROM embedding_reduction WHERE id = 0
+"""
+
+SQL_UPSERT_EMBEDDING_REDUCTION = """
+INSERT OR REPLACE INTO embedding_reduction(id, embedding_size, n_components, mean, components, explained_variance)
+VALUES(0, :embedding_size, :n_components, :mean, :components, :explained_variance)
+"""
+
+SQL_DELETE_EMBEDDING_REDUCTION = """
+DELETE FROM embedding_reduction
+"""
+
+
+class PCAReduction:
+    """
+    Projection of embeddings on the n_components principal components of a sample of them.
+    The projection is orthonormal, so that squared L2 distances between projected embeddings approximate
+    the ones between full embeddings (the variance outside of the components is lost).
+    """
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance: float | None = None):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.explained_variance = explained_variance
+        # NOTE: (x - mean) @ components.T without a centered copy of large matrices
+        self.offset = self.mean @ self.components.T
+
+    @property
+    def embedding_size(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def n_components(self) -> int:
+        return self.components.shape[0]
+
+    def transform(self, embeddings: list[float] | list[list[float]] | np.ndarray) -> np.ndarray:
+        """
+        Project an embedding or a matrix of embeddings
+        """
+        return np.asarray(embeddings, dtype=np.float32) @ self.components.T - self.offset
+
+    @classmethod
+    def fit(cls, sample: np.ndarray, n_components: int) -> "PCAReduction":
+        """
+        Fit the projection on a sample of embeddings, out of the eigenvectors of their covariance matrix
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+        mean = sample.mean(axis=0)
+        centered = (sample - mean).astype(np.float64)
+        eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered / max(len(sample) - 1, 1))
+        # NOTE: eigh returns the eigenvalues in ascending order
+        order = np.argsort(eigenvalues)[::-1][:n_components]
+        explained_variance = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+        return cls(mean, eigenvectors[:, order].T, explained_variance)
+
+
+def load_reduction(connection: sqlite3.Connection) -> PCAReduction | None:
+    """
+    Return the reduction stored within the database, None if embeddings are searched with all their dimensions
+    """
+    row = connection.execute(SQL_QUERY_EMBEDDING_REDUCTION).fetchone()
+    if row is None:
+        return None
+    embedding_size, n_components, mean, components, explained_variance = row
+    return PCAReduction(
+        np.frombuffer(mean, dtype=np.float32),
+        np.frombuffer(components, dtype=np.float32).reshape(n_components, embedding_size),
+        explained_variance,
+    )
+
+
+def save_reduction(connection: sqlite3.Connection, reduction: PCAReduction | None):
+    """
+    Store the reduction within the database (or remove it), this has to happen within a transaction
+    """
+    if reduction is None:
+        connection.execute(SQL_DELETE_EMBEDDING_REDUCTION)
+        return
+    connection.execute(
+        SQL_UPSERT_EMBEDDING_REDUCTION,
+        {
+            "embedding_size": reduction.embedding_size,
+            "n_components": reduction.n_components,
+            "mean": reduction.mean.tobytes(),
+            "components": reduction.components.tobytes(),
+            "explained_variance": reduction.explained_variance,
+        },
+    )
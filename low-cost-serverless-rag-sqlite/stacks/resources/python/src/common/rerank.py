@@ -0,0 +1,182 @@
+import threading
+
+import numpy as np
+
+from .config import (
+    CROSS_ENCODER_BATCH_SIZE,
+    CROSS_ENCODER_MAX_LENGTH,
+    CROSS_ENCODER_MODEL_ID,
+    LOCAL_EMBEDDING_MODELS_DIR,
+    LOCAL_EMBEDDING_THREADS,
+    MMR_LAMBDA,
+    RERANK_METHOD,
+)
+from .embeddings import ONNX_MODEL_ID_PREFIX, load_onnx_model
+
+RERANK_METHOD_MMR = "mmr"
+RERANK_METHOD_CROSS_ENCODER = "cross_encoder"
+RERANK_METHODS = (RERANK_METHOD_MMR, RERANK_METHOD_CROSS_ENCODER)
+
+
+def get_rerank_method(method: str | None = RERANK_METHOD) -> str | None:
+    """
+    Return the re-ranking method, None when re-ranking is disabled
+    """
+    if not method or method.lower() == "none":
+        return None
+    if method not in RERANK_METHODS:
+        raise ValueError(f"Unknown re-ranking method {method}, expected one of {RERANK_METHODS}")
+    return method
+
+
+def get_normalized_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=-1, keepdims=True), 1e-12)
+
+
+def get_lsh_vectors(lsh_list: list[str]) -> np.ndarray:
+    """
+    Return LSH bit strings as +1 / -1 vectors: their cosine similarity (1 - 2 * hamming distance / bits)
+    approximates the cosine similarity of the embeddings they were computed from
+    """
+    bits = np.array([np.frombuffer(lsh.encode(), dtype=np.uint8) for lsh in lsh_list], dtype=np.float32)
+    return 2 * (bits - ord("0")) - 1
+
+
+def select_mmr(
+    candidate_vectors: np.ndarray,
+    top_n: int,
+    query_vector: np.ndarray | None = None,
+    relevances: np.ndarray | None = None,
+    mmr_lambda: float = MMR_LAMBDA,
+) -> list[tuple[int, float]]:
+    """
+    Maximal marginal relevance: greedily select the candidate maximizing
+    mmr_lambda * relevance - (1 - mmr_lambda) * max similarity to the already selected candidates,
+    so that near duplicate chunks do not fill the context.
+    Relevances default to the cosine similarity to query_vector, or to the rank of the candidates without it.
+    Return (candidate index, mmr score) in selection order.
+    """
+    candidates = get_normalized_rows(candidate_vectors)
+    if relevances is None:
+        if query_vector is not None:
+            relevances = candidates @ get_normalized_rows(query_vector)
+        else:
+            relevances = 1.0 - np.arange(len(candidates), dtype=np.float32) / max(len(candidates), 1)
+    similarities = candidates @ candidates.T
+
+    selected: list[tuple[int, float]] = []
+    redundancies = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    for _ in range(min(top_n, len(candidates))):
+        scores = np.where(available, mmr_lambda * relevances - (1 - mmr_lambda) * redundancies, -np.inf)
+        best = int(np.argmax(scores))
+        redundancies = similarities[best] if not selected else np.maximum(redundancies, similarities[best])
+        selected.append((best, float(scores[best])))
+        available[best] = False
+    return selected
+
+
+class CrossEncoder:
+    """
+    Cross-encoder run locally on CPU with ONNX Runtime, scoring the relevance of (query, text) pairs.
+    The model "onnx/<name>" is loaded once per process out of LOCAL_EMBEDDING_MODELS_DIR/<name>,
+    which holds the exported model (model.onnx) and its tokenizer (tokenizer.json).
+    """
+
+    model_id_prefix = ONNX_MODEL_ID_PREFIX
+
+    def __init__(
+        self,
+        model_id: str = CROSS_ENCODER_MODEL_ID,
+        batch_size: int = CROSS_ENCODER_BATCH_SIZE,
+        threads: int | None = LOCAL_EMBEDDING_THREADS,
+        max_length: int = CROSS_ENCODER_MAX_LENGTH,
+        models_dir: str = LOCAL_EMBEDDING_MODELS_DIR,
+    ):
+        if not model_id.startswith(self.model_id_prefix):
+            raise ValueError(f"Unknown cross-encoder model {model_id}, expected a model id starting with onnx/")
+
+        self.model_id = model_id
+        self.batch_size = max(1, batch_size)
+        self.tokenizer, self.session, self.input_names = load_onnx_model(model_id, threads, max_length, models_dir)
+
+    def invoke(self, query: str, texts: list[str]) -> np.ndarray:
+        """
+        Score the texts against the query with a single inference
+        """
+        encodings = self.tokenizer.encode_batch([(query, text) for text in texts])
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        (logits,) = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})
+        # NOTE: Models with a single output logit score relevance directly, others score (not relevant, relevant)
+        return logits[:, -1] if logits.ndim == 2 else logits
+
+    def score(self, query: str, texts: list[str]) -> np.ndarray:
+        """
+        Score the texts against the query in batches of texts of similar length (less padding),
+        scores are returned in the order of the texts, higher is more relevant
+        """
+        order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+        scores = np.empty(len(texts), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            scores[batch] = self.invoke(query, [texts[idx] for idx in batch])
+        return scores
+
+
+CROSS_ENCODER_INSTANCES: dict[str, CrossEncoder] = {}
+CROSS_ENCODER_INSTANCES_LOCK = threading.Lock()
+
+
+def get_cross_encoder(model_id: str = CROSS_ENCODER_MODEL_ID) -> CrossEncoder:
+    """
+    Return the cross-encoder of the model shared within the container
+    """
+    cross_encoder = CROSS_ENCODER_INSTANCES.get(model_id)
+    if cross_encoder is None:
+        with CROSS_ENCODER_INSTANCES_LOCK:
+            cross_encoder = CROSS_ENCODER_INSTANCES.get(model_id)
+            if cross_encoder is None:
+                cross_encoder = CrossEncoder(model_id)
+                CROSS_ENCODER_INSTANCES[model_id] = cross_encoder
+    return cross_encoder
+
+
+def rerank_chunks(
+    query: str,
+    chunks: list[dict],
+    top_n: int,
+    method: str | None = RERANK_METHOD,
+    query_vector: list[float] | np.ndarray | None = None,
+    chunk_vectors: list[list[float]] | np.ndarray | None = None,
+    mmr_lambda: float = MMR_LAMBDA,
+) -> list[dict]:
+    """
+    Re-rank the chunks retrieved for the query (sorted by relevance, most relevant first)
+    and return the top_n best ones with their "rerank_score", most relevant first:
+    RERANK_METHOD_MMR trades relevance for diversity out of the chunk vectors (stored embeddings or LSH vectors)
+    and RERANK_METHOD_CROSS_ENCODER scores each (query, chunk text) pair with the cross-encoder.
+    Without a method, the top_n first chunks are returned as is.
+    """
+    method = get_rerank_method(method)
+    if method is None or not chunks:
+        return chunks[:top_n]
+
+    if method == RERANK_METHOD_MMR:
+        if chunk_vectors is None or len(chunk_vectors) != len(chunks):
+            raise ValueError("MMR re-ranking needs one vector per chunk")
+        ranked = select_mmr(
+            np.asarray(chunk_vectors, dtype=np.float32),
+            top_n,
+            query_vector=None if query_vector is None else np.asarray(query_vector, dtype=np.float32),
+            mmr_lambda=mmr_lambda,
+        )
+    else:
+        scores = get_cross_encoder().score(query, [chunk["text"] for chunk in chunks])
+        ranked = [(int(idx), float(scores[idx])) for idx in np.argsort(-scores, kind="stable")[:top_n]]
+
+    return [{**chunks[idx], "rerank_score": score} for idx, score in ranked]
@@ -0,0 +1,204 @@
+import functools
+import os
+import struct
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+
+from .config import (
+    SQLITE_DB_COMPRESSION_FRAME_SIZE,
+    SQLITE_DB_COMPRESSION_LEVEL,
+    SQLITE_DB_TRANSFER_CONCURRENCY,
+    SQLITE_DB_TRANSFER_PART_SIZE,
+)
+
+# NOTE: Files are compressed in the zstd seekable format: independent zstd frames followed by a seek table
+# (a skippable frame listing the compressed / decompressed size of each frame), so that any frame can be
+# downloaded and decompressed on its own, see
+# https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+COMPRESSION_SUFFIXES = {"zstd": ".zst"}
+
+SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct("<IBI")
+SEEK_TABLE_ENTRY = struct.Struct("<II")
+SEEK_TABLE_ENTRY_WITH_CHECKSUM = struct.Struct("<III")
+SEEK_TABLE_CHECKSUM_FLAG = 0x80
+
+# NOTE: The end of the object is fetched with the first request, it holds the seek table of files up to ~8 GB
+SEEK_TABLE_TAIL_SIZE = 64 * 1024
+
+
+def get_compressed_key(key: str, compression: str) -> str:
+    """
+    Return the S3 key of the compressed version of the object
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression {compression}, expected one of {tuple(COMPRESSION_SUFFIXES)}")
+    return f"{key}{COMPRESSION_SUFFIXES[compression]}"
+
+
+def compress_frame(data: bytes, level: int = SQLITE_DB_COMPRESSION_LEVEL) -> bytes:
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=level, write_content_size=True).compress(data)
+
+
+def iter_compressed_frames(
+    file_in: BinaryIO,
+    level: int = SQLITE_DB_COMPRESSION_LEVEL,
+    frame_size: int = SQLITE_DB_COMPRESSION_FRAME_SIZE,
+    max_workers: int = SQLITE_DB_TRANSFER_CONCURRENCY,
+) -> Iterator[tuple[bytes, int]]:
+    """
+    Yield (compressed frame, decompressed size) of consecutive frame_size parts of the file,
+    max_workers frames are compressed in parallel (zstandard releases the GIL)
+    """
+    with ThreadPoolExecutor(max_workers) as executor:
+        while True:
+            parts = [part for part in (file_in.read(frame_size) for _ in range(max_workers)) if part]
+            if not parts:
+                return
+            frames = executor.map(functools.partial(compress_frame, level=level), parts)
+            yield from zip(frames, (len(part) for part in parts))
+
+
+def compress_file_seekable(
+    source_path: str,
+    target_path: str,
+    level: int = SQLITE_DB_COMPRESSION_LEVEL,
+    frame_size: int = SQLITE_DB_COMPRESSION_FRAME_SIZE,
+    max_workers: int = SQLITE_DB_TRANSFER_CONCURRENCY,
+):
+    """
+    Compress the file into independent zstd frames of frame_size decompressed bytes followed by their seek table
+    """
+    entries = []
+    with open(source_path, "rb") as file_in, open(target_path, "wb") as file_out:
+        for frame, decompressed_size in iter_compressed_frames(file_in, level, frame_size, max_workers):
+            file_out.write(frame)
+            entries.append((len(frame), decompressed_size))
+
+        seek_table = b"".join(SEEK_TABLE_ENTRY.pack(*entry) for entry in entries)
+        seek_table += SEEK_TABLE_FOOTER.pack(len(entries), 0, SEEKABLE_MAGIC)
+        file_out.write(struct.pack("<II", SKIPPABLE_FRAME_MAGIC, len(seek_table)) + seek_table)
+
+
+def get_seek_table_size(tail: bytes) -> tuple[int, struct.Struct]:
+    """
+    Return the size of the seek table (skippable frame included) and the struct of its entries
+    out of the end of a seekable zstd file
+    """
+    n_frames, descriptor, magic = SEEK_TABLE_FOOTER.unpack(tail[-SEEK_TABLE_FOOTER.size :])
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("Not a seekable zstd file")
+    entry_struct = SEEK_TABLE_ENTRY_WITH_CHECKSUM if descriptor & SEEK_TABLE_CHECKSUM_FLAG else SEEK_TABLE_ENTRY
+    return 8 + n_frames * entry_struct.size + SEEK_TABLE_FOOTER.size, entry_struct
+
+
+def read_seek_table(tail: bytes) -> list[tuple[int, int]] | None:
+    """
+    Return (compressed size, decompressed size) of each frame out of the end of a seekable zstd file,
+    or None if the seek table is not entirely within tail
+    """
+    seek_table_size, entry_struct = get_seek_table_size(tail)
+    if seek_table_size > len(tail):
+        return None
+    n_frames = (seek_table_size - 8 - SEEK_TABLE_FOOTER.size) // entry_struct.size
+    entries_start = len(tail) - seek_table_size + 8
+    return [
+        entry_struct.unpack_from(tail, entries_start + idx * entry_struct.size)[:2] for idx in range(n_frames)
+    ]
+
+
+def get_object_range(s3_client, bucket: str, key: str, byte_range: str) -> dict:
+    return s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={byte_range}")
+
+
+def get_parts(
+    entries: list[tuple[int, int]], part_size: int = SQLITE_DB_TRANSFER_PART_SIZE
+) -> list[tuple[int, list[tuple[int, int, int]]]]:
+    """
+    Group consecutive frames into parts of about part_size compressed bytes.
+    Return (compressed offset, [(compressed size, decompressed size, decompressed offset), ...]) of each part.
+    """
+    parts: list[tuple[int, list[tuple[int, int, int]]]] = []
+    compressed_offset, decompressed_offset, part_compressed_size = 0, 0, 0
+    for compressed_size, decompressed_size in entries:
+        if not parts or part_compressed_size + compressed_size > part_size:
+            parts.append((compressed_offset, []))
+            part_compressed_size = 0
+        parts[-1][1].append((compressed_size, decompressed_size, decompressed_offset))
+        part_compressed_size += compressed_size
+        compressed_offset += compressed_size
+        decompressed_offset += decompressed_size
+    return parts
+
+
+def download_part(s3_client, bucket: str, key: str, fd: int, part: tuple[int, list[tuple[int, int, int]]]):
+    """
+    Download the part with a single ranged GET and decompress its frames into the file as they arrive
+    """
+    import zstandard
+
+    compressed_offset, frames = part
+    compressed_end = compressed_offset + sum(compressed_size for compressed_size, _, _ in frames) - 1
+    body = get_object_range(s3_client, bucket, key, f"{compressed_offset}-{compressed_end}")["Body"]
+    decompressor = zstandard.ZstdDecompressor()
+    for compressed_size, decompressed_size, decompressed_offset in frames:
+        frame = body.read(compressed_size)
+        os.pwrite(fd, decompressor.decompress(frame, max_output_size=decompressed_size), decompressed_offset)
+
+
+def download_file_seekable(
+    s3_client,
+    bucket: str,
+    key: str,
+    local_path: str,
+    part_size: int = SQLITE_DB_TRANSFER_PART_SIZE,
+    max_workers: int = SQLITE_DB_TRANSFER_CONCURRENCY,
+):
+    """
+    Download a seekable zstd object and decompress it to local_path: parts of about part_size compressed bytes
+    are fetched with max_workers parallel ranged GETs and each frame is decompressed and written at its offset
+    as soon as it is received, so that network, decompression and disk writes overlap.
+    """
+    # NOTE: A suffix range fetches the seek table without knowing the size of the object (no HEAD request)
+    response = get_object_range(s3_client, bucket, key, f"-{SEEK_TABLE_TAIL_SIZE}")
+    tail = response["Body"].read()
+    entries = read_seek_table(tail)
+    if entries is None:
+        seek_table_size, _ = get_seek_table_size(tail)
+        tail = get_object_range(s3_client, bucket, key, f"-{seek_table_size}")["Body"].read()
+        entries = read_seek_table(tail)
+
+    tmp_path = f"{local_path}.part"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, sum(decompressed_size for _, decompressed_size in entries))
+        parts = get_parts(entries, part_size)
+        with ThreadPoolExecutor(max(1, min(max_workers, len(parts)))) as executor:
+            for _ in executor.map(functools.partial(download_part, s3_client, bucket, key, fd), parts):
+                pass
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, local_path)
+
+
+def upload_file_seekable(
+    s3_client,
+    bucket: str,
+    key: str,
+    local_path: str,
+    level: int = SQLITE_DB_COMPRESSION_LEVEL,
+    frame_size: int = SQLITE_DB_COMPRESSION_FRAME_SIZE,
+):
+    """
+    Compress the file in the seekable zstd format next to it and upload it (multipart upload for large files)
+    """
+    compressed_path = f"{local_path}{COMPRESSION_SUFFIXES['zstd']}"
+    compress_file_seekable(local_path, compressed_path, level=level, frame_size=frame_size)
+    try:
+        s3_client.upload_file(compressed_path, bucket, key)
+    finally:
+        os.remove(compressed_path)
@@ -0,0 +1,875 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from .config import (
+    EMBEDDING_REDUCTION_COMPONENTS,
+    EMBEDDING_REDUCTION_SAMPLE_SIZE,
+    EMBEDDING_SIZE,
+    HNSW_EF,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_M,
+    IVF_N_LISTS,
+    IVF_NPROBE,
+    IVF_TRAINING_SAMPLE_SIZE,
+    VECTOR_INDEX_BACKEND,
+    VSS_INDEX_FACTORY,
+    VSS_TRAINING_SAMPLE_SIZE,
+)
+from .reduction import SQL_CREATE_EMBEDDING_REDUCTION_TABLE, PCAReduction, load_reduction, save_reduction
+
+SQL_CREATE_EMBEDDINGS_TABLE = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    id INTEGER PRIMARY KEY,
+    embedding BLOB
+);
+"""
+
+SQL_INSERT_EMBEDDING = """
+INSERT INTO embeddings(id, embedding)
+VALUES(:id, :embedding)
+"""
+
+SQL_QUERY_EMBEDDINGS = """
+SELECT id, embedding FROM embeddings ORDER BY id
+"""
+
+SQL_QUERY_EMBEDDINGS_BY_IDS = """
+SELECT id, embedding FROM embeddings WHERE id IN (SELECT value FROM json_each(:ids))
+"""
+
+SQL_DELETE_EMBEDDINGS_BY_IDS = """
+DELETE FROM embeddings WHERE id IN (SELECT value FROM json_each(:ids))
+"""
+
+SQL_QUERY_EMBEDDINGS_COUNT = """
+SELECT count(*) FROM embeddings
+"""
+
+SQL_QUERY_EMBEDDINGS_SAMPLE = """
+SELECT embedding FROM embeddings ORDER BY random() LIMIT :sample_size
+"""
+
+# NOTE: Parts of Faiss factory strings of indexes which need to be trained before vectors can be added
+FAISS_TRAINED_INDEX_KEYWORDS = ("IVF", "PQ", "SQ", "LSH", "PCA", "ITQ", "RR")
+
+# NOTE: Vectors are processed in batches while training / assigning lists to bound memory usage
+ASSIGNMENT_BATCH_SIZE = 16384
+
+# NOTE: sqlite-vss returns the stored vectors as float32 blobs, so that they can be copied as is
+SQL_BACKFILL_EMBEDDINGS_FROM_VSS = """
+INSERT INTO embeddings(id, embedding)
+SELECT rowid, text_embedding FROM vss_documents
+"""
+
+SQL_CREATE_VSS_DOCUMENTS_TABLE_TEMPLATE = """
+CREATE virtual table IF NOT EXISTS vss_documents using vss0(
+  text_embedding({embedding_size}){factory}
+);
+"""
+
+SQL_DROP_VSS_DOCUMENTS_TABLE = """
+DROP TABLE IF EXISTS vss_documents
+"""
+
+# NOTE: sqlite-vss trains the index when the transaction is committed
+SQL_TRAIN_VSS_DOCUMENT = """
+INSERT INTO vss_documents(operation, text_embedding)
+VALUES('training', :text_embedding)
+"""
+
+SQL_INSERT_VSS_DOCUMENT = """
+INSERT INTO vss_documents(rowid, text_embedding)
+VALUES(:rowid, :text_embedding)
+"""
+
+SQL_QUERY_VSS_DOCUMENTS = """
+SELECT
+    rowid,
+    distance
+FROM vss_documents
+WHERE
+    vss_search(
+        text_embedding,
+        vss_search_params(
+            :embedding,
+            :top_n_documents
+        )
+    )
+ORDER BY distance ASC
+"""
+
+SQL_QUERY_VSS_DOCUMENTS_COUNT = """SELECT count(*) FROM vss_documents"""
+
+SQL_DELETE_VSS_DOCUMENTS_BY_IDS = """
+DELETE FROM vss_documents WHERE rowid IN (SELECT value FROM json_each(:ids))
+"""
+
+
+def get_serialized_embedding(embedding: list[float] | np.ndarray) -> str:
+    if isinstance(embedding, np.ndarray):
+        embedding = embedding.tolist()
+
+    return json.dumps(embedding)
+
+
+def get_embedding_blob(embedding: list[float] | np.ndarray) -> bytes:
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def table_exists(connection: sqlite3.Connection, table_name: str) -> bool:
+    query = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?"
+    return connection.execute(query, [table_name]).fetchone() is not None
+
+
+def load_vss_extension(connection: sqlite3.Connection):
+    import sqlite_vss
+
+    connection.enable_load_extension(True)
+    sqlite_vss.load(connection)
+    connection.enable_load_extension(False)
+    (version,) = connection.execute("select vss_version()").fetchone()
+    print("VSS_VERSION: ", version)
+
+
+def load_embeddings(connection: sqlite3.Connection, embedding_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Load all stored embeddings and return their ids and the embeddings matrix
+    """
+    rows = connection.execute(SQL_QUERY_EMBEDDINGS).fetchall()
+    return get_ids_matrix(rows, embedding_size)
+
+
+def get_ids_matrix(rows: list[tuple[int, bytes]], embedding_size: int) -> tuple[np.ndarray, np.ndarray]:
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), embedding_size)
+    return ids, matrix
+
+
+def get_squared_norms(matrix: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", matrix, matrix)
+
+
+def get_top_n(
+    ids: np.ndarray, matrix: np.ndarray, norms: np.ndarray, embedding: list[float] | np.ndarray, top_n: int
+) -> list[tuple[int, float]]:
+    """
+    Exact search: return (id, squared L2 distance) of the top_n rows of matrix closest to embedding
+    """
+    if len(ids) == 0:
+        return []
+    query = np.asarray(embedding, dtype=np.float32)
+    distances = np.maximum(norms - 2 * (matrix @ query) + query @ query, 0)
+    top_n = min(top_n, len(distances))
+    best_idx = np.argpartition(distances, top_n - 1)[:top_n]
+    best_idx = best_idx[np.argsort(distances[best_idx])]
+    return [(int(ids[idx]), float(distances[idx])) for idx in best_idx]
+
+
+def get_closest_centroids(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    centroids_norms = get_squared_norms(centroids)
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), ASSIGNMENT_BATCH_SIZE):
+        batch = matrix[start : start + ASSIGNMENT_BATCH_SIZE]
+        assignments[start : start + len(batch)] = np.argmin(centroids_norms - 2 * (batch @ centroids.T), axis=1)
+    return assignments
+
+
+def train_kmeans(matrix: np.ndarray, n_clusters: int, n_iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means, return the centroids
+    """
+    rnd = np.random.RandomState(seed)
+    centroids = matrix[rnd.choice(len(matrix), n_clusters, replace=False)].astype(np.float32)
+    for _ in range(n_iterations):
+        assignments = get_closest_centroids(matrix, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, matrix)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # NOTE: Empty clusters keep their previous centroid
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids
+
+
+class VectorIndex:
+    """
+    Base class of the vector indexes used to search documents by embedding.
+
+    Embeddings are always stored within the embeddings table, so that any index can be built out of it.
+    Indexes may persist their own format in sidecar files next to the database file.
+    Distances are squared L2 distances like the ones returned by sqlite-vss.
+    With a PCA reduction stored within the database, indexes hold the projected embeddings and queries are
+    projected the same way, distances are the ones between projected embeddings.
+    """
+
+    name: str = None
+    sidecar_suffixes: tuple[str, ...] = ()
+    # NOTE: Indexes holding all embeddings in memory restrict a search to allowed ids at about the cost of a search
+    supports_allow_list: bool = False
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        database: str,
+        embedding_size: int = EMBEDDING_SIZE,
+        reduction_components: int | None = EMBEDDING_REDUCTION_COMPONENTS,
+    ):
+        self.connection = connection
+        self.database = database
+        self.embedding_size = embedding_size
+        self.reduction_components = reduction_components
+        self.reduction: PCAReduction | None = None
+
+    @property
+    def index_size(self) -> int:
+        """
+        Dimension of the vectors held by the index: the number of components of the reduction if any
+        """
+        return self.embedding_size if self.reduction is None else self.reduction.n_components
+
+    def initialize(self):
+        embeddings_table_exists = table_exists(self.connection, "embeddings")
+        with self.connection:
+            self.connection.execute(SQL_CREATE_EMBEDDINGS_TABLE)
+            self.connection.execute(SQL_CREATE_EMBEDDING_REDUCTION_TABLE)
+            # NOTE: Databases created before the embeddings table only store embeddings within vss_documents
+            if not embeddings_table_exists and table_exists(self.connection, "vss_documents"):
+                if self.name != VSSIndex.name:
+                    load_vss_extension(self.connection)
+                self.connection.execute(SQL_BACKFILL_EMBEDDINGS_FROM_VSS)
+        self.reduction = load_reduction(self.connection)
+
+    def count(self) -> int:
+        return self.connection.execute(SQL_QUERY_EMBEDDINGS_COUNT).fetchone()[0]
+
+    def reduce(self, embeddings: list[float] | list[list[float]] | np.ndarray) -> np.ndarray:
+        """
+        Return an embedding or a matrix of embeddings as held by the index, projected by the reduction if any
+        """
+        if self.reduction is None:
+            return np.asarray(embeddings, dtype=np.float32)
+        return self.reduction.transform(embeddings)
+
+    def load_vectors(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Load all stored embeddings and return their ids and the matrix of their (reduced) vectors
+        """
+        ids, matrix = load_embeddings(self.connection, self.embedding_size)
+        return ids, self.reduce(matrix)
+
+    def get_embeddings_sample(self, sample_size: int) -> np.ndarray:
+        """
+        Return a random sample of the stored embeddings (not reduced)
+        """
+        rows = self.connection.execute(SQL_QUERY_EMBEDDINGS_SAMPLE, {"sample_size": sample_size})
+        return np.frombuffer(b"".join(row[0] for row in rows), dtype=np.float32).reshape(-1, self.embedding_size)
+
+    def get_reduction_components(self, sample_size: int = EMBEDDING_REDUCTION_SAMPLE_SIZE) -> int | None:
+        """
+        Return the number of components of the reduction to fit, None when embeddings are searched with all
+        their dimensions, including while fewer embeddings than components are stored to fit it on
+        """
+        if not self.reduction_components or self.reduction_components >= self.embedding_size:
+            return None
+        if min(self.count(), sample_size) < self.reduction_components:
+            return None
+        return self.reduction_components
+
+    def fit_reduction(self, sample_size: int = EMBEDDING_REDUCTION_SAMPLE_SIZE):
+        """
+        Fit the PCA reduction on a sample of the stored embeddings and store it within the database
+        (or remove it when not configured), the index has to be rebuilt afterwards
+        """
+        reduction = None
+        n_components = self.get_reduction_components(sample_size)
+        if n_components is not None:
+            reduction = PCAReduction.fit(self.get_embeddings_sample(sample_size), n_components)
+            print(
+                f"EMBEDDING REDUCTION: {self.embedding_size} -> {n_components} dimensions, "
+                f"{reduction.explained_variance:.1%} of the variance explained"
+            )
+        with self.connection:
+            save_reduction(self.connection, reduction)
+        self.reduction = reduction
+
+    def load(self):
+        """
+        Load the index into memory, so that the first search does not need to
+        """
+
+    def add(self, ids: list[int], embeddings: list[list[float]] | np.ndarray):
+        """
+        Store the embeddings, this has to happen within the transaction inserting the documents
+        """
+        self.connection.executemany(
+            SQL_INSERT_EMBEDDING,
+            [{"id": id_, "embedding": get_embedding_blob(embedding)} for id_, embedding in zip(ids, embeddings)],
+        )
+
+    def remove(self, ids: list[int]):
+        """
+        Remove the stored embeddings, this has to happen within the transaction deleting the documents.
+        The index still holds them until it is rebuilt.
+        """
+        self.connection.execute(SQL_DELETE_EMBEDDINGS_BY_IDS, {"ids": json.dumps(list(ids))})
+
+    def search(
+        self, embedding: list[float] | np.ndarray, top_n: int, nprobe: int | None = None
+    ) -> list[tuple[int, float]]:
+        """
+        Return (id, distance) of the top_n closest embeddings sorted by distance.
+        nprobe is the number of inverted lists visited by indexes supporting it and ignored otherwise.
+        """
+        raise NotImplementedError
+
+    def search_allowed(
+        self, embedding: list[float] | np.ndarray, top_n: int, allowed_ids: list[int]
+    ) -> list[tuple[int, float]]:
+        """
+        Return (id, distance) of the top_n closest embeddings among allowed_ids sorted by distance.
+        By default the allowed embeddings are read from the embeddings table and searched exactly.
+        """
+        rows = self.connection.execute(SQL_QUERY_EMBEDDINGS_BY_IDS, {"ids": json.dumps(list(allowed_ids))}).fetchall()
+        ids, matrix = get_ids_matrix(rows, self.embedding_size)
+        matrix = self.reduce(matrix)
+        return get_top_n(ids, matrix, get_squared_norms(matrix), self.reduce(embedding), top_n)
+
+    def get_embeddings(self, ids: list[int]) -> np.ndarray:
+        """
+        Return the stored (full) embeddings of the ids in the same order, e.g. to re-rank search results
+        """
+        rows = self.connection.execute(SQL_QUERY_EMBEDDINGS_BY_IDS, {"ids": json.dumps(list(ids))}).fetchall()
+        rows_ids, matrix = get_ids_matrix(rows, self.embedding_size)
+        positions = {id_: position for position, id_ in enumerate(rows_ids.tolist())}
+        return matrix[[positions[id_] for id_ in ids]]
+
+    def needs_rebuild(self) -> bool:
+        """
+        Tell whether stored embeddings are missing from the index, e.g. because it needs to be trained first,
+        or whether the reduction has to be fitted (again)
+        """
+        n_components = None if self.reduction is None else self.reduction.n_components
+        return n_components != self.get_reduction_components()
+
+    def rebuild(self):
+        """
+        Rebuild (and retrain if applicable) the index out of all stored embeddings, e.g. after a bulk import.
+        The reduction is fitted again first, so that it reflects the whole corpus as well.
+        """
+        self.fit_reduction()
+        self.load()
+
+    def get_sidecar_paths(self, database: str | None = None, suffixes: tuple[str, ...] | None = None) -> list[str]:
+        database = self.database if database is None else database
+        if not isinstance(database, str) or database.startswith(":"):
+            return []
+        return [f"{database}{suffix}" for suffix in (self.sidecar_suffixes if suffixes is None else suffixes)]
+
+    def save(self, database: str | None = None) -> list[str]:
+        """
+        Persist the index next to the database (or next to a copy of it) and return the paths of the files written
+        """
+        return []
+
+    def save_for_queries(self, database: str | None = None) -> list[str]:
+        """
+        Persist the index next to the database of the query artifact and return the paths of the files written,
+        by default the same files as save()
+        """
+        return self.save(database)
+
+
+class VSSIndex(VectorIndex):
+    """
+    Faiss index managed by the sqlite-vss extension within the vss_documents virtual table.
+    The query artifact also holds its vectors as npy files, which are memory-mapped when loaded
+    and searched exactly for filtered searches instead of reading the embeddings table.
+    """
+
+    name = "vss"
+    vectors_suffixes = (".vss.vectors.npy", ".vss.ids.npy")
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        database: str,
+        embedding_size: int = EMBEDDING_SIZE,
+        factory: str | None = VSS_INDEX_FACTORY,
+        training_sample_size: int = VSS_TRAINING_SAMPLE_SIZE,
+        reduction_components: int | None = EMBEDDING_REDUCTION_COMPONENTS,
+    ):
+        super().__init__(connection, database, embedding_size, reduction_components)
+        self.factory = factory
+        self.training_sample_size = training_sample_size
+        self.ids: np.ndarray | None = None
+        self.vectors: np.ndarray | None = None
+        self.norms: np.ndarray | None = None
+
+    @property
+    def requires_training(self) -> bool:
+        return bool(self.factory) and any(keyword in self.factory for keyword in FAISS_TRAINED_INDEX_KEYWORDS)
+
+    def create_table(self):
+        factory = f' factory="{self.factory}"' if self.factory else ""
+        self.connection.execute(
+            SQL_CREATE_VSS_DOCUMENTS_TABLE_TEMPLATE.format(embedding_size=self.index_size, factory=factory)
+        )
+
+    def get_vss_count(self) -> int:
+        return self.connection.execute(SQL_QUERY_VSS_DOCUMENTS_COUNT).fetchone()[0]
+
+    def initialize(self):
+        load_vss_extension(self.connection)
+        super().initialize()
+        self.create_table()
+
+    @property
+    def supports_allow_list(self) -> bool:
+        return self.vectors is not None
+
+    def load(self):
+        vectors_paths = self.get_sidecar_paths(suffixes=self.vectors_suffixes)
+        if vectors_paths and all(os.path.exists(path) for path in vectors_paths):
+            vectors_path, ids_path = vectors_paths
+            ids = np.load(ids_path)
+            vectors = np.load(vectors_path, mmap_mode="r")
+            if len(ids) == self.count() and vectors.shape[1:] == (self.index_size,):
+                self.ids, self.vectors = ids, vectors
+                self.norms = get_squared_norms(vectors)
+
+    def add(self, ids: list[int], embeddings: list[list[float]] | np.ndarray):
+        super().add(ids, embeddings)
+        self.ids, self.vectors, self.norms = None, None, None
+        # NOTE: An untrained index can not store any vector, embeddings are indexed on rebuild
+        if self.requires_training and self.get_vss_count() == 0:
+            return
+        self.connection.executemany(
+            SQL_INSERT_VSS_DOCUMENT,
+            [[id_, get_serialized_embedding(vector)] for id_, vector in zip(ids, self.reduce(embeddings))],
+        )
+
+    def search(
+        self, embedding: list[float] | np.ndarray, top_n: int, nprobe: int | None = None
+    ) -> list[tuple[int, float]]:
+        # NOTE: sqlite-vss does not expose nprobe, use the ivf backend to control it at query time
+        vss_documents_count: int = self.get_vss_count()
+
+        # NOTE: The database extension generates an exception for sqlite < 3.41.0 in case the virtual table is empty
+        # see: https://github.com/asg017/sqlite-vss/issues/129
+        if vss_documents_count == 0:
+            # NOTE: Until a trained index is built, embeddings are searched exactly
+            if self.requires_training and self.count() > 0:
+                if self.vectors is not None:
+                    return get_top_n(self.ids, self.vectors, self.norms, self.reduce(embedding), top_n)
+                ids, matrix = self.load_vectors()
+                return get_top_n(ids, matrix, get_squared_norms(matrix), self.reduce(embedding), top_n)
+            return []
+
+        return self.connection.execute(
+            SQL_QUERY_VSS_DOCUMENTS,
+            {"embedding": get_serialized_embedding(self.reduce(embedding)), "top_n_documents": top_n},
+        ).fetchall()
+
+    def search_allowed(
+        self, embedding: list[float] | np.ndarray, top_n: int, allowed_ids: list[int]
+    ) -> list[tuple[int, float]]:
+        if self.vectors is None:
+            return super().search_allowed(embedding, top_n, allowed_ids)
+        mask = np.isin(self.ids, allowed_ids)
+        return get_top_n(self.ids[mask], self.vectors[mask], self.norms[mask], self.reduce(embedding), top_n)
+
+    def remove(self, ids: list[int]):
+        """
+        Remove the stored embeddings and their vectors from the vss index, which does not need to be rebuilt
+        """
+        super().remove(ids)
+        self.connection.execute(SQL_DELETE_VSS_DOCUMENTS_BY_IDS, {"ids": json.dumps(list(ids))})
+        self.ids, self.vectors, self.norms = None, None, None
+
+    def needs_rebuild(self) -> bool:
+        return self.get_vss_count() != self.count() or super().needs_rebuild()
+
+    def rebuild(self):
+        """
+        Recreate the vss table with the configured factory, train it on a sample of the stored embeddings
+        if the factory requires it and index all stored embeddings
+        """
+        self.ids, self.vectors, self.norms = None, None, None
+        self.fit_reduction()
+        with self.connection:
+            self.connection.execute(SQL_DROP_VSS_DOCUMENTS_TABLE)
+            self.create_table()
+        # NOTE: Vectors are (reduced and) passed as JSON like in add(), as sqlite-vss only indexes them on commit:
+        # float32 blobs copied with INSERT ... SELECT were found to index wrong vectors in large tables
+        if self.requires_training:
+            sample = self.reduce(self.get_embeddings_sample(self.training_sample_size))
+            try:
+                with self.connection:
+                    self.connection.executemany(
+                        SQL_TRAIN_VSS_DOCUMENT, [[get_serialized_embedding(vector)] for vector in sample]
+                    )
+            except sqlite3.OperationalError as err:
+                # NOTE: e.g. fewer embeddings than IVF lists, the index is trained again after the next import
+                print("VSS INDEX TRAINING FAILED: ", err)
+                return
+        with self.connection:
+            cursor = self.connection.execute(SQL_QUERY_EMBEDDINGS)
+            while rows := cursor.fetchmany(ASSIGNMENT_BATCH_SIZE):
+                ids, matrix = get_ids_matrix(rows, self.embedding_size)
+                self.connection.executemany(
+                    SQL_INSERT_VSS_DOCUMENT,
+                    [[int(id_), get_serialized_embedding(vector)] for id_, vector in zip(ids, self.reduce(matrix))],
+                )
+
+    def save_for_queries(self, database: str | None = None) -> list[str]:
+        """
+        Write the (reduced) vectors of the index and their ids as npy files next to the database
+        """
+        vectors_paths = self.get_sidecar_paths(database, self.vectors_suffixes)
+        if not vectors_paths:
+            return []
+        vectors_path, ids_path = vectors_paths
+        ids, matrix = self.load_vectors()
+        np.save(vectors_path, matrix)
+        np.save(ids_path, ids)
+        return vectors_paths
+
+
+class FlatIndex(VectorIndex):
+    """
+    Exact search over a NumPy matrix of all embeddings.
+    The matrix is persisted as npy sidecar files which are memory-mapped when loaded.
+    """
+
+    name = "flat"
+    sidecar_suffixes = (".flat.npy", ".flat.ids.npy")
+    supports_allow_list = True
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        database: str,
+        embedding_size: int = EMBEDDING_SIZE,
+        reduction_components: int | None = EMBEDDING_REDUCTION_COMPONENTS,
+    ):
+        super().__init__(connection, database, embedding_size, reduction_components)
+        self.ids: np.ndarray | None = None
+        self.matrix: np.ndarray | None = None
+        self.norms: np.ndarray | None = None
+
+    def load(self):
+        count = self.count()
+        sidecar_paths = self.get_sidecar_paths()
+        ids, matrix = None, None
+        if sidecar_paths and all(os.path.exists(path) for path in sidecar_paths):
+            matrix_path, ids_path = sidecar_paths
+            matrix = np.load(matrix_path, mmap_mode="r")
+            ids = np.load(ids_path)
+        if ids is None or len(ids) != count or matrix.shape[1:] != (self.index_size,):
+            ids, matrix = self.load_vectors()
+        self.ids, self.matrix = ids, matrix
+        self.norms = get_squared_norms(matrix)
+
+    def add(self, ids: list[int], embeddings: list[list[float]] | np.ndarray):
+        super().add(ids, embeddings)
+        self.ids, self.matrix, self.norms = None, None, None
+
+    def search(
+        self, embedding: list[float] | np.ndarray, top_n: int, nprobe: int | None = None
+    ) -> list[tuple[int, float]]:
+        if self.matrix is None:
+            self.load()
+        return get_top_n(self.ids, self.matrix, self.norms, self.reduce(embedding), top_n)
+
+    def search_allowed(
+        self, embedding: list[float] | np.ndarray, top_n: int, allowed_ids: list[int]
+    ) -> list[tuple[int, float]]:
+        if self.matrix is None:
+            self.load()
+        mask = np.isin(self.ids, allowed_ids)
+        return get_top_n(self.ids[mask], self.matrix[mask], self.norms[mask], self.reduce(embedding), top_n)
+
+    def rebuild(self):
+        # NOTE: Sidecar files hold vectors projected by the previous reduction
+        self.fit_reduction()
+        self.ids, self.matrix = self.load_vectors()
+        self.norms = get_squared_norms(self.matrix)
+
+    def save(self, database: str | None = None) -> list[str]:
+        sidecar_paths = self.get_sidecar_paths(database)
+        if not sidecar_paths:
+            return []
+        matrix_path, ids_path = sidecar_paths
+        ids, matrix = self.load_vectors()
+        np.save(matrix_path, matrix)
+        np.save(ids_path, ids)
+        return sidecar_paths
+
+
+class HNSWIndex(VectorIndex):
+    """
+    Approximate search with a HNSW graph (hnswlib) persisted as a sidecar file.
+    M and ef_construction trade build time and memory for recall, ef trades query time for recall.
+    """
+
+    name = "hnsw"
+    sidecar_suffixes = (".hnsw.bin",)
+    supports_allow_list = True
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        database: str,
+        embedding_size: int = EMBEDDING_SIZE,
+        m: int = HNSW_M,
+        ef_construction: int = HNSW_EF_CONSTRUCTION,
+        ef: int = HNSW_EF,
+        reduction_components: int | None = EMBEDDING_REDUCTION_COMPONENTS,
+    ):
+        super().__init__(connection, database, embedding_size, reduction_components)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.index = None
+
+    def build(self, max_elements: int):
+        import hnswlib
+
+        ids, matrix = self.load_vectors()
+        index = hnswlib.Index(space="l2", dim=self.index_size)
+        index.init_index(max_elements=max(max_elements, len(ids), 1), M=self.m, ef_construction=self.ef_construction)
+        if len(ids):
+            index.add_items(matrix, ids)
+        return index
+
+    def load(self):
+        import hnswlib
+
+        count = self.count()
+        sidecar_paths = self.get_sidecar_paths()
+        index = None
+        if sidecar_paths and os.path.exists(sidecar_paths[0]):
+            index = hnswlib.Index(space="l2", dim=self.index_size)
+            index.load_index(sidecar_paths[0], max_elements=max(count, 1))
+            if index.get_current_count() != count:
+                index = None
+        if index is None:
+            index = self.build(count)
+        index.set_ef(self.ef)
+        self.index = index
+
+    def add(self, ids: list[int], embeddings: list[list[float]] | np.ndarray):
+        super().add(ids, embeddings)
+        if self.index is None:
+            # NOTE: Loading the index already includes the embeddings just stored
+            self.load()
+            return
+        required_elements = self.index.get_current_count() + len(ids)
+        if required_elements > self.index.get_max_elements():
+            self.index.resize_index(max(required_elements, 2 * self.index.get_max_elements()))
+        self.index.add_items(self.reduce(embeddings), ids)
+
+    def search(
+        self, embedding: list[float] | np.ndarray, top_n: int, nprobe: int | None = None
+    ) -> list[tuple[int, float]]:
+        if self.index is None:
+            self.load()
+        top_n = min(top_n, self.index.get_current_count())
+        if top_n == 0:
+            return []
+
+        self.index.set_ef(max(self.ef, top_n))
+        labels, distances = self.index.knn_query(self.reduce(embedding), k=top_n)
+        return [(int(label), float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+    def search_allowed(
+        self, embedding: list[float] | np.ndarray, top_n: int, allowed_ids: list[int]
+    ) -> list[tuple[int, float]]:
+        if self.index is None:
+            self.load()
+        allowed_ids_set = set(allowed_ids)
+        top_n = min(top_n, len(allowed_ids_set), self.index.get_current_count())
+        if top_n == 0:
+            return []
+
+        self.index.set_ef(max(self.ef, top_n))
+        try:
+            labels, distances = self.index.knn_query(
+                self.reduce(embedding), k=top_n, filter=lambda label: label in allowed_ids_set
+            )
+        except RuntimeError:
+            # NOTE: The graph search can end with fewer than top_n allowed ids for very selective filters
+            return super().search_allowed(embedding, top_n, allowed_ids)
+        return [(int(label), float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+    def save(self, database: str | None = None) -> list[str]:
+        sidecar_paths = self.get_sidecar_paths(database)
+        if not sidecar_paths:
+            return []
+        if self.index is None:
+            self.load()
+        self.index.save_index(sidecar_paths[0])
+        return sidecar_paths
+
+    def rebuild(self):
+        self.fit_reduction()
+        self.index = self.build(self.count())
+        self.index.set_ef(self.ef)
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted file index: embeddings are clustered with k-means and only the nprobe lists closest to the query
+    are searched exactly, nprobe trades query time for recall at query time.
+    Centroids, ids and list ordered vectors are persisted as npy sidecar files, vectors are memory-mapped when loaded.
+    """
+
+    name = "ivf"
+    sidecar_suffixes = (".ivf.centroids.npy", ".ivf.offsets.npy", ".ivf.ids.npy", ".ivf.vectors.npy")
+    supports_allow_list = True
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        database: str,
+        embedding_size: int = EMBEDDING_SIZE,
+        n_lists: int | None = IVF_N_LISTS,
+        nprobe: int = IVF_NPROBE,
+        training_sample_size: int = IVF_TRAINING_SAMPLE_SIZE,
+        reduction_components: int | None = EMBEDDING_REDUCTION_COMPONENTS,
+    ):
+        super().__init__(connection, database, embedding_size, reduction_components)
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.training_sample_size = training_sample_size
+        self.centroids: np.ndarray | None = None
+        self.offsets: np.ndarray | None = None
+        self.ids: np.ndarray | None = None
+        self.vectors: np.ndarray | None = None
+        self.norms: np.ndarray | None = None
+        self.is_stale = True
+
+    def get_n_lists(self, count: int) -> int:
+        n_lists = self.n_lists or int(4 * np.sqrt(count))
+        return int(np.clip(n_lists, 1, max(count, 1)))
+
+    def train(self) -> np.ndarray:
+        count = self.count()
+        sample = self.reduce(self.get_embeddings_sample(self.training_sample_size))
+        if len(sample) == 0:
+            return np.zeros((0, self.index_size), dtype=np.float32)
+        return train_kmeans(sample, min(self.get_n_lists(count), len(sample)))
+
+    def build(self, centroids: np.ndarray):
+        """
+        Assign all stored embeddings to the inverted list of their closest centroid
+        """
+        ids, matrix = self.load_vectors()
+        if len(centroids) == 0:
+            assignments = np.zeros(len(ids), dtype=np.int64)
+        else:
+            assignments = get_closest_centroids(matrix, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=max(len(centroids), 1))
+        self.centroids = centroids
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.ids = ids[order]
+        self.vectors = matrix[order]
+        self.norms = get_squared_norms(self.vectors)
+        self.is_stale = False
+
+    def load(self):
+        count = self.count()
+        sidecar_paths = self.get_sidecar_paths()
+        if sidecar_paths and all(os.path.exists(path) for path in sidecar_paths):
+            centroids_path, offsets_path, ids_path, vectors_path = sidecar_paths
+            centroids = np.load(centroids_path)
+            ids = np.load(ids_path)
+            if len(ids) == count and centroids.shape[1:] == (self.index_size,):
+                self.centroids = centroids
+                self.offsets = np.load(offsets_path)
+                self.ids = ids
+                self.vectors = np.load(vectors_path, mmap_mode="r")
+                self.norms = get_squared_norms(self.vectors)
+                self.is_stale = False
+                return
+            # NOTE: New embeddings are assigned to the lists of the already trained centroids
+            if len(centroids) > 0 and centroids.shape[1:] == (self.index_size,):
+                self.build(centroids)
+                return
+        self.build(self.train())
+
+    def add(self, ids: list[int], embeddings: list[list[float]] | np.ndarray):
+        super().add(ids, embeddings)
+        self.is_stale = True
+
+    def refresh(self):
+        """
+        Load the index or assign embeddings added since it was built to the existing lists
+        """
+        if not self.is_stale:
+            return
+        if self.centroids is not None and len(self.centroids) > 0:
+            self.build(self.centroids)
+        else:
+            self.load()
+
+    def search(
+        self, embedding: list[float] | np.ndarray, top_n: int, nprobe: int | None = None
+    ) -> list[tuple[int, float]]:
+        self.refresh()
+        if len(self.ids) == 0:
+            return []
+
+        query = self.reduce(embedding)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids) or 1)
+        centroids_distances = get_squared_norms(self.centroids) - 2 * (self.centroids @ query)
+        probed_lists = np.argpartition(centroids_distances, nprobe - 1)[:nprobe] if len(self.centroids) else [0]
+        candidates = np.concatenate(
+            [np.arange(self.offsets[list_idx], self.offsets[list_idx + 1]) for list_idx in probed_lists]
+        )
+        return get_top_n(self.ids[candidates], self.vectors[candidates], self.norms[candidates], query, top_n)
+
+    def search_allowed(
+        self, embedding: list[float] | np.ndarray, top_n: int, allowed_ids: list[int]
+    ) -> list[tuple[int, float]]:
+        # NOTE: Allowed embeddings are searched exactly, probing lists could miss most of them
+        self.refresh()
+        mask = np.isin(self.ids, allowed_ids)
+        return get_top_n(self.ids[mask], self.vectors[mask], self.norms[mask], self.reduce(embedding), top_n)
+
+    def needs_rebuild(self) -> bool:
+        return self.centroids is None or len(self.centroids) == 0 or super().needs_rebuild()
+
+    def rebuild(self):
+        self.fit_reduction()
+        self.build(self.train())
+
+    def save(self, database: str | None = None) -> list[str]:
+        sidecar_paths = self.get_sidecar_paths(database)
+        if not sidecar_paths:
+            return []
+        self.refresh()
+        # NOTE: The vectors may be memory-mapped out of the file they are saved to, which is replaced instead
+        for path, array in zip(sidecar_paths, (self.centroids, self.offsets, self.ids, self.vectors)):
+            with open(f"{path}.tmp", "wb") as file:
+                np.save(file, array)
+            os.replace(f"{path}.tmp", path)
+        return sidecar_paths
+
+
+VECTOR_INDEXES: dict[str, type[VectorIndex]] = {
+    VSSIndex.name: VSSIndex,
+    FlatIndex.name: FlatIndex,
+    HNSWIndex.name: HNSWIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def get_vector_index_class(backend: str = VECTOR_INDEX_BACKEND) -> type[VectorIndex]:
+    if backend not in VECTOR_INDEXES:
+        raise ValueError(f"Unknown vector index backend {backend}, expected one of {sorted(VECTOR_INDEXES)}")
+    return VECTOR_INDEXES[backend]
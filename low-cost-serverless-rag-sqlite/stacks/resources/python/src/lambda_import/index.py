@@ -4,74 +4,310 @@ import os
 import sys
 import io
 import json
+import math
 import pathlib
+import shutil
+import time
 import urllib
 
-import boto3
-
-s3_client = boto3.client("s3")
-
 
 SQLITE_DB_S3_BUCKET = os.getenv("SQLITE_DB_S3_BUCKET")
 SQLITE_DB_S3_KEY = os.getenv("SQLITE_DB_S3_KEY")
+# NOTE: Prefix of the read-optimized artifact published for the query lambdas
+SQLITE_QUERY_ARTIFACT_S3_PREFIX = os.getenv("SQLITE_QUERY_ARTIFACT_S3_PREFIX", "query-artifact")
+# NOTE: The import queue, documents not imported before the timeout are re-enqueued there
+SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
+MESSAGE_GROUP_ID = "SINGLETON"
+
+# NOTE: Sending a message with this action to the queue rebuilds (and retrains) the vector index,
+# e.g. once after a bulk import so that IVF centroids reflect the whole corpus
+REBUILD_VECTOR_INDEX_ACTION = "rebuild_vector_index"
+# NOTE: Sending a message with this action (scheduled) removes the rows of deleted documents and rebuilds the index
+COMPACT_DOCUMENTS_ACTION = "compact_documents"
+
+# NOTE: e.g. "ObjectRemoved:Delete" or "ObjectRemoved:DeleteMarkerCreated" of versioned buckets
+OBJECT_REMOVED_EVENT_PREFIX = "ObjectRemoved:"
 
 src_dir_path = str(pathlib.Path(__file__).parent.parent)
 sys.path.append(src_dir_path)
 
+from common.clients import get_client
+from common.config import (
+    IMPORT_SLICE_CHUNKS,
+    IMPORT_TAIL_SAFETY_FACTOR,
+    IMPORT_TIME_RESERVE_SECONDS,
+    SQLITE_IMPORT_PRAGMAS,
+    SQLITE_SNAPSHOT_METHOD,
+    SQLITE_SNAPSHOT_SUFFIX,
+)
+from common.instrumentation import instrumented_handler, span, timed
+
+s3_client = get_client("s3")
+sqs_client = get_client("sqs")
+
 from common.helpers import (
-    compute_documents_information,
+    compute_chunks_documents_information,
+    get_configured_text_chunks,
     get_file_text,
+    get_import_timestamp,
     get_s3_file_locally,
+    get_s3_object_tags,
+    get_s3_sidecar_files_locally,
     upload_file,
+    upload_sidecar_files,
 )
 from common.db import (
+    compact_db,
+    delete_document,
+    get_import_checkpoint,
     save_documents_to_db,
     initialize_db,
+    snapshot_db,
 )
+from common.artifact import build_query_artifact, optimize_db_if_changed, publish_query_artifact
+from common.vector_index import get_vector_index_class
+
+# NOTE: "vacuum" uploads a compacted snapshot of the database, "backup" is faster on large databases
+SQLITE_SNAPSHOT_METHOD = os.getenv("SQLITE_SNAPSHOT_METHOD", SQLITE_SNAPSHOT_METHOD)
+IMPORT_SLICE_CHUNKS = int(os.getenv("IMPORT_SLICE_CHUNKS", IMPORT_SLICE_CHUNKS))
+IMPORT_TIME_RESERVE_SECONDS = float(os.getenv("IMPORT_TIME_RESERVE_SECONDS", IMPORT_TIME_RESERVE_SECONDS))
+IMPORT_TAIL_SAFETY_FACTOR = float(os.getenv("IMPORT_TAIL_SAFETY_FACTOR", IMPORT_TAIL_SAFETY_FACTOR))
+
+# NOTE: Duration of the last snapshot, uploads and query artifact, stored next to the database once measured
+# (the uploaded snapshot can only hold the duration of a previous invocation), so that containers started later
+# reserve it as well
+IMPORT_TAIL_S3_KEY = f"{SQLITE_DB_S3_KEY}.import-tail.json"
+
+
+def get_stored_import_tail_seconds() -> float:
+    try:
+        response = s3_client.get_object(Bucket=SQLITE_DB_S3_BUCKET, Key=IMPORT_TAIL_S3_KEY)
+    except s3_client.exceptions.NoSuchKey:
+        return 0.0
+    return float(json.loads(response["Body"].read())["tail_seconds"])
+
+
+def store_import_tail_seconds(tail_seconds: float):
+    global IMPORT_TAIL_SECONDS
+
+    IMPORT_TAIL_SECONDS = tail_seconds
+    s3_client.put_object(
+        Bucket=SQLITE_DB_S3_BUCKET,
+        Key=IMPORT_TAIL_S3_KEY,
+        Body=json.dumps({"tail_seconds": round(tail_seconds, 3)}).encode(),
+        ContentType="application/json",
+    )
+
 
 # NOTE: There is no need to re-download the sqlite db file, as the file can not be concurrently updated with the setup
 # so that the local within a lambda instance is the most up-to-date-one
 # This is why we can use the same local file for all lambda instances
+with span("s3_download"):
+    LOCAL_DB_URI = get_s3_file_locally(SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY)
+    IMPORT_TAIL_SECONDS = get_stored_import_tail_seconds()
+    get_s3_sidecar_files_locally(
+        SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY, get_vector_index_class().sidecar_suffixes, LOCAL_DB_URI
+    )
+with span("db_init"):
+    # NOTE: The database is written in WAL mode with relaxed syncs, only consistent snapshots of it are uploaded
+    DB_CONNECTION = initialize_db(LOCAL_DB_URI, pragmas=SQLITE_IMPORT_PRAGMAS)
 
-LOCAL_DB_URI = get_s3_file_locally(SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY)
-DB_CONNECTION = initialize_db(LOCAL_DB_URI)
+# NOTE: The query artifact is built next to the database before being uploaded
+QUERY_ARTIFACT_DIRECTORY = f"{LOCAL_DB_URI}.query-artifact"
 
 
-def process_single_s3_record(s3_record: dict):
+def get_remaining_seconds(context: object) -> float:
+    """
+    Return the remaining time of the invocation, infinite when not invoked by lambda (e.g. benchmarks)
+    """
+    if context is None:
+        return math.inf
+    return context.get_remaining_time_in_millis() / 1000
+
+
+def get_import_time_reserve() -> float:
+    """
+    Return the time to keep for the end of the invocation (snapshot, uploads and query artifact)
+    """
+    return max(IMPORT_TIME_RESERVE_SECONDS, IMPORT_TAIL_SAFETY_FACTOR * IMPORT_TAIL_SECONDS)
+
+
+class ImportDeadline:
+    """
+    Time budget of the slices imported within an invocation: a slice only starts if the time left covers the reserve
+    and a slice as long as the last one. The very first slice of the invocation always starts, so that imports progress.
+    """
+
+    def __init__(self, context: object = None, reserve_seconds: float = IMPORT_TIME_RESERVE_SECONDS):
+        self.context = context
+        self.reserve_seconds = reserve_seconds
+        self.slices_count = 0
+        self.last_slice_seconds = 0.0
+
+    def allows_slice(self) -> bool:
+        if self.slices_count == 0:
+            return True
+        return get_remaining_seconds(self.context) >= self.reserve_seconds + self.last_slice_seconds
+
+    def add_slice(self, seconds: float):
+        self.slices_count += 1
+        self.last_slice_seconds = seconds
+
+
+def process_single_s3_record(s3_record: dict, deadline: ImportDeadline | None = None) -> bool:
+    """
+    Import the document in slices of IMPORT_SLICE_CHUNKS chunks, each saved with the import checkpoint of the document,
+    so that an import resumes after the last saved slice. Return False if the import stopped before the deadline
+    of the invocation, True once the document is imported.
+    Removed objects are recorded as deleted documents.
+    """
+    if deadline is None:
+        deadline = ImportDeadline()
     bucket_input = s3_record["s3"]["bucket"]["name"]
     object_key_input = urllib.parse.unquote_plus(s3_record["s3"]["object"]["key"])
     filetype = object_key_input.split(".")[-1]
 
     object_s3_uri = f"s3://{bucket_input}/{object_key_input}"
-    object_content = s3_client.get_object(Bucket=bucket_input, Key=object_key_input)["Body"].read()
-    file_text = get_file_text(document_blob=object_content, filetype=filetype)
+    if s3_record.get("eventName", "").startswith(OBJECT_REMOVED_EVENT_PREFIX):
+        timed(delete_document, "db_delete")(DB_CONNECTION, object_s3_uri)
+        print("DELETED: ", object_s3_uri)
+        return True
+    # NOTE: Checked before downloading and parsing as well, which can take long for large documents
+    if not deadline.allows_slice():
+        print("IMPORT DEADLINE: ", object_s3_uri)
+        return False
+
+    with span("s3_download"):
+        try:
+            s3_object = s3_client.get_object(Bucket=bucket_input, Key=object_key_input)
+        except s3_client.exceptions.NoSuchKey:
+            # NOTE: Removed before being imported, its removal event deletes what was imported of it
+            print("OBJECT NOT FOUND: ", object_s3_uri)
+            return True
+        object_content = s3_object["Body"].read()
+    etag = s3_object.get("ETag")
+
+    # NOTE: A checkpoint of another version of the object (e.g. overwritten while being imported) is restarted,
+    # the chunks of the previous version are deleted
+    checkpoint = get_import_checkpoint(DB_CONNECTION, object_s3_uri)
+    if checkpoint is None or checkpoint["etag"] != etag:
+        delete_document(DB_CONNECTION, object_s3_uri)
+        checkpoint = {"document_id": object_s3_uri, "etag": etag, "timestamp": get_import_timestamp(), "next_chunk": 0}
+    elif checkpoint["next_chunk"] >= checkpoint["n_chunks"]:
+        print("ALREADY IMPORTED: ", object_s3_uri)
+        return True
+
+    file_text = timed(get_file_text, "parse")(document_blob=object_content, filetype=filetype)
+    chunks = get_configured_text_chunks(file_text)
+    checkpoint["n_chunks"] = len(chunks)
+    tags = get_s3_object_tags(s3_object)
 
-    documents = compute_documents_information(file_text, object_s3_uri)
-    save_documents_to_db(documents, connection=DB_CONNECTION)
+    while True:
+        start = checkpoint["next_chunk"]
+        if not deadline.allows_slice():
+            print("IMPORT CHECKPOINT: ", json.dumps(checkpoint))
+            return False
+        slice_start_time = time.perf_counter()
+        slice_chunks = chunks[start : start + IMPORT_SLICE_CHUNKS]
+        documents = compute_chunks_documents_information(slice_chunks, object_s3_uri, checkpoint["timestamp"], tags)
+        checkpoint["next_chunk"] = start + len(slice_chunks)
+        timed(save_documents_to_db, "db_save")(documents, connection=DB_CONNECTION, checkpoint=checkpoint)
+        deadline.add_slice(time.perf_counter() - slice_start_time)
+        if checkpoint["next_chunk"] >= checkpoint["n_chunks"]:
+            return True
 
 
-def lambda_handler(event: dict[str, object], context: dict[str, object]):
+def send_continuation(body: dict, deduplication_id: str):
+    """
+    Re-enqueue the work left when the invocation stopped, it is processed by the next invocation
+    """
+    sqs_client.send_message(
+        QueueUrl=SQS_QUEUE_URL,
+        MessageBody=json.dumps(body),
+        MessageDeduplicationId=deduplication_id,
+        MessageGroupId=MESSAGE_GROUP_ID,
+    )
+
+
+@instrumented_handler
+def lambda_handler(event: dict[str, object], context: object):
     sqs_batch_response: dict = {"batch_item_failures": []}
 
     silenced_errors = []
     if event:
         records = event["Records"]
         batch_item_failures = []
+        rebuild_vector_index = False
+        compact_documents = False
+        deadline = ImportDeadline(context, get_import_time_reserve())
+        # NOTE: Once an import stopped before the timeout, the S3 records left (starting with the stopped one)
+        # are re-enqueued as a single message, the stopped document resumes from its checkpoint
+        continuation_s3_records: list[dict] = []
 
         for record in records:
             record_body_reconstructed: dict[str, str | list | dict] = json.loads(record["body"])
+            if record_body_reconstructed.get("action") == REBUILD_VECTOR_INDEX_ACTION:
+                rebuild_vector_index = True
+                continue
+            if record_body_reconstructed.get("action") == COMPACT_DOCUMENTS_ACTION:
+                compact_documents = True
+                continue
             try:
                 sqs_records: list[dict] = record_body_reconstructed["Records"]
                 for sqs_record in sqs_records:
                     s3_records: list[dict] = json.loads(sqs_record["body"])["Records"]
                     for s3_record in s3_records:
-                        process_single_s3_record(s3_record)
+                        if continuation_s3_records or not process_single_s3_record(s3_record, deadline):
+                            continuation_s3_records.append(s3_record)
             except Exception as e:
                 batch_item_failures.append({"itemIdentifier": record["messageId"]})
                 silenced_errors.append(str(e))
 
         sqs_batch_response["batchItemFailures"] = batch_item_failures
-        upload_file(SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY)
+        # NOTE: Rebuilding the index is deferred to the continuation, which imports the rest of the documents
+        rebuild_vector_index_deferred = rebuild_vector_index and bool(continuation_s3_records)
+        rebuild_vector_index = rebuild_vector_index and not rebuild_vector_index_deferred
+        if compact_documents:
+            compacted_count = timed(compact_db, "db_compact")(DB_CONNECTION)
+            print("COMPACTED DOCUMENTS: ", compacted_count)
+            # NOTE: Indexes other than vss still hold the embeddings of the removed rows, vss is retrained
+            rebuild_vector_index = rebuild_vector_index or compacted_count > 0
+        # NOTE: Trained indexes can only index embeddings once enough of them are stored to be trained on
+        if rebuild_vector_index or DB_CONNECTION.vector_index.needs_rebuild():
+            timed(DB_CONNECTION.vector_index.rebuild, "vector_index_rebuild")()
+        tail_start_time = time.perf_counter()
+        # NOTE: Optimized within the import database, as a copy can not be opened without the vector index extension,
+        # so that both the uploaded snapshot and the query artifact built out of it are optimized
+        if timed(optimize_db_if_changed, "db_optimize")(DB_CONNECTION):
+            print("DB OPTIMIZED")
+        with span("db_snapshot"):
+            snapshot_path = snapshot_db(
+                DB_CONNECTION, f"{LOCAL_DB_URI}{SQLITE_SNAPSHOT_SUFFIX}", method=SQLITE_SNAPSHOT_METHOD
+            )
+        with span("upload"):
+            upload_file(SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY, snapshot_path)
+            sidecar_paths = DB_CONNECTION.vector_index.save()
+            upload_sidecar_files(SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY, sidecar_paths, LOCAL_DB_URI)
+        with span("query_artifact"):
+            query_artifact_manifest = build_query_artifact(
+                DB_CONNECTION, QUERY_ARTIFACT_DIRECTORY, snapshot_path, sidecar_paths
+            )
+            publish_query_artifact(
+                SQLITE_DB_S3_BUCKET, SQLITE_QUERY_ARTIFACT_S3_PREFIX, QUERY_ARTIFACT_DIRECTORY, query_artifact_manifest
+            )
+            shutil.rmtree(QUERY_ARTIFACT_DIRECTORY, ignore_errors=True)
+            print("QUERY ARTIFACT: ", json.dumps(query_artifact_manifest))
+        store_import_tail_seconds(time.perf_counter() - tail_start_time)
+
+        # NOTE: Sent once the imported slices are uploaded, so that the continuation starts from them
+        if continuation_s3_records:
+            send_continuation(
+                {"Records": [{"body": json.dumps({"Records": continuation_s3_records})}]},
+                f"{context.aws_request_id}-continuation",
+            )
+            print("CONTINUATION: ", len(continuation_s3_records))
+        if rebuild_vector_index_deferred:
+            send_continuation({"action": REBUILD_VECTOR_INDEX_ACTION}, f"{context.aws_request_id}-rebuild")
 
     if silenced_errors:
         print("SILENCED ERRORS: ", silenced_errors)
@@ -1,23 +1,45 @@
 import os
-import boto3
 import sys
-import time
 import re
+import functools
 import pathlib
+import sqlite3
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 
 src_dir_path = str(pathlib.Path(__file__).parent.parent)
 sys.path.append(src_dir_path)
 
-from common.config import MAX_TOKEN_OUTPUT, AWS_REGION_BEDROCK
+from common.artifact import download_query_artifact, get_query_artifact_manifest
+from common.cache import AnswerCache
+from common.clients import get_client
+from common.instrumentation import instrumented_handler, span, timed
+from common.config import (
+    CONTEXT_MAX_TOKENS,
+    IVF_NPROBE,
+    MAX_TOKEN_OUTPUT,
+    RERANK_CANDIDATES_FACTOR,
+    RERANK_METHOD,
+    RERANK_TOP_N_DOCUMENTS,
+    SQLITE_QUERY_PRAGMAS,
+)
+from common.context import assemble_context
 from common.db import (
+    SEARCH_MODE_FTS,
+    SEARCH_MODE_HYBRID,
+    SEARCH_MODE_VECTOR,
+    fuse_ranked_documents,
     initialize_db,
     query_db_documents,
+    query_db_documents_fts,
 )
+from common.rerank import RERANK_METHOD_MMR, get_rerank_method, rerank_chunks
 from common.helpers import (
     get_cleaned_text,
     get_embedding,
-    get_s3_file_locally,
+    is_keyword_query,
     get_llm_query_response_text,
+    get_llm_query_response_text_stream,
 )
 
 
@@ -27,37 +49,67 @@ TOP_N_DOCUMENTS = int(os.environ.get("TOP_N_DOCUMENTS", "6"))
 # NOTE: possible distances ranges from 0 to ~2X embedding-size
 MAX_DISTANCE_THRESHOLD = int(os.environ.get("MAX_DISTANCE_THRESHOLD", "350"))
 
+# NOTE: Number of inverted lists searched by the ivf vector index, higher is slower with a better recall
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", IVF_NPROBE))
+
+# NOTE: One of "vector", "fts" or "hybrid" (vector and full text search merged with reciprocal rank fusion),
+# "fts" only returns the documents found by the full text search (no embedding is computed)
+SEARCH_MODE = os.environ.get("SEARCH_MODE", SEARCH_MODE_HYBRID)
+
+# NOTE: In "hybrid" mode, queries made of identifiers only (e.g. product codes, error numbers) only use the full text
+# search if it finds anything, otherwise they fall back to the hybrid search
+KEYWORD_QUERY_FTS_ONLY = os.environ.get("KEYWORD_QUERY_FTS_ONLY", "true").lower() == "true"
+
+# NOTE: How many tokens of documents text are sent to the LLM at most
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", CONTEXT_MAX_TOKENS))
+
+# NOTE: One of "none", "mmr" (diversity out of the stored embeddings) or "cross_encoder" (local ONNX model):
+# RERANK_CANDIDATES_FACTOR times TOP_N_DOCUMENTS are retrieved and only the best RERANK_TOP_N_DOCUMENTS are sent
+RERANK_METHOD = get_rerank_method(os.environ.get("RERANK_METHOD", RERANK_METHOD))
+RERANK_CANDIDATES_FACTOR = int(os.environ.get("RERANK_CANDIDATES_FACTOR", RERANK_CANDIDATES_FACTOR))
+RERANK_TOP_N_DOCUMENTS = int(os.environ.get("RERANK_TOP_N_DOCUMENTS", RERANK_TOP_N_DOCUMENTS))
+RETRIEVED_N_DOCUMENTS = TOP_N_DOCUMENTS * RERANK_CANDIDATES_FACTOR if RERANK_METHOD else TOP_N_DOCUMENTS
+
 SQLITE_DB_S3_BUCKET = os.getenv("SQLITE_DB_S3_BUCKET")
-SQLITE_DB_S3_KEY = os.getenv("SQLITE_DB_S3_KEY")
+# NOTE: The query lambda only loads the read-optimized artifact published by the import lambda under this prefix
+SQLITE_QUERY_ARTIFACT_S3_PREFIX = os.getenv("SQLITE_QUERY_ARTIFACT_S3_PREFIX", "query-artifact")
+LOCAL_QUERY_ARTIFACT_DIRECTORY = "/tmp/query-artifact"
 
+# NOTE: Answers are persisted to S3 when a bucket is configured, otherwise they are only cached in memory
+ANSWER_CACHE_S3_BUCKET = os.getenv("ANSWER_CACHE_S3_BUCKET")
+ANSWER_CACHE_S3_PREFIX = os.getenv("ANSWER_CACHE_S3_PREFIX", "tmp/answer-cache")
 
-def log_time(function):
-    def logging_time_function(*args, **kwargs):
-        start = time.time()
-        result = function(*args, **kwargs)
-        end = time.time()
-        time_ms = int((end - start) * 1000)
-        print("*" * 40, "START", f"<{function.__name__}>", "*" * 40)
-        print(f"Timed {time_ms} ms for function <{function.__name__}>")
-        print("*" * 40, " END ", "*" * 40)
-        return result
+# NOTE: Threads used to download / load the database and compute embeddings concurrently
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))
 
-    return logging_time_function
 
+def load_db() -> sqlite3.Connection:
+    manifest = DB_MANIFEST_FUTURE.result()
+    with span("s3_download"):
+        local_db_uri = download_query_artifact(
+            SQLITE_DB_S3_BUCKET, SQLITE_QUERY_ARTIFACT_S3_PREFIX, manifest, LOCAL_QUERY_ARTIFACT_DIRECTORY
+        )
+    # NOTE: The connection is created within a worker thread but used by the handler
+    with span("db_init"):
+        connection = initialize_db(local_db_uri, check_same_thread=False, pragmas=SQLITE_QUERY_PRAGMAS)
+        connection.vector_index.load()
+    return connection
 
-LOCAL_DB_URI = log_time(get_s3_file_locally)(SQLITE_DB_S3_BUCKET, SQLITE_DB_S3_KEY)
-DB_CONNECTION = log_time(initialize_db)(LOCAL_DB_URI)
 
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
-SupportsWrite = object
+# NOTE: The manifest of the query artifact tells which version to download and scopes cached answers
+DB_MANIFEST_FUTURE = EXECUTOR.submit(get_query_artifact_manifest, SQLITE_DB_S3_BUCKET, SQLITE_QUERY_ARTIFACT_S3_PREFIX)
 
-s3_client = boto3.client("s3")
+# NOTE: The database is downloaded and loaded in the background, so that the query embedding
+# can be computed meanwhile on cold start
+DB_CONNECTION_FUTURE = EXECUTOR.submit(load_db)
 
 
-# Create the connection to Bedrock
-bedrock = boto3.client(service_name="bedrock", region_name=AWS_REGION_BEDROCK)
+SupportsWrite = object
 
-bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION_BEDROCK)
+s3_client = get_client("s3")
+bedrock_runtime = get_client("bedrock-runtime")
 
 
 LLM_RAG_QUERY_TEMPLATE = """
@@ -78,30 +130,136 @@ def build_llm_query(documents_text: str, query: str):
     return LLM_RAG_QUERY_TEMPLATE.format(documents=documents_text, query=query)
 
 
-def get_text_from_documents(documents: list[dict]):
+def get_text_from_documents(documents: list[dict], max_tokens: int = CONTEXT_MAX_TOKENS):
     """
-    Extract, preprocess and combine text from chunks
+    Extract, preprocess and combine text from chunks:
+    overlapping chunks of the same document are merged and the text is packed by relevance within max_tokens
     """
-
-    # NOTE: for a real use case we would use a proper strategy to clean and put the text together
-    # e.g. by avoiding overlaps, making sure the final text would fit within the LLM context etc.
-    documents_text = "\n".join(document["text"] for document in documents)
+    documents_text = assemble_context(documents, max_tokens=max_tokens)
 
     return get_cleaned_text(documents_text)
 
 
-def lambda_handler(event: dict[str, object], context: dict[str, object]):
-    query = event["query"]
+def get_db_connection() -> sqlite3.Connection:
+    """
+    Return the database connection, waiting for the database to be loaded if needed
+    """
+    return DB_CONNECTION_FUTURE.result()
 
-    embedding = log_time(get_embedding)(query)
 
-    matching_documents = log_time(query_db_documents)(
-        embedding=embedding,
-        connection=DB_CONNECTION,
-        top_n_documents=TOP_N_DOCUMENTS,
-        distance_threshold=MAX_DISTANCE_THRESHOLD,
+@functools.cache
+def get_answer_cache() -> AnswerCache:
+    """
+    Return the answer cache scoped to the version of the database loaded by this container
+    """
+    return AnswerCache(
+        version=(DB_MANIFEST_FUTURE.result() or {}).get("version", "empty"),
+        s3_client=s3_client,
+        s3_bucket=ANSWER_CACHE_S3_BUCKET,
+        s3_prefix=ANSWER_CACHE_S3_PREFIX,
+    )
+
+
+def submit_query_embeddings(queries: list[str]) -> list[Future]:
+    """
+    Compute the embeddings of all queries concurrently (and while the database is being loaded)
+    """
+    return [EXECUTOR.submit(get_embedding, query) for query in queries]
+
+
+def submit_query_embeddings_while_loading(queries: list[str]) -> list[Future] | None:
+    """
+    Submit the embeddings of the queries if the database is still being loaded (cold start), so that they are
+    computed meanwhile instead of after the full text search, which waits for the database. Return None otherwise,
+    the embeddings are then only computed if the full text search is not enough.
+    """
+    if SEARCH_MODE == SEARCH_MODE_FTS or DB_CONNECTION_FUTURE.done():
+        return None
+    return submit_query_embeddings(queries)
+
+
+def get_keyword_matching_documents(query: str, filters: dict | None = None) -> list[dict]:
+    """
+    Return the documents matching the words of the query in case a full text search is enough for this query,
+    so that no embedding needs to be computed. Return an empty list otherwise.
+    """
+    if SEARCH_MODE == SEARCH_MODE_VECTOR:
+        return []
+    if SEARCH_MODE != SEARCH_MODE_FTS and not (KEYWORD_QUERY_FTS_ONLY and is_keyword_query(query)):
+        return []
+    documents = timed(query_db_documents_fts, "fts_search")(
+        query, connection=get_db_connection(), top_n_documents=RETRIEVED_N_DOCUMENTS, filters=filters
     )
+    if not documents and SEARCH_MODE == SEARCH_MODE_HYBRID:
+        print("FTS FALLBACK: ", query)
+    return documents
 
+
+def needs_vector_search(matching_documents: list[dict]) -> bool:
+    """
+    Return True if the documents found by the keyword search are not enough, the "fts" search mode never searches
+    the vector index
+    """
+    return not matching_documents and SEARCH_MODE != SEARCH_MODE_FTS
+
+
+def get_matching_documents(query: str, embedding_futures: list[Future], filters: dict | None = None) -> list[dict]:
+    """
+    Return the documents matching any of the query embeddings (and the query words in hybrid search mode)
+    merged with reciprocal rank fusion, restricted to the documents matching the metadata filters
+    """
+    connection = timed(get_db_connection, "db_wait")()
+
+    documents_lists = [
+        timed(query_db_documents, "vector_search")(
+            embedding=embedding_future.result(),
+            connection=connection,
+            top_n_documents=RETRIEVED_N_DOCUMENTS,
+            distance_threshold=MAX_DISTANCE_THRESHOLD,
+            nprobe=IVF_NPROBE,
+            filters=filters,
+        )
+        for embedding_future in embedding_futures
+    ]
+    if SEARCH_MODE == SEARCH_MODE_HYBRID:
+        documents_lists.append(
+            timed(query_db_documents_fts, "fts_search")(
+                query, connection=connection, top_n_documents=RETRIEVED_N_DOCUMENTS, filters=filters
+            )
+        )
+    return fuse_ranked_documents(documents_lists, top_n_documents=RETRIEVED_N_DOCUMENTS)
+
+
+def rerank_documents(
+    query: str, documents: list[dict], query_embedding: list[float] | None = None, method: str | None = RERANK_METHOD
+) -> list[dict]:
+    """
+    Re-rank the retrieved documents and keep the RERANK_TOP_N_DOCUMENTS best ones, documents are kept as is
+    without re-ranking method. MMR uses the stored embeddings of the documents.
+    """
+    if method is None:
+        return documents
+    with span("rerank"):
+        embeddings = None
+        if method == RERANK_METHOD_MMR:
+            embeddings = get_db_connection().vector_index.get_embeddings([document["id"] for document in documents])
+        return rerank_chunks(
+            query,
+            documents,
+            RERANK_TOP_N_DOCUMENTS,
+            method,
+            query_vector=query_embedding,
+            chunk_vectors=embeddings,
+        )
+
+
+def build_llm_request_body(
+    query: str, matching_documents: list[dict], query_embedding: list[float] | None = None
+) -> dict:
+    """
+    Build the request body for the LLM out of the query and the (re-ranked) documents matching it
+    """
+    matching_documents = rerank_documents(query, matching_documents, query_embedding)
     documents_text = get_text_from_documents(matching_documents)
 
     if not documents_text:
@@ -113,7 +271,98 @@ def lambda_handler(event: dict[str, object], context: dict[str, object]):
     )
 
     llm_request_body = {"inputText": llm_query, "textGenerationConfig": {"maxTokenCount": MAX_TOKEN_OUTPUT}}
-    answer_text = log_time(get_llm_query_response_text)(llm_request_body)
+    return llm_request_body
+
+
+def get_request_answer_cache(filters: dict | None = None) -> AnswerCache | None:
+    """
+    Return the answer cache, None for filtered queries as answers are cached by query and rephrased queries only
+    """
+    return get_answer_cache() if not filters else None
+
+
+def get_llm_request(
+    query: str,
+    rephrased_queries: list[str] | None = None,
+    filters: dict | None = None,
+    answer_cache: AnswerCache | None = None,
+) -> dict:
+    """
+    Retrieve the documents matching the query (and its optional rephrasings) and build the request body for the LLM.
+    Return {"answer": ...} if the answer cache holds an answer of the same or of a similar query,
+    {"body": ..., "embedding": ...} otherwise (the embedding is None if no vector search was needed).
+    """
+    if answer_cache is not None:
+        answer_text = timed(answer_cache.get, "answer_cache")(query, rephrased_queries)
+        if answer_text is not None:
+            return {"answer": answer_text}
+
+    # NOTE: Identifier queries (and all queries in "fts" mode) are answered out of a full text search,
+    # without any embedding
+    query_embedding = None
+    queries = [query, *(rephrased_queries or [])]
+    embedding_futures = submit_query_embeddings_while_loading(queries)
+    matching_documents = get_keyword_matching_documents(query, filters)
+    if needs_vector_search(matching_documents):
+        embedding_futures = embedding_futures or submit_query_embeddings(queries)
+        query_embedding = embedding_futures[0].result()
+        if answer_cache is not None:
+            answer_text = answer_cache.get_similar(query_embedding, rephrased_queries)
+            if answer_text is not None:
+                return {"answer": answer_text}
+        matching_documents = get_matching_documents(query, embedding_futures, filters)
+
+    return {"body": build_llm_request_body(query, matching_documents, query_embedding), "embedding": query_embedding}
+
+
+def get_llm_request_body(
+    query: str, rephrased_queries: list[str] | None = None, filters: dict | None = None
+) -> dict:
+    """
+    Retrieve the documents matching the query (and its optional rephrasings) and build the request body for the LLM
+    """
+    return get_llm_request(query, rephrased_queries, filters)["body"]
+
+
+def stream_answer(
+    query: str, rephrased_queries: list[str] | None = None, filters: dict | None = None, client=bedrock_runtime
+) -> Iterator[str]:
+    """
+    Answer the query and yield the answer text as soon as it is generated by the LLM, a cached answer is yielded
+    at once. The answer is cached once the whole stream is consumed.
+
+    NOTE: Lambda response streaming is not available for the python runtime, so that this generator is meant
+    to be used locally or behind a streaming capable integration.
+    """
+    answer_cache = get_request_answer_cache(filters)
+    llm_request = get_llm_request(query, rephrased_queries, filters, answer_cache)
+    if "answer" in llm_request:
+        yield llm_request["answer"]
+        return
+
+    text_pieces = []
+    for text in get_llm_query_response_text_stream(llm_request["body"], client=client):
+        text_pieces.append(text)
+        yield text
+    if answer_cache is not None:
+        answer_cache.put(query, "".join(text_pieces), llm_request["embedding"], rephrased_queries)
+
+
+@instrumented_handler
+def lambda_handler(event: dict[str, object], context: dict[str, object]):
+    query = event["query"]
+    rephrased_queries = event.get("rephrased_queries")
+    # NOTE: e.g. {"document_id_prefix": "s3://bucket/faq/", "timestamp_from": "2024-01-01", "tags": ["public"]}
+    filters = event.get("filters")
+
+    answer_cache = get_request_answer_cache(filters)
+    llm_request = get_llm_request(query, rephrased_queries, filters, answer_cache)
+    if "answer" in llm_request:
+        return {"text": llm_request["answer"]}
+
+    answer_text = get_llm_query_response_text(llm_request["body"])
+    if answer_cache is not None:
+        answer_cache.put(query, answer_text, llm_request["embedding"], rephrased_queries)
 
     response = {"text": answer_text}
     return response
@@ -121,9 +370,11 @@ def lambda_handler(event: dict[str, object], context: dict[str, object]):
 
 if __name__ == "__main__":
     # lambda_handler({"query": "Tell me the story of the ugly prince."}, None)
+    # for text in stream_answer("Tell me the story of the ugly prince."):
+    #     print(text, end="", flush=True)
     res = query_db_documents(
         embedding=[0.1] * 1536,
-        connection=DB_CONNECTION,
+        connection=get_db_connection(),
         top_n_documents=TOP_N_DOCUMENTS,
         distance_threshold=MAX_DISTANCE_THRESHOLD,
     )
@@ -1,5 +1,4 @@
 import os
-import boto3
 import sys
 import time
 import re
@@ -12,7 +11,9 @@ sys.path.append(src_dir_path)
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
 MESSAGE_GROUP_ID = "SINGLETON"
 
-sqs_client = boto3.client("sqs")
+from common.clients import get_client
+
+sqs_client = get_client("sqs")
 
 
 TEST_EVENTS = {"s3:TestEvent"}
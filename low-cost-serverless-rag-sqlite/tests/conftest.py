@@ -0,0 +1,24 @@
+import os
+import pathlib
+import sys
+
+import pytest
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+sys.path.insert(0, str(SRC_DIR_PATH))
+
+
+@pytest.fixture(scope="module")
+def query_lambda():
+    """
+    Return the query lambda module, its database is loaded in the background at import time
+    and fails at once without bucket
+    """
+    moto = pytest.importorskip("moto")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+    os.environ.setdefault("SQLITE_DB_S3_BUCKET", "bucket")
+    with moto.mock_aws():
+        import lambda_query.index as query_lambda
+
+        query_lambda.DB_CONNECTION_FUTURE.exception()
+    return query_lambda
@@ -0,0 +1,51 @@
+import pytest
+
+from common.cache import AnswerCache
+
+QUERY = "Tell me about the ugly prince"
+ANSWER_PIECES = ["The ugly prince ", "lives in a castle."]
+
+
+@pytest.fixture
+def answer_cache(query_lambda, monkeypatch):
+    answer_cache = AnswerCache("v1")
+    monkeypatch.setattr(query_lambda, "get_request_answer_cache", lambda filters=None: answer_cache)
+    monkeypatch.setattr(query_lambda, "get_keyword_matching_documents", lambda query, filters: [])
+    monkeypatch.setattr(query_lambda, "get_embedding", lambda query: [1.0, 0.0] if "prince" in query else [0.0, 1.0])
+    monkeypatch.setattr(query_lambda, "get_matching_documents", lambda query, embedding_futures, filters: [])
+    monkeypatch.setattr(
+        query_lambda, "build_llm_request_body", lambda query, documents, embedding: {"inputText": query}
+    )
+    monkeypatch.setattr(
+        query_lambda, "get_llm_query_response_text_stream", lambda body, client=None: iter(ANSWER_PIECES)
+    )
+    return answer_cache
+
+
+def fail_llm(body: dict) -> str:
+    raise AssertionError("cached answers do not call the LLM")
+
+
+def test_streamed_answer_is_cached(query_lambda, answer_cache, monkeypatch):
+    assert list(query_lambda.stream_answer(QUERY)) == ANSWER_PIECES
+    assert answer_cache.get(QUERY) == "".join(ANSWER_PIECES)
+
+    monkeypatch.setattr(query_lambda, "get_llm_query_response_text", fail_llm)
+    assert query_lambda.lambda_handler({"query": QUERY}, None) == {"text": "".join(ANSWER_PIECES)}
+    assert query_lambda.lambda_handler({"query": "The ugly prince please"}, None) == {"text": "".join(ANSWER_PIECES)}
+
+
+def test_handler_answer_is_streamed_from_cache(query_lambda, answer_cache, monkeypatch):
+    monkeypatch.setattr(query_lambda, "get_llm_query_response_text", lambda body: "Cached answer.")
+    query_lambda.lambda_handler({"query": QUERY}, None)
+
+    monkeypatch.setattr(query_lambda, "get_llm_query_response_text_stream", fail_llm)
+    assert list(query_lambda.stream_answer(QUERY)) == ["Cached answer."]
+
+
+def test_partially_consumed_stream_is_not_cached(query_lambda, answer_cache):
+    answer_stream = query_lambda.stream_answer(QUERY)
+    assert next(answer_stream) == ANSWER_PIECES[0]
+    answer_stream.close()
+
+    assert answer_cache.get(QUERY) is None
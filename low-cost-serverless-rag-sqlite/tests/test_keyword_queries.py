@@ -0,0 +1,33 @@
+import pytest
+
+from common.helpers import is_keyword_query
+
+
+@pytest.mark.parametrize("query", ["ERR-4021", "X12b", "ERR-4021 SKU-12.5"])
+def test_identifier_queries_are_keyword_queries(query):
+    assert is_keyword_query(query)
+
+
+@pytest.mark.parametrize("query", ["refund policy details", "prince", "what is ERR-4021?", "ERR-4021 meaning", ""])
+def test_plain_language_queries_are_not_keyword_queries(query):
+    assert not is_keyword_query(query)
+
+
+def test_short_plain_language_query_reaches_vector_search(query_lambda, monkeypatch):
+    searches = []
+    monkeypatch.setattr(query_lambda, "SEARCH_MODE", query_lambda.SEARCH_MODE_HYBRID)
+    monkeypatch.setattr(query_lambda, "KEYWORD_QUERY_FTS_ONLY", True)
+    monkeypatch.setattr(query_lambda, "get_embedding", lambda query: [1.0, 0.0])
+    monkeypatch.setattr(
+        query_lambda, "query_db_documents_fts", lambda query, **kwargs: searches.append(("fts", query)) or []
+    )
+    monkeypatch.setattr(
+        query_lambda,
+        "get_matching_documents",
+        lambda query, embedding_futures, filters: searches.append(("vector", query)) or [],
+    )
+    monkeypatch.setattr(query_lambda, "build_llm_request_body", lambda query, documents, embedding: documents)
+
+    query_lambda.get_llm_request_body("refund policy details")
+
+    assert searches == [("vector", "refund policy details")]
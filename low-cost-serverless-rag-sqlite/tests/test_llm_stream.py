@@ -0,0 +1,77 @@
+import json
+
+from common.helpers import get_llm_query_response_stream, get_llm_query_response_text_stream
+
+MODEL_ID = "amazon.titan-text-express-v1"
+BODY = {"inputText": "What is the ugly prince?", "textGenerationConfig": {"maxTokenCount": 64}}
+
+
+def get_chunk_event(payload: dict) -> dict:
+    return {"chunk": {"bytes": json.dumps(payload).encode()}}
+
+
+class FakeStreamClient:
+    """
+    Bedrock runtime client answering invoke_model_with_response_stream with the given events
+    """
+
+    def __init__(self, events: list[dict]):
+        self.events = events
+        self.requests = []
+        self.consumed_events = 0
+
+    def iter_events(self):
+        for event in self.events:
+            self.consumed_events += 1
+            yield event
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"body": self.iter_events()}
+
+
+def get_answer_events() -> list[dict]:
+    return [
+        get_chunk_event({"outputText": "The ugly prince ", "index": 0}),
+        # NOTE: Events without chunk (e.g. metadata) are skipped
+        {"metadata": {"usage": {"inputTokens": 7}}},
+        get_chunk_event({"outputText": "lives in a castle.", "index": 0}),
+        get_chunk_event(
+            {
+                "outputText": "",
+                "index": 0,
+                "completionReason": "FINISH",
+                "amazon-bedrock-invocationMetrics": {"inputTokenCount": 7, "outputTokenCount": 9},
+            }
+        ),
+    ]
+
+
+def test_stream_parses_chunks():
+    client = FakeStreamClient(get_answer_events())
+
+    chunks = list(get_llm_query_response_stream(BODY, MODEL_ID, client=client))
+
+    assert [chunk["outputText"] for chunk in chunks] == ["The ugly prince ", "lives in a castle.", ""]
+    assert chunks[-1]["completionReason"] == "FINISH"
+    (request,) = client.requests
+    assert request["modelId"] == MODEL_ID
+    assert json.loads(request["body"]) == BODY
+
+
+def test_stream_yields_final_answer():
+    client = FakeStreamClient(get_answer_events())
+
+    text_pieces = list(get_llm_query_response_text_stream(BODY, MODEL_ID, client=client))
+
+    assert text_pieces == ["The ugly prince ", "lives in a castle."]
+    assert "".join(text_pieces) == "The ugly prince lives in a castle."
+
+
+def test_stream_yields_text_as_it_arrives():
+    client = FakeStreamClient(get_answer_events())
+
+    text_stream = get_llm_query_response_text_stream(BODY, MODEL_ID, client=client)
+
+    assert next(text_stream) == "The ugly prince "
+    assert client.consumed_events == 1
@@ -0,0 +1,62 @@
+import datetime
+import json
+import os
+
+import pytest
+
+BUCKET = "bucket"
+PREFIX = "query-artifact"
+
+
+@pytest.fixture
+def artifact(tmp_path, monkeypatch):
+    """
+    Return the artifact module publishing into a mocked bucket out of a directory holding a database file
+    """
+    moto = pytest.importorskip("moto")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+    with moto.mock_aws():
+        import boto3
+
+        from common import artifact, helpers
+
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(
+            Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_DEFAULT_REGION"]}
+        )
+        monkeypatch.setattr(artifact, "s3_client", s3_client)
+        monkeypatch.setattr(helpers, "s3_client", s3_client)
+        tmp_path.joinpath(artifact.QUERY_ARTIFACT_DB_NAME).write_bytes(b"db")
+        yield artifact
+
+
+def publish(artifact, directory, retention_seconds: float = 600) -> str:
+    manifest = {"version": artifact.get_artifact_version(), "files": {artifact.QUERY_ARTIFACT_DB_NAME: 2}}
+    artifact.publish_query_artifact(BUCKET, PREFIX, str(directory), manifest, retention_seconds=retention_seconds)
+    return manifest["version"]
+
+
+def test_replaced_versions_are_kept_for_loading_containers(artifact, tmp_path):
+    versions = [publish(artifact, tmp_path) for _ in range(3)]
+
+    assert sorted(artifact.get_query_artifact_versions(BUCKET, PREFIX)) == versions
+    manifest = artifact.get_query_artifact_manifest(BUCKET, PREFIX)
+    assert manifest["version"] == versions[-1]
+    assert sorted(manifest["replaced_versions"]) == versions[:-1]
+
+
+def test_versions_are_deleted_once_replaced_for_the_retention(artifact, tmp_path):
+    versions = [publish(artifact, tmp_path) for _ in range(3)]
+    manifest = artifact.get_query_artifact_manifest(BUCKET, PREFIX)
+    replaced_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    manifest["replaced_versions"][versions[0]] = replaced_at.isoformat()
+    artifact.s3_client.put_object(
+        Bucket=BUCKET, Key=f"{PREFIX}/{artifact.SQLITE_QUERY_ARTIFACT_MANIFEST}", Body=json.dumps(manifest).encode()
+    )
+
+    version = publish(artifact, tmp_path)
+    assert sorted(artifact.get_query_artifact_versions(BUCKET, PREFIX)) == versions[1:] + [version]
+
+    version = publish(artifact, tmp_path, retention_seconds=0)
+    assert sorted(artifact.get_query_artifact_versions(BUCKET, PREFIX)) == [version]
+    assert "replaced_versions" not in artifact.get_query_artifact_manifest(BUCKET, PREFIX)
@@ -0,0 +1,87 @@
+import botocore.exceptions
+import pytest
+
+import common.rate_limiter as rate_limiter
+from common.rate_limiter import call_model, get_rate_limiter
+
+MODEL_ID = "test.retried-model-v1"
+
+
+def get_client_error(code: str, status_code: int = 400) -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}},
+        "InvokeModel",
+    )
+
+
+class FlakyMethod:
+    """
+    Client method raising the given errors first, then answering
+    """
+
+    def __init__(self, errors: list[Exception]):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"modelId": kwargs["modelId"]}
+
+
+@pytest.fixture(autouse=True)
+def fresh_rate_limiter():
+    # NOTE: Each test starts with a full bucket, so that its calls are not paced
+    rate_limiter.RATE_LIMITERS.pop(MODEL_ID, None)
+
+
+@pytest.fixture(autouse=True)
+def backoffs(monkeypatch):
+    backoffs = []
+    monkeypatch.setattr(rate_limiter.time, "sleep", backoffs.append)
+    return backoffs
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        get_client_error("ServiceUnavailableException", 503),
+        get_client_error("InternalServerException", 500),
+        get_client_error("ModelTimeoutException", 408),
+        get_client_error("UnknownServerError", 502),
+        botocore.exceptions.EndpointConnectionError(endpoint_url="https://bedrock-runtime"),
+        botocore.exceptions.ReadTimeoutError(endpoint_url="https://bedrock-runtime"),
+    ],
+)
+def test_transient_errors_are_retried_with_backoff(error, backoffs):
+    method = FlakyMethod([error, error])
+
+    assert call_model(method, MODEL_ID, max_retries=2) == {"modelId": MODEL_ID}
+    assert method.calls == 3
+    assert len(backoffs) == 2
+
+
+def test_transient_errors_are_raised_after_max_retries():
+    method = FlakyMethod([get_client_error("ServiceUnavailableException", 503)] * 3)
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        call_model(method, MODEL_ID, max_retries=2)
+    assert method.calls == 3
+
+
+def test_client_errors_are_not_retried():
+    method = FlakyMethod([get_client_error("ValidationException")])
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        call_model(method, MODEL_ID)
+    assert method.calls == 1
+
+
+def test_throttled_calls_slow_the_rate_limiter_down(backoffs):
+    method = FlakyMethod([get_client_error("ThrottlingException")])
+    rate = get_rate_limiter(MODEL_ID).requests.rate
+
+    assert call_model(method, MODEL_ID) == {"modelId": MODEL_ID}
+    assert method.calls == 2
+    assert get_rate_limiter(MODEL_ID).requests.rate < rate
@@ -0,0 +1,84 @@
+"""
+Measure the import time of a Lambda handler module with `python -X importtime` and guard cold start regressions.
+
+The module is imported in a fresh interpreter, the slowest top level imports are reported and the script exits
+with an error in case the total import time exceeds --max-ms or any of the --forbidden modules gets imported.
+
+Usage (from this directory):
+    python import_time_benchmark.py --module lambda_query.index --max-ms 1500
+"""
+
+import argparse
+import os
+import pathlib
+import re
+import subprocess
+import sys
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+
+# NOTE: Heavy dependencies only needed to import documents, the query path must not load them
+FORBIDDEN_MODULES = ["pandas", "pyarrow", "fitz", "awswrangler", "lshashpy3"]
+
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def get_import_times(module: str) -> list[tuple[str, int, int]]:
+    """
+    Import the module in a fresh interpreter and return (module, depth, cumulative us) of all imports
+    """
+    env = {**os.environ, "PYTHONPATH": str(SRC_DIR_PATH)}
+    env.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR_PATH,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    import_times = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            _, cumulative_us, indent, name = match.groups()
+            import_times.append((name, (len(indent) - 1) // 2, int(cumulative_us)))
+    return import_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="lambda_query.index")
+    parser.add_argument("--max-ms", type=float, default=1500)
+    parser.add_argument("--forbidden", nargs="*", default=FORBIDDEN_MODULES)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    import_times = get_import_times(args.module)
+    top_level_imports = [(name, cumulative_us) for name, depth, cumulative_us in import_times if depth == 0]
+    total_ms = sum(cumulative_us for _, cumulative_us in top_level_imports) / 1000
+
+    print(f"Total import time of {args.module}: {total_ms:.0f} ms")
+    # NOTE: Direct imports of the top level modules tell which dependency is slow to import
+    direct_imports = [(name, cumulative_us) for name, depth, cumulative_us in import_times if depth <= 1]
+    for name, cumulative_us in sorted(direct_imports, key=lambda item: item[1], reverse=True)[: args.top]:
+        print(f"{cumulative_us / 1000:>10.1f} ms  {name}")
+
+    imported_modules = {name.split(".")[0] for name, _, _ in import_times}
+    forbidden_imported = sorted(imported_modules & set(args.forbidden))
+
+    errors = []
+    if forbidden_imported:
+        errors.append(f"forbidden modules imported: {forbidden_imported}")
+    if total_ms > args.max_ms:
+        errors.append(f"import time {total_ms:.0f} ms exceeds {args.max_ms:.0f} ms")
+    if errors:
+        print("FAILED:", "; ".join(errors))
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
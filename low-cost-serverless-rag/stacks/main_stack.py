@@ -24,14 +24,18 @@ class RAGStack(Stack):
         workgroup_name = f"rag_{stack_addr}"
         glue_database_name = f"rag_{stack_addr}"
         glue_table_name = "documents"
+        documents_prepared_statement_name = "rag_documents_query"
 
         output_bucket = input_bucket = aws_s3.Bucket(self, "RAG")
         input_prefix = "input"
 
         output_prefix = "output"
         documents_table_location_prefix = os.path.join(output_prefix, "tables", glue_table_name)
+        # NOTE: Outside of the table location, so that Athena does not read it as a table file
+        documents_version_key = os.path.join(output_prefix, "documents-version.json")
 
         tmp_prefix = "tmp"
+        answer_cache_prefix = os.path.join(tmp_prefix, "answer-cache")
 
         output_bucket.add_lifecycle_rule(
             prefix=os.path.join(tmp_prefix, ""),
@@ -120,6 +124,7 @@ class RAGStack(Stack):
                 "OUTPUT_BUCKET": output_bucket.bucket_name,
                 "OUTPUT_PREFIX": output_prefix,
                 "DOCUMENTS_OUTPUT_PREFIX": documents_table_location_prefix,
+                "DOCUMENTS_VERSION_S3_KEY": documents_version_key,
             },
             memory_size=1024,
             timeout=cdk.Duration.minutes(5),
@@ -138,16 +143,23 @@ class RAGStack(Stack):
                 "ATHENA_TABLE": glue_table_name,
                 "ATHENA_DATABASE": glue_database.database_input.name,
                 "ATHENA_WORKGROUP": workgroup_name,
+                "ATHENA_DOCUMENTS_PREPARED_STATEMENT": documents_prepared_statement_name,
+                "DOCUMENTS_S3_BUCKET": output_bucket.bucket_name,
+                "DOCUMENTS_S3_PREFIX": os.path.join(documents_table_location_prefix, ""),
+                "DOCUMENTS_VERSION_S3_KEY": documents_version_key,
+                "ANSWER_CACHE_S3_BUCKET": output_bucket.bucket_name,
+                "ANSWER_CACHE_S3_PREFIX": answer_cache_prefix,
             },
             memory_size=1024,
             timeout=cdk.Duration.minutes(5),
         )
-        # NOTE: As we are using the AWS data wrangler we need a bit more of athena/glue permissions than normally
+        # NOTE: Glue permissions are needed to run Athena queries on the documents table
         lambda_query.add_to_role_policy(
             aws_iam.PolicyStatement(
                 actions=[
                     "athena:GetQueryExecution",
                     "athena:GetQueryResults",
+                    "athena:GetPreparedStatement",
                     "athena:GetWorkGroup",
                     "athena:ListWorkGroups",
                     "athena:StartQueryExecution",
@@ -170,7 +182,7 @@ class RAGStack(Stack):
         lambda_import.add_event_source(
             aws_lambda_event_sources.S3EventSource(
                 input_bucket,
-                events=[aws_s3.EventType.OBJECT_CREATED],
+                events=[aws_s3.EventType.OBJECT_CREATED, aws_s3.EventType.OBJECT_REMOVED],
                 filters=[aws_s3.NotificationKeyFilter(prefix=os.path.join(input_prefix, ""))],
             )
         )
@@ -210,6 +222,32 @@ class RAGStack(Stack):
         )
         workgroup.node.add_dependency(output_bucket)
 
+        # NOTE: The documents query is parsed and planned once, queries only bind the LSH, threshold and limit
+        documents_prepared_statement = aws_athena.CfnPreparedStatement(
+            self,
+            "RAGDocumentsPreparedStatement",
+            statement_name=documents_prepared_statement_name,
+            work_group=workgroup_name,
+            description="Documents best matching the LSH of a query",
+            query_statement=f"""
+WITH scored_documents AS (
+    SELECT
+        "uuid", "start", "end", start_unique, end_unique, lsh, document_id, "text",
+        (length(lsh) - hamming_distance(lsh, ?)) * 100.0 / length(lsh) score
+    FROM
+        "awsdatacatalog"."{glue_database_name}"."{glue_table_name}"
+)
+
+SELECT * FROM scored_documents
+WHERE
+    score >= ?
+ORDER BY score DESC
+LIMIT ?
+""",
+        )
+        documents_prepared_statement.node.add_dependency(workgroup)
+        documents_prepared_statement.node.add_dependency(glue_athena_table)
+
         cdk.CfnOutput(self, "LambdaQueryName", value=lambda_query.function_name, description="Lambda Query name")
         cdk.CfnOutput(self, "OutputBucket", value=output_bucket.bucket_name)
         cdk.CfnOutput(self, "OutputBucketPrefix", value=output_prefix)
@@ -0,0 +1,128 @@
+import time
+
+from .clients import get_client
+from .config import (
+    ATHENA_POLL_BACKOFF,
+    ATHENA_POLL_FIRST_INTERVAL_SECONDS,
+    ATHENA_POLL_MAX_INTERVAL_SECONDS,
+    ATHENA_RESULT_REUSE_MAX_AGE_MINUTES,
+)
+
+athena_client = get_client("athena")
+
+ATHENA_QUERY_FINAL_STATES = {"SUCCEEDED", "FAILED", "CANCELLED"}
+
+# NOTE: Athena returns all values as strings, values of other column types are converted
+ATHENA_TYPE_CONVERTERS = {
+    "tinyint": int,
+    "smallint": int,
+    "integer": int,
+    "bigint": int,
+    "float": float,
+    "real": float,
+    "double": float,
+    "boolean": lambda value: value == "true",
+}
+
+
+class AthenaQueryError(Exception):
+    pass
+
+
+def start_query(
+    sql: str,
+    database: str,
+    workgroup: str,
+    execution_parameters: list[str] | None = None,
+    result_reuse_max_age_minutes: int = ATHENA_RESULT_REUSE_MAX_AGE_MINUTES,
+    client=athena_client,
+) -> str:
+    """
+    Start the query and return its execution id.
+    Results of an identical query run within result_reuse_max_age_minutes are reused (0 disables the reuse).
+    """
+    kwargs = {}
+    if execution_parameters:
+        kwargs["ExecutionParameters"] = execution_parameters
+    if result_reuse_max_age_minutes:
+        kwargs["ResultReuseConfiguration"] = {
+            "ResultReuseByAgeConfiguration": {"Enabled": True, "MaxAgeInMinutes": result_reuse_max_age_minutes}
+        }
+    response = client.start_query_execution(
+        QueryString=sql, QueryExecutionContext={"Database": database}, WorkGroup=workgroup, **kwargs
+    )
+    return response["QueryExecutionId"]
+
+
+def wait_for_query(
+    query_execution_id: str,
+    first_interval_seconds: float = ATHENA_POLL_FIRST_INTERVAL_SECONDS,
+    max_interval_seconds: float = ATHENA_POLL_MAX_INTERVAL_SECONDS,
+    backoff: float = ATHENA_POLL_BACKOFF,
+    client=athena_client,
+) -> dict:
+    """
+    Poll the query until it is done and return its execution.
+    The first polls are short, as reused or small queries finish quickly, and the interval grows up to a maximum.
+    """
+    interval_seconds = first_interval_seconds
+    while True:
+        query_execution = client.get_query_execution(QueryExecutionId=query_execution_id)["QueryExecution"]
+        state = query_execution["Status"]["State"]
+        if state in ATHENA_QUERY_FINAL_STATES:
+            break
+        time.sleep(interval_seconds)
+        interval_seconds = min(interval_seconds * backoff, max_interval_seconds)
+
+    if state != "SUCCEEDED":
+        reason = query_execution["Status"].get("StateChangeReason", "")
+        raise AthenaQueryError(f"Query {query_execution_id} {state}: {reason}")
+
+    reused = query_execution.get("Statistics", {}).get("ResultReuseInformation", {}).get("ReusedPreviousResult")
+    print("ATHENA QUERY: ", query_execution_id, "REUSED RESULT: ", reused)
+    return query_execution
+
+
+def get_query_rows(query_execution_id: str, client=athena_client) -> list[dict]:
+    """
+    Return the rows of a succeeded query as dicts, fetched page by page with GetQueryResults
+    """
+    rows = []
+    columns = None
+    paginator = client.get_paginator("get_query_results")
+    for page in paginator.paginate(QueryExecutionId=query_execution_id):
+        result_set = page["ResultSet"]
+        page_rows = result_set["Rows"]
+        if columns is None:
+            columns = [
+                (column["Name"], ATHENA_TYPE_CONVERTERS.get(column["Type"]))
+                for column in result_set["ResultSetMetadata"]["ColumnInfo"]
+            ]
+            # NOTE: The first row of the first page holds the column names
+            page_rows = page_rows[1:]
+        for row in page_rows:
+            item = {}
+            for (name, converter), datum in zip(columns, row["Data"]):
+                value = datum.get("VarCharValue")
+                item[name] = converter(value) if converter is not None and value is not None else value
+            rows.append(item)
+    return rows
+
+
+def run_query(
+    sql: str,
+    database: str,
+    workgroup: str,
+    execution_parameters: list[str] | None = None,
+    result_reuse_max_age_minutes: int = ATHENA_RESULT_REUSE_MAX_AGE_MINUTES,
+    client=athena_client,
+) -> list[dict]:
+    """
+    Run the query and return its rows, meant for small results which are faster fetched through the API
+    than downloaded and parsed from the result file
+    """
+    query_execution_id = start_query(
+        sql, database, workgroup, execution_parameters, result_reuse_max_age_minutes, client=client
+    )
+    wait_for_query(query_execution_id, client=client)
+    return get_query_rows(query_execution_id, client=client)
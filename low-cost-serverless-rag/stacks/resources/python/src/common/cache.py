@@ -0,0 +1,211 @@
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+import numpy as np
+
+from .config import (
+    ANSWER_CACHE_MAX_SIZE,
+    ANSWER_CACHE_S3_LOAD_CONCURRENCY,
+    ANSWER_CACHE_S3_LOAD_SIZE,
+    ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    ANSWER_CACHE_TTL_SECONDS,
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a query so that queries only differing in case, whitespaces or punctuation share the same key
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+def get_normalized_rephrased_queries(rephrased_queries: list[str] | None) -> list[str]:
+    return sorted(normalize_query(rephrased_query) for rephrased_query in rephrased_queries or [])
+
+
+def get_query_key(query: str, rephrased_queries: list[str] | None = None) -> str:
+    """
+    Return the cache key of a query, rephrasings of the query are part of it as they change the retrieved documents
+    """
+    key_text = "\n".join([normalize_query(query), *get_normalized_rephrased_queries(rephrased_queries)])
+    return hashlib.sha1(key_text.encode()).hexdigest()
+
+
+def get_cosine_similarities(embeddings: np.ndarray, embedding: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(embedding)
+    return embeddings @ embedding / np.where(norms == 0, 1, norms)
+
+
+class AnswerCache:
+    """
+    Answer cache with TTL and LRU eviction scoped to a database version.
+
+    Answers are looked up by normalized query text (and rephrasings) first, in memory and then in S3 (if configured)
+    so that they survive container recycling. Near duplicate queries are matched by query embedding similarity
+    against the answers held in memory, which are completed once with the most recent answers persisted in S3.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_size: int = ANSWER_CACHE_MAX_SIZE,
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        s3_client=None,
+        s3_bucket: str | None = None,
+        s3_prefix: str | None = None,
+        s3_load_size: int = ANSWER_CACHE_S3_LOAD_SIZE,
+    ):
+        self.version = version
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.s3_load_size = s3_load_size
+        self.s3_entries_loaded = False
+        self.entries: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def is_persistent(self) -> bool:
+        return self.s3_client is not None and bool(self.s3_bucket) and self.s3_prefix is not None
+
+    def get_s3_version_prefix(self) -> str:
+        return f"{self.s3_prefix.rstrip('/')}/{self.version}/"
+
+    def get_s3_key(self, key: str) -> str:
+        return f"{self.get_s3_version_prefix()}{key}.json"
+
+    def is_expired(self, entry: dict) -> bool:
+        return time.time() - entry["created"] > self.ttl_seconds
+
+    def remember(self, key: str, entry: dict):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_memory_entry(self, key: str) -> dict | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if self.is_expired(entry):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def get_s3_entry(self, key: str) -> dict | None:
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_s3_key(key))
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] in {"NoSuchKey", "404"}:
+                return None
+            raise
+        entry = json.loads(response["Body"].read())
+        if self.is_expired(entry):
+            return None
+        return entry
+
+    def load_s3_entries(self, max_workers: int = ANSWER_CACHE_S3_LOAD_CONCURRENCY):
+        """
+        Load the s3_load_size most recent answers persisted for this version into memory (once),
+        so that near duplicate queries are matched after the container was recycled as well
+        """
+        with self.lock:
+            if self.s3_entries_loaded:
+                return
+            self.s3_entries_loaded = True
+
+        prefix = self.get_s3_version_prefix()
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix)
+        items = [item for page in pages for item in page.get("Contents", [])]
+        keys = [
+            item["Key"].removeprefix(prefix).removesuffix(".json")
+            for item in sorted(items, key=lambda item: item["LastModified"])[-self.s3_load_size :]
+        ]
+        if not keys:
+            return
+        with ThreadPoolExecutor(max(1, min(max_workers, len(keys)))) as executor:
+            entries = list(executor.map(self.get_s3_entry, keys))
+        # NOTE: Oldest first, so that the most recent answers are the last evicted
+        for key, entry in zip(keys, entries):
+            if entry is not None and self.get_memory_entry(key) is None:
+                self.remember(key, entry)
+
+    def get(self, query: str, rephrased_queries: list[str] | None = None) -> str | None:
+        """
+        Return the cached answer for the (normalized) query and its rephrasings or None
+        """
+        key = get_query_key(query, rephrased_queries)
+        entry = self.get_memory_entry(key)
+        if entry is None and self.is_persistent:
+            entry = self.get_s3_entry(key)
+            if entry is not None:
+                self.remember(key, entry)
+        return entry["answer"] if entry is not None else None
+
+    def get_similar(
+        self, embedding: list[float] | np.ndarray, rephrased_queries: list[str] | None = None
+    ) -> str | None:
+        """
+        Return the cached answer of the most similar query (with the same rephrasings) if its similarity
+        is above the threshold or None
+        """
+        if self.is_persistent:
+            self.load_s3_entries()
+        normalized_rephrased_queries = get_normalized_rephrased_queries(rephrased_queries)
+        with self.lock:
+            entries = [
+                entry
+                for entry in self.entries.values()
+                if entry.get("embedding") is not None
+                and not self.is_expired(entry)
+                and get_normalized_rephrased_queries(entry.get("rephrased_queries")) == normalized_rephrased_queries
+            ]
+        if not entries:
+            return None
+
+        similarities = get_cosine_similarities(
+            np.array([entry["embedding"] for entry in entries], dtype=np.float32), np.asarray(embedding, np.float32)
+        )
+        best_idx = int(np.argmax(similarities))
+        if similarities[best_idx] < self.similarity_threshold:
+            return None
+
+        # NOTE: Refresh the LRU position of the matching entry
+        best_entry = entries[best_idx]
+        self.get_memory_entry(get_query_key(best_entry["query"], best_entry.get("rephrased_queries")))
+        return best_entry["answer"]
+
+    def put(
+        self,
+        query: str,
+        answer: str,
+        embedding: list[float] | np.ndarray | None = None,
+        rephrased_queries: list[str] | None = None,
+    ):
+        if isinstance(embedding, np.ndarray):
+            embedding = embedding.tolist()
+        key = get_query_key(query, rephrased_queries)
+        entry = {
+            "query": query,
+            "rephrased_queries": rephrased_queries or [],
+            "answer": answer,
+            "embedding": embedding,
+            "created": time.time(),
+        }
+        self.remember(key, entry)
+        if self.is_persistent:
+            self.s3_client.put_object(Bucket=self.s3_bucket, Key=self.get_s3_key(key), Body=json.dumps(entry))
@@ -0,0 +1,53 @@
+import threading
+
+import boto3
+import botocore.config
+
+from .config import (
+    AWS_REGION_BEDROCK,
+    CLIENT_CONNECT_TIMEOUT_SECONDS,
+    CLIENT_MAX_ATTEMPTS,
+    CLIENT_MAX_POOL_CONNECTIONS,
+    CLIENT_READ_TIMEOUT_SECONDS,
+    CLIENT_SERVICES_TOTAL_MAX_ATTEMPTS,
+)
+
+# NOTE: Clients are thread safe while sessions are not, so that clients are created once with a lock
+# and then shared by all modules and threads of the container
+SESSION = boto3.session.Session()
+CLIENTS: dict[tuple[str, str | None], object] = {}
+CLIENTS_LOCK = threading.Lock()
+
+BEDROCK_SERVICE_NAMES = {"bedrock", "bedrock-runtime"}
+
+
+def get_client_config(service_name: str | None = None) -> botocore.config.Config:
+    retries = {"mode": "adaptive", "max_attempts": CLIENT_MAX_ATTEMPTS}
+    if service_name in CLIENT_SERVICES_TOTAL_MAX_ATTEMPTS:
+        retries = {"mode": "adaptive", "total_max_attempts": CLIENT_SERVICES_TOTAL_MAX_ATTEMPTS[service_name]}
+    return botocore.config.Config(
+        max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=CLIENT_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=CLIENT_READ_TIMEOUT_SECONDS,
+        retries=retries,
+    )
+
+
+def get_client(service_name: str, region_name: str | None = None):
+    """
+    Return the client of the service shared within the container, created on first use with a connection pool
+    sized for concurrent calls, TCP keep-alive, timeouts and adaptive retries (none for the Bedrock runtime,
+    retried by the rate limiter). Bedrock clients default to AWS_REGION_BEDROCK.
+    """
+    if region_name is None and service_name in BEDROCK_SERVICE_NAMES:
+        region_name = AWS_REGION_BEDROCK
+    key = (service_name, region_name)
+    client = CLIENTS.get(key)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                client = SESSION.client(service_name, region_name=region_name, config=get_client_config(service_name))
+                CLIENTS[key] = client
+    return client
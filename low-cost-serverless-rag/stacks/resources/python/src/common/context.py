@@ -0,0 +1,133 @@
+from typing import TypedDict
+
+from .config import CONTEXT_MAX_TOKENS
+from .tokenizer import count_tokens
+
+CONTEXT_SEPARATOR = "\n\n"
+
+
+class ChunkRow(TypedDict, total=False):
+    """
+    Chunk as returned by the documents query
+    """
+
+    uuid: str
+    start: int
+    end: int
+    start_unique: int
+    end_unique: int
+    lsh: str
+    document_id: str
+    text: str
+    score: float
+
+
+def get_chunk_span(chunk: dict) -> tuple[int, int] | None:
+    """
+    Return the (start, end) position of the chunk within its document or None if unknown
+    """
+    if chunk.get("document_id") is None or chunk.get("start") is None or chunk.get("end") is None:
+        return None
+    return int(chunk["start"]), int(chunk["end"])
+
+
+def subtract_spans(span: tuple[int, int], spans: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Return the parts of span which are not covered by any of spans
+    """
+    remaining = [span]
+    for covered_start, covered_end in spans:
+        next_remaining = []
+        for start, end in remaining:
+            if covered_end <= start or covered_start >= end:
+                next_remaining.append((start, end))
+                continue
+            if start < covered_start:
+                next_remaining.append((start, covered_start))
+            if covered_end < end:
+                next_remaining.append((covered_end, end))
+        remaining = next_remaining
+    return remaining
+
+
+def select_chunks(chunks: list[dict], max_tokens: int = CONTEXT_MAX_TOKENS) -> list[tuple[int, dict]]:
+    """
+    Greedily select chunks by relevance (chunks are expected to be sorted with the most relevant first)
+    as long as the text they add to the context fits within max_tokens.
+    Text overlapping with already selected chunks of the same document does not count against the budget.
+    Return the selected chunks with their rank.
+    """
+    selected = []
+    spans_by_document: dict[str, list[tuple[int, int]]] = {}
+    used_tokens = 0
+
+    for rank, chunk in enumerate(chunks):
+        span = get_chunk_span(chunk)
+        if span is None:
+            new_text_parts = [chunk["text"]]
+        else:
+            chunk_start = span[0]
+            document_spans = spans_by_document.setdefault(chunk["document_id"], [])
+            new_text_parts = [
+                chunk["text"][start - chunk_start : end - chunk_start]
+                for start, end in subtract_spans(span, document_spans)
+            ]
+
+        new_tokens = sum(count_tokens(text) for text in new_text_parts)
+        if used_tokens + new_tokens > max_tokens:
+            continue
+
+        used_tokens += new_tokens
+        if span is not None:
+            spans_by_document[chunk["document_id"]].append(span)
+        selected.append((rank, chunk))
+
+    return selected
+
+
+def merge_chunks(ranked_chunks: list[tuple[int, dict]]) -> list[tuple[int, str]]:
+    """
+    Merge overlapping or adjacent chunks of the same document into a single text without duplicated overlaps.
+    Return (best rank, text) for each merged segment.
+    """
+    segments: list[tuple[int, str]] = []
+    chunks_by_document: dict[str, list[tuple[int, dict]]] = {}
+
+    for rank, chunk in ranked_chunks:
+        if get_chunk_span(chunk) is None:
+            segments.append((rank, chunk["text"]))
+        else:
+            chunks_by_document.setdefault(chunk["document_id"], []).append((rank, chunk))
+
+    for document_chunks in chunks_by_document.values():
+        document_chunks.sort(key=lambda ranked_chunk: get_chunk_span(ranked_chunk[1]))
+
+        segment_rank, segment_text, segment_end = None, "", None
+        for rank, chunk in document_chunks:
+            start, end = get_chunk_span(chunk)
+            if segment_end is not None and start <= segment_end:
+                if end > segment_end:
+                    segment_text += chunk["text"][segment_end - start :]
+                    segment_end = end
+                segment_rank = min(segment_rank, rank)
+            else:
+                if segment_end is not None:
+                    segments.append((segment_rank, segment_text))
+                segment_rank, segment_text, segment_end = rank, chunk["text"], end
+        segments.append((segment_rank, segment_text))
+
+    segments.sort(key=lambda segment: segment[0])
+    return segments
+
+
+def assemble_context(
+    chunks: list[dict], max_tokens: int = CONTEXT_MAX_TOKENS, separator: str = CONTEXT_SEPARATOR
+) -> str:
+    """
+    Build the LLM context from retrieved chunks sorted by relevance (most relevant first):
+    chunks are packed into max_tokens by relevance, chunks of the same document are merged using their
+    start/end positions so that overlapping text is only sent once, and the most relevant segments come first.
+    """
+    selected_chunks = select_chunks(chunks, max_tokens=max_tokens)
+    segments = merge_chunks(selected_chunks)
+    return separator.join(text for _, text in segments)
@@ -0,0 +1,335 @@
+import json
+import pathlib
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .clients import get_client
+from .config import (
+    ACCEPT,
+    BATCH_INFERENCE_POLL_INTERVAL_SECONDS,
+    CONTENT_TYPE,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MODEL_ID,
+    LOCAL_EMBEDDING_BATCH_SIZE,
+    LOCAL_EMBEDDING_MAX_LENGTH,
+    LOCAL_EMBEDDING_MODELS_DIR,
+    LOCAL_EMBEDDING_THREADS,
+)
+from .rate_limiter import PRIORITY_INTERACTIVE, call_model, estimate_tokens
+
+# NOTE: Some models embed queries and documents differently, models without input types ignore it
+INPUT_TYPE_QUERY = "query"
+INPUT_TYPE_DOCUMENT = "document"
+
+SRC_DIR_PATH = pathlib.Path(__file__).parent.parent
+ONNX_MODEL_ID_PREFIX = "onnx/"
+
+BATCH_INFERENCE_FINAL_STATES = {"Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired"}
+
+
+class EmbeddingProvider:
+    """
+    Compute embeddings of texts with a Bedrock embedding model.
+
+    Each provider builds the request bodies of its model family: models accepting multiple texts per request
+    (max_batch_size > 1) embed batches of texts with a single request, other models are called with parallel
+    single text requests.
+    """
+
+    model_id_prefix: str = ""
+    max_batch_size: int = 1
+
+    def __init__(
+        self,
+        model_id: str,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+        client=None,
+    ):
+        self.model_id = model_id
+        self.batch_size = max(1, min(batch_size, self.max_batch_size))
+        self.max_concurrency = max_concurrency
+        self.client = client if client is not None else get_client("bedrock-runtime")
+        self.executor = None
+
+    def get_request_body(self, texts: list[str], input_type: str) -> dict:
+        raise NotImplementedError
+
+    def get_response_embeddings(self, response_body: dict) -> list[list[float]]:
+        raise NotImplementedError
+
+    def invoke(self, texts: list[str], input_type: str, priority: int) -> list[list[float]]:
+        """
+        Embed the texts with a single request
+        """
+        response = call_model(
+            self.client.invoke_model,
+            self.model_id,
+            tokens=sum(estimate_tokens(text) for text in texts),
+            priority=priority,
+            body=json.dumps(self.get_request_body(texts, input_type)),
+            accept=ACCEPT,
+            contentType=CONTENT_TYPE,
+        )
+        return self.get_response_embeddings(json.loads(response["body"].read()))
+
+    def get_embedding(
+        self, text: str, input_type: str = INPUT_TYPE_QUERY, priority: int = PRIORITY_INTERACTIVE
+    ) -> list[float]:
+        return self.invoke([text], input_type, priority)[0]
+
+    def get_embeddings(
+        self, texts: list[str], input_type: str = INPUT_TYPE_DOCUMENT, priority: int = PRIORITY_INTERACTIVE
+    ) -> list[list[float]]:
+        """
+        Embed the texts in batches of up to batch_size texts, batches are requested in parallel.
+        Embeddings are returned in the order of the texts.
+        """
+        batches = [texts[start : start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1 or self.max_concurrency <= 1:
+            batches_embeddings = [self.invoke(batch, input_type, priority) for batch in batches]
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.max_concurrency)
+            batches_embeddings = self.executor.map(lambda batch: self.invoke(batch, input_type, priority), batches)
+        return [embedding for batch_embeddings in batches_embeddings for embedding in batch_embeddings]
+
+
+class TitanEmbeddingProvider(EmbeddingProvider):
+    """
+    Amazon Titan embedding models, embedding a single text per request
+    """
+
+    model_id_prefix = "amazon.titan-embed"
+
+    def get_request_body(self, texts: list[str], input_type: str) -> dict:
+        (text,) = texts
+        return {"inputText": text}
+
+    def get_response_embeddings(self, response_body: dict) -> list[list[float]]:
+        return [response_body["embedding"]]
+
+
+class CohereEmbeddingProvider(EmbeddingProvider):
+    """
+    Cohere embedding models, embedding up to 96 texts per request
+    """
+
+    model_id_prefix = "cohere.embed"
+    max_batch_size = 96
+
+    INPUT_TYPES = {INPUT_TYPE_QUERY: "search_query", INPUT_TYPE_DOCUMENT: "search_document"}
+
+    def get_request_body(self, texts: list[str], input_type: str) -> dict:
+        return {"texts": texts, "input_type": self.INPUT_TYPES[input_type], "truncate": "END"}
+
+    def get_response_embeddings(self, response_body: dict) -> list[list[float]]:
+        return response_body["embeddings"]
+
+
+def load_onnx_model(
+    model_id: str, threads: int | None, max_length: int, models_dir: str = LOCAL_EMBEDDING_MODELS_DIR
+) -> tuple:
+    """
+    Load the local model "onnx/<name>" out of <models_dir>/<name>, which holds the exported model (model.onnx)
+    and its tokenizer (tokenizer.json): return the tokenizer, the CPU inference session and its input names
+    """
+    # NOTE: Imported lazily as only the local models need them
+    import onnxruntime
+    from tokenizers import Tokenizer
+
+    model_dir = SRC_DIR_PATH / models_dir / model_id.removeprefix(ONNX_MODEL_ID_PREFIX)
+    tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+    tokenizer.enable_truncation(max_length)
+    tokenizer.enable_padding()
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = threads or 0
+    options.inter_op_num_threads = 1
+    session = onnxruntime.InferenceSession(str(model_dir / "model.onnx"), options, providers=["CPUExecutionProvider"])
+    input_names = {model_input.name for model_input in session.get_inputs()}
+    return tokenizer, session, input_names
+
+
+class OnnxEmbeddingProvider(EmbeddingProvider):
+    """
+    Sentence embedding model run locally on CPU with ONNX Runtime, e.g. for bulk imports or offline.
+    The model "onnx/<name>" is loaded once per process out of LOCAL_EMBEDDING_MODELS_DIR/<name>,
+    which holds the exported model (model.onnx) and its tokenizer (tokenizer.json).
+    """
+
+    model_id_prefix = ONNX_MODEL_ID_PREFIX
+    max_batch_size = 1024
+
+    def __init__(
+        self,
+        model_id: str,
+        batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+        threads: int | None = LOCAL_EMBEDDING_THREADS,
+        max_length: int = LOCAL_EMBEDDING_MAX_LENGTH,
+        models_dir: str = LOCAL_EMBEDDING_MODELS_DIR,
+    ):
+        self.model_id = model_id
+        self.batch_size = max(1, min(batch_size, self.max_batch_size))
+        # NOTE: Batches run one after the other, ONNX Runtime parallelizes each inference over threads
+        self.max_concurrency = 1
+        self.executor = None
+        self.tokenizer, self.session, self.input_names = load_onnx_model(model_id, threads, max_length, models_dir)
+
+    def invoke(self, texts: list[str], input_type: str, priority: int) -> list[list[float]]:
+        """
+        Embed the texts with a single inference: mean pooling of the token embeddings, normalized
+        """
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        outputs = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})
+
+        embeddings = outputs[0]
+        # NOTE: Models exported with pooling output sentence embeddings, others output token embeddings
+        if embeddings.ndim == 3:
+            mask = attention_mask[:, :, np.newaxis].astype(embeddings.dtype)
+            embeddings = (embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings.tolist()
+
+    def get_embeddings(
+        self, texts: list[str], input_type: str = INPUT_TYPE_DOCUMENT, priority: int = PRIORITY_INTERACTIVE
+    ) -> list[list[float]]:
+        # NOTE: Texts of similar length are batched together to reduce the padding
+        order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+        sorted_embeddings = super().get_embeddings([texts[idx] for idx in order], input_type, priority)
+        embeddings = [None] * len(texts)
+        for idx, embedding in zip(order, sorted_embeddings):
+            embeddings[idx] = embedding
+        return embeddings
+
+
+EMBEDDING_PROVIDERS: list[type[EmbeddingProvider]] = [
+    TitanEmbeddingProvider,
+    CohereEmbeddingProvider,
+    OnnxEmbeddingProvider,
+]
+
+
+def get_embedding_provider_class(model_id: str = EMBEDDING_MODEL_ID) -> type[EmbeddingProvider]:
+    for provider_class in EMBEDDING_PROVIDERS:
+        if model_id.startswith(provider_class.model_id_prefix):
+            return provider_class
+    prefixes = [provider_class.model_id_prefix for provider_class in EMBEDDING_PROVIDERS]
+    raise ValueError(f"Unknown embedding model {model_id}, expected a model id starting with one of {prefixes}")
+
+
+EMBEDDING_PROVIDER_INSTANCES: dict[str, EmbeddingProvider] = {}
+EMBEDDING_PROVIDER_INSTANCES_LOCK = threading.Lock()
+
+
+def get_embedding_provider(model_id: str = EMBEDDING_MODEL_ID) -> EmbeddingProvider:
+    """
+    Return the embedding provider of the model shared within the container
+    """
+    provider = EMBEDDING_PROVIDER_INSTANCES.get(model_id)
+    if provider is None:
+        with EMBEDDING_PROVIDER_INSTANCES_LOCK:
+            provider = EMBEDDING_PROVIDER_INSTANCES.get(model_id)
+            if provider is None:
+                provider = get_embedding_provider_class(model_id)(model_id)
+                EMBEDDING_PROVIDER_INSTANCES[model_id] = provider
+    return provider
+
+
+def write_batch_inference_input(
+    records: Iterable[tuple[str, str]], file, provider: EmbeddingProvider, input_type: str = INPUT_TYPE_DOCUMENT
+) -> int:
+    """
+    Write (record id, text) records as Bedrock batch inference JSONL input to the text file and return their count.
+    NOTE: Each record holds a single text, the batch inference job itself amortizes the per request overhead
+    """
+    count = 0
+    for record_id, text in records:
+        record = {"recordId": record_id, "modelInput": provider.get_request_body([text], input_type)}
+        file.write(json.dumps(record) + "\n")
+        count += 1
+    return count
+
+
+def read_batch_inference_output(file, provider: EmbeddingProvider) -> Iterator[tuple[str, list[float]]]:
+    """
+    Yield (record id, embedding) out of a Bedrock batch inference JSONL output text file, failed records are skipped
+    """
+    for line in file:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if "modelOutput" not in record:
+            print("BATCH INFERENCE RECORD FAILED: ", record.get("recordId"), record.get("error"))
+            continue
+        (embedding,) = provider.get_response_embeddings(record["modelOutput"])
+        yield record["recordId"], embedding
+
+
+def run_batch_inference_locally(
+    input_file, output_file, provider: EmbeddingProvider, priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Simulate a batch inference job: process the JSONL input text file with direct model calls and write the output
+    in the batch inference output format, e.g. to test a backfill end to end without waiting for a job
+    """
+    records = [json.loads(line) for line in input_file if line.strip()]
+
+    def invoke(record: dict) -> dict:
+        response = call_model(
+            provider.client.invoke_model,
+            provider.model_id,
+            tokens=estimate_tokens(json.dumps(record["modelInput"])),
+            priority=priority,
+            body=json.dumps(record["modelInput"]),
+            accept=ACCEPT,
+            contentType=CONTENT_TYPE,
+        )
+        return {**record, "modelOutput": json.loads(response["body"].read())}
+
+    with ThreadPoolExecutor(provider.max_concurrency) as executor:
+        for output_record in executor.map(invoke, records):
+            output_file.write(json.dumps(output_record) + "\n")
+
+
+def start_batch_inference_job(
+    job_name: str, input_s3_uri: str, output_s3_uri: str, role_arn: str, model_id: str = EMBEDDING_MODEL_ID
+) -> str:
+    """
+    Start a Bedrock batch inference job embedding the JSONL input under input_s3_uri and return its ARN.
+    The output is written as <input file name>.out files under output_s3_uri.
+    """
+    response = get_client("bedrock").create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": input_s3_uri, "s3InputFormat": "JSONL"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": output_s3_uri}},
+    )
+    return response["jobArn"]
+
+
+def wait_for_batch_inference_job(
+    job_arn: str, poll_interval_seconds: float = BATCH_INFERENCE_POLL_INTERVAL_SECONDS
+) -> dict:
+    """
+    Poll the batch inference job until it is done and return the job description
+    """
+    while True:
+        job = get_client("bedrock").get_model_invocation_job(jobIdentifier=job_arn)
+        if job["status"] in BATCH_INFERENCE_FINAL_STATES:
+            break
+        time.sleep(poll_interval_seconds)
+    print("BATCH INFERENCE JOB: ", job_arn, "STATUS: ", job["status"], job.get("message", ""))
+    return job
@@ -1,34 +1,41 @@
 import datetime
+import functools
+import hashlib
 import io
 import uuid
-import boto3
 import json
-from lshashpy3 import LSHash
+from collections.abc import Iterator
 
-import pandas as pd
 import numpy as np
-import fitz
 
 
 from .config import (
     ACCEPT,
-    AWS_REGION_BEDROCK,
     CHAT_MODEL_ID,
     CHUNK_OVERLAP_SIZE,
+    CHUNK_OVERLAP_SIZE_TOKENS,
     CHUNK_SIZE,
+    CHUNK_SIZE_TOKENS,
+    CHUNK_TOKENS_SAFETY_MARGIN,
+    CHUNK_UNIT,
     CONTENT_TYPE,
     EMBEDDING_LSH_SEED,
     EMBEDDING_LSH_SIZE,
     EMBEDDING_MODEL_ID,
     EMBEDDING_SIZE,
+    MAX_TOKEN_OUTPUT,
 )
+from .clients import get_client
+from .embeddings import INPUT_TYPE_DOCUMENT, INPUT_TYPE_QUERY, get_embedding_provider
+from .instrumentation import span
+from .rate_limiter import PRIORITY_BULK, PRIORITY_INTERACTIVE, call_model, estimate_tokens
+from .tokenizer import get_token_offsets
 
 SupportsWrite = object
 
-s3_client = boto3.client("s3")
-athena_client = boto3.client("athena")
+s3_client = get_client("s3")
 
-bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION_BEDROCK)
+bedrock_runtime = get_client("bedrock-runtime")
 
 
 def get_document_text(document_blob: bytes, filetype: str = None) -> str:
@@ -38,78 +45,60 @@ def get_document_text(document_blob: bytes, filetype: str = None) -> str:
     if filetype in {"txt", "md"}:
         document_text = document_blob.decode()
     else:
+        # NOTE: Imported lazily as only the import Lambda parses documents
+        import fitz
+
         document = fitz.open(stream=io.BytesIO(document_blob), filetype=filetype)
         document_text = "\n\n".join(page.get_text() for page in document.pages())
     return document_text
 
 
-class LSHashCustom(LSHash):
-    def __init__(self, hash_size, input_dim, seed=None, **kwargs):
-        self.seed = seed
-        super().__init__(hash_size, input_dim, **kwargs)
-
-    def hash(self, input_point):
-        """
-        hash a single input point by adding it to the selected storage.
-
-        If `extra_data` is provided, it will become the value of the dictionary
-        {input_point: extra_data}, which in turn will become the value of the
-        hash table. `extra_data` needs to be JSON serializable if in-memory
-        dict is not used as storage.
-
-        :param input_point:
-            A list, or tuple, or numpy ndarray object that contains numbers
-            only. The dimension needs to be 1 * `input_dim`.
-            This object will be converted to Python tuple and its hash value returned.
-
-        Note: we always only consider a single table hash
-        """
-
-        value = (tuple(input_point), None)
-
-        hashes = []
-        for i, table in enumerate(self.hash_tables):
-            h = self._hash(self.uniform_planes[i], input_point)
-            table.append_val(h, value)
-            hashes.append(h)
-        return hashes[0]
-
-    def _generate_uniform_planes(self):
-        """
-        Generate uniformly distributed hyperplanes and return it as a 2D numpy array.
-        ---
-        @override:
-            Allow seeded LSH
-        """
-        rnd = np.random.RandomState(self.seed)
-        return rnd.randn(self.hash_size, self.input_dim)
-
-    @classmethod
-    def get_hasher(
-        cls, hash_size: int = EMBEDDING_LSH_SIZE, input_dim: int = EMBEDDING_SIZE, seed: int = EMBEDDING_LSH_SEED
-    ):
-        hasher = LSHashCustom(hash_size=hash_size, input_dim=input_dim, seed=seed)
-        return hasher
-
-
-embedding_lsh_hasher = LSHashCustom.get_hasher()
+@functools.cache
+def get_lsh_planes(
+    hash_size: int = EMBEDDING_LSH_SIZE, input_dim: int = EMBEDDING_SIZE, seed: int = EMBEDDING_LSH_SEED
+) -> np.ndarray:
+    """
+    Return the random hyperplanes of the LSH, generated once per container.
+    NOTE: The planes (and hence hashes) are the ones of the seeded lshashpy3 hasher used before,
+    so that already imported hashes stay valid.
+    """
+    rnd = np.random.RandomState(seed)
+    return rnd.randn(hash_size, input_dim)
 
 
 def get_embedding(
     text: str,
     model_id: str = EMBEDDING_MODEL_ID,
-    content_type: str = CONTENT_TYPE,
-    accept: str = ACCEPT,
+    input_type: str = INPUT_TYPE_QUERY,
+    priority: int = PRIORITY_INTERACTIVE,
 ) -> list[float]:
     """
     Compute an embedding for the given text and return a list of floats.
     The size of the list depends on model_id.
     """
-    body = json.dumps({"inputText": text})
-    response = bedrock_runtime.invoke_model(body=body, modelId=model_id, accept=accept, contentType=content_type)
-    response_body = json.loads(response["body"].read())
-    embedding = response_body.get("embedding")
-    return embedding
+    with span("embedding"):
+        return get_embedding_provider(model_id).get_embedding(text, input_type=input_type, priority=priority)
+
+
+def get_embeddings(
+    texts: list[str],
+    model_id: str = EMBEDDING_MODEL_ID,
+    input_type: str = INPUT_TYPE_DOCUMENT,
+    priority: int = PRIORITY_INTERACTIVE,
+) -> list[list[float]]:
+    """
+    Compute the embeddings of the texts with as few requests as the model allows, in the order of the texts
+    """
+    with span("embedding"):
+        return get_embedding_provider(model_id).get_embeddings(texts, input_type=input_type, priority=priority)
+
+
+def get_llm_request_tokens(body: dict) -> int:
+    """
+    Estimate the tokens counted against the quota for a LLM request: the input and the maximum output
+    """
+    max_output_tokens = body.get("textGenerationConfig", {}).get("maxTokenCount", MAX_TOKEN_OUTPUT)
+    return estimate_tokens(body.get("inputText", "")) + max_output_tokens
 
 
 def get_llm_query_response(
@@ -118,10 +107,16 @@ def get_llm_query_response(
     content_type: str = CONTENT_TYPE,
     accept: str = ACCEPT,
 ) -> dict:
-    response = bedrock_runtime.invoke_model(
-        body=json.dumps(body), modelId=model_id, accept=accept, contentType=content_type
-    )
-    response_body = json.loads(response["body"].read())
+    with span("llm"):
+        response = call_model(
+            bedrock_runtime.invoke_model,
+            model_id,
+            tokens=get_llm_request_tokens(body),
+            body=json.dumps(body),
+            accept=accept,
+            contentType=content_type,
+        )
+        response_body = json.loads(response["body"].read())
     return response_body
 
 
@@ -133,16 +128,68 @@ def get_llm_query_response_text(
     return text
 
 
-def compute_embedding_lsh(text: str) -> str:
+def get_llm_query_response_stream(
+    body: dict,
+    model_id: str = CHAT_MODEL_ID,
+    content_type: str = CONTENT_TYPE,
+    accept: str = ACCEPT,
+    client=bedrock_runtime,
+) -> Iterator[dict]:
+    """
+    Stream the LLM response and yield each response chunk as soon as it is generated by the model
+    """
+    response = call_model(
+        client.invoke_model_with_response_stream,
+        model_id,
+        tokens=get_llm_request_tokens(body),
+        body=json.dumps(body),
+        accept=accept,
+        contentType=content_type,
+    )
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk:
+            yield json.loads(chunk["bytes"])
+
+
+def get_llm_query_response_text_stream(
+    body: dict,
+    model_id: str = CHAT_MODEL_ID,
+    content_type: str = CONTENT_TYPE,
+    accept: str = ACCEPT,
+    client=bedrock_runtime,
+) -> Iterator[str]:
+    """
+    Stream the LLM response and yield the generated text pieces as they arrive
+    """
+    for chunk in get_llm_query_response_stream(body, model_id, content_type, accept, client=client):
+        text = chunk.get("outputText")
+        if text:
+            yield text
+
+
+def compute_embedding_lsh(text: str, priority: int = PRIORITY_INTERACTIVE) -> str:
     """
     Given a text, compute and return a fixed length locality-sensitive-hash
     """
-    embedding = get_embedding(text)
-    return embedding_lsh_hasher.hash(embedding)
+    embedding = get_embedding(text, priority=priority)
+    return compute_lsh(embedding)
+
+
+def compute_lsh(embedding: list[float]) -> str:
+    """
+    Given an embedding, compute and return a fixed length locality-sensitive-hash:
+    one bit per hyperplane, set when the embedding lies on its positive side
+    """
+    projections = get_lsh_planes() @ np.asarray(embedding, dtype=np.float64)
+    return "".join(np.where(projections > 0, "1", "0"))
 
 
 def compute_text_chunks(
-    text: str, chunk_size: int = CHUNK_SIZE, chunk_overlap_size: int = CHUNK_OVERLAP_SIZE
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap_size: int = CHUNK_OVERLAP_SIZE,
+    chunk_unit: str = "chars",
 ) -> tuple[tuple[int], tuple[int], str]:
     """
     Split the text in chunks with overlapping and return chunks with position information:
@@ -151,7 +198,11 @@ def compute_text_chunks(
         the initial text without overlapping
     [(text_start_pos, text_end_pos), (unique_text_start_pos, unique_text_end_pos), text_chunk]
 
+    With chunk_unit="tokens", chunk_size and chunk_overlap_size are counted in tokens instead of chars.
     """
+    if chunk_unit == "tokens":
+        return compute_text_token_chunks(text, chunk_size, chunk_overlap_size)
+
     chunks = []
     single_side_overlap_size = (chunk_overlap_size + 1) // 2
 
@@ -170,6 +221,59 @@ def compute_text_chunks(
     return chunks
 
 
+def compute_text_token_chunks(
+    text: str, chunk_size: int = CHUNK_SIZE_TOKENS, chunk_overlap_size: int = CHUNK_OVERLAP_SIZE_TOKENS
+) -> tuple[tuple[int], tuple[int], str]:
+    """
+    Same as compute_text_chunks but chunk_size and chunk_overlap_size are counted in tokens.
+    Token boundaries are mapped back to char positions, so the positions returned have the same meaning
+    and unique parts of consecutive chunks still rebuild the initial text.
+    """
+    if chunk_size <= chunk_overlap_size:
+        raise ValueError(f"chunk_size ({chunk_size}) must be greater than chunk_overlap_size ({chunk_overlap_size})")
+
+    token_offsets = get_token_offsets(text)
+    tokens_count = len(token_offsets)
+
+    if tokens_count <= chunk_size:
+        return [((0, len(text)), (0, len(text)), text)]
+
+    chunks = []
+    single_side_overlap_size = (chunk_overlap_size + 1) // 2
+    step = chunk_size - chunk_overlap_size
+    for idx in range(single_side_overlap_size, tokens_count, step):
+        chunk_start_token = idx - single_side_overlap_size
+        chunk_end_token = min(idx + chunk_size - single_side_overlap_size, tokens_count)
+        is_last_chunk = chunk_end_token >= tokens_count
+
+        chunk_start_idx = token_offsets[chunk_start_token][0] if chunk_start_token > 0 else 0
+        # NOTE: Chunks end where the next token starts, so that the text between tokens belongs to a chunk
+        chunk_end_idx = len(text) if is_last_chunk else token_offsets[chunk_end_token][0]
+        chunk = text[chunk_start_idx:chunk_end_idx]
+
+        unique_chunk_start_idx = 0
+        if is_last_chunk:
+            unique_chunk_end_idx = len(chunk)
+        else:
+            # The unique part ends where the next chunk starts
+            unique_chunk_end_idx = token_offsets[chunk_start_token + step][0] - chunk_start_idx
+        chunks.append(((chunk_start_idx, chunk_end_idx), (unique_chunk_start_idx, unique_chunk_end_idx), chunk))
+
+        if is_last_chunk:
+            break
+    return chunks
+
+
+def get_configured_text_chunks(text: str, chunk_unit: str = CHUNK_UNIT) -> tuple[tuple[int], tuple[int], str]:
+    """
+    Split the text in chunks using the chunk unit and sizes from the configuration
+    """
+    if chunk_unit == "tokens":
+        chunk_size = int(CHUNK_SIZE_TOKENS * (1 - CHUNK_TOKENS_SAFETY_MARGIN))
+        return compute_text_chunks(text, chunk_size, CHUNK_OVERLAP_SIZE_TOKENS, chunk_unit=chunk_unit)
+    return compute_text_chunks(text, CHUNK_SIZE, CHUNK_OVERLAP_SIZE, chunk_unit=chunk_unit)
+
+
 def compute_chunks_information(
     text: str, document_id: str | None = None, timestamp: str | None = None
 ) -> list[dict[str, str | int]]:
@@ -190,11 +294,13 @@ def compute_chunks_information(
 
     if timestamp is None:
         timestamp = datetime.datetime.now().isoformat(" ", timespec="seconds")
+    chunks = get_configured_text_chunks(text)
+    embeddings = get_embeddings([text for _, _, text in chunks], priority=PRIORITY_BULK)
     items = []
-    for pos, unique_pos, text in compute_text_chunks(text):
+    for (pos, unique_pos, text), embedding in zip(chunks, embeddings):
         start, end = pos
         start_unique, end_unique = unique_pos
-        embedding_lsh = compute_embedding_lsh(text)
+        embedding_lsh = compute_lsh(embedding)
         item = {
             "uuid": str(uuid.uuid4()),
             "timestamp": timestamp,
@@ -210,12 +316,49 @@ def compute_chunks_information(
     return items
 
 
+def get_s3_prefix_version(bucket: str, prefix: str) -> str:
+    """
+    Return an identifier of the current version of all objects under the S3 prefix,
+    it changes as soon as an object is added, updated or removed
+    """
+    digest = hashlib.sha1()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            digest.update(f"{item['Key']}:{item['ETag']}\n".encode())
+    return digest.hexdigest()
+
+
+def put_s3_version_marker(bucket: str, key: str) -> str:
+    """
+    Write a new version identifier of the documents to the marker object and return it
+    """
+    version = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps({"version": version}).encode())
+    return version
+
+
+def get_s3_version_marker(bucket: str, key: str) -> str | None:
+    """
+    Return the version identifier of the documents written by the import or None if there is no marker yet
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())["version"]
+
+
 def export_chunks_information_to_csv(items: list[dict[str, int | str]], csv_file_or_buffer: SupportsWrite):
+    import pandas as pd
+
     df = pd.DataFrame(items)
     df.to_csv(csv_file_or_buffer, index=False)
 
 
 def export_chunks_information_to_parquet(items: list[dict[str, int | str]], csv_file_or_buffer: SupportsWrite):
+    import pandas as pd
+
     df = pd.DataFrame(items)
     df.to_parquet(csv_file_or_buffer, compression="snappy", index=False)
 
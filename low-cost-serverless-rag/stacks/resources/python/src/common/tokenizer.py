@@ -0,0 +1,35 @@
+import functools
+import pathlib
+
+from .config import TOKENIZER_FILE, TOKENIZER_NAME
+
+SRC_DIR_PATH = pathlib.Path(__file__).parent.parent
+
+
+@functools.cache
+def get_tokenizer(name: str = TOKENIZER_NAME, tokenizer_file: str = TOKENIZER_FILE):
+    """
+    Load the tokenizer once per container and return the cached instance.
+    The tokenizer file shipped with the image is preferred, the hub is only used as a fallback (e.g. locally).
+    """
+    from tokenizers import Tokenizer
+
+    tokenizer_path = SRC_DIR_PATH / tokenizer_file
+    if tokenizer_path.exists():
+        return Tokenizer.from_file(str(tokenizer_path))
+    return Tokenizer.from_pretrained(name)
+
+
+def get_token_offsets(text: str) -> list[tuple[int, int]]:
+    """
+    Tokenize the text and return the (start, end) character positions of each token within the text
+    """
+    encoding = get_tokenizer().encode(text, add_special_tokens=False)
+    return encoding.offsets
+
+
+def count_tokens(text: str) -> int:
+    """
+    Return the number of tokens within the text
+    """
+    return len(get_tokenizer().encode(text, add_special_tokens=False).ids)
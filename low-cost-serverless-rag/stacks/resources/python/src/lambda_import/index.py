@@ -7,25 +7,43 @@ import json
 import pathlib
 import urllib
 
-import boto3
-
-s3_client = boto3.client("s3")
-
 
 OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET")
 OUTPUT_PREFIX = os.environ.get("OUTPUT_PREFIX")
 DOCUMENTS_OUTPUT_PREFIX = os.environ.get("DOCUMENTS_OUTPUT_PREFIX")
+# NOTE: Marker object holding the current version of the documents, read by the query lambda
+DOCUMENTS_VERSION_S3_KEY = os.environ.get("DOCUMENTS_VERSION_S3_KEY")
+
+# NOTE: e.g. "ObjectRemoved:Delete" or "ObjectRemoved:DeleteMarkerCreated" of versioned buckets
+OBJECT_REMOVED_EVENT_PREFIX = "ObjectRemoved:"
 
 src_dir_path = str(pathlib.Path(__file__).parent.parent)
 sys.path.append(src_dir_path)
 
+from common.clients import get_client
+from common.instrumentation import instrumented_handler, span, timed
+
+s3_client = get_client("s3")
+
 from common.helpers import (
     export_chunks_information_to_parquet,
     compute_chunks_information,
     get_document_text,
+    put_s3_version_marker,
 )
 
 
+def get_output_key(object_s3_uri: str) -> str:
+    """
+    Return the key of the parquet file holding the chunks of an input object
+    """
+    input_file_basename = os.path.basename(object_s3_uri)
+    input_file_path_hexdigest = hashlib.sha1(object_s3_uri.encode()).hexdigest()
+    output_basename = f"{input_file_basename}-{input_file_path_hexdigest}.parquet"
+    return os.path.join(DOCUMENTS_OUTPUT_PREFIX, str(output_basename))
+
+
+@instrumented_handler
 def lambda_handler(event: dict[str, object], context: dict[str, object]):
     print(json.dumps(event))
 
@@ -37,23 +55,33 @@ def lambda_handler(event: dict[str, object], context: dict[str, object]):
         filetype = object_key_input.split(".")[-1]
 
         object_s3_uri = f"s3://{bucket_input}/{object_key_input}"
-        object_content = s3_client.get_object(Bucket=bucket_input, Key=object_key_input)["Body"].read()
-        document_text = get_document_text(document_blob=object_content, filetype=filetype)
+        bucket_output = OUTPUT_BUCKET
+        object_key_output = get_output_key(object_s3_uri)
 
-        chunks_information = compute_chunks_information(document_text, object_s3_uri)
+        # NOTE: Each input object has its own parquet file, removing it removes its chunks from the documents table
+        # without rewriting any other file, so that Athena scans only the live documents
+        if record.get("eventName", "").startswith(OBJECT_REMOVED_EVENT_PREFIX):
+            with span("delete"):
+                s3_client.delete_object(Bucket=bucket_output, Key=object_key_output)
+            print("DELETED: ", object_s3_uri)
+            continue
 
-        input_file_basename = os.path.basename(object_s3_uri)
-        input_file_path_hexdigest = hashlib.sha1(object_s3_uri.encode()).hexdigest()
-        output_basename = f"{input_file_basename}-{input_file_path_hexdigest}.parquet"
+        with span("s3_download"):
+            object_content = s3_client.get_object(Bucket=bucket_input, Key=object_key_input)["Body"].read()
+        document_text = timed(get_document_text, "parse")(document_blob=object_content, filetype=filetype)
+
+        chunks_information = compute_chunks_information(document_text, object_s3_uri)
 
         csv_file_buffer = io.BytesIO()
-        export_chunks_information_to_parquet(chunks_information, csv_file_buffer)
+        timed(export_chunks_information_to_parquet, "parquet_export")(chunks_information, csv_file_buffer)
         csv_file_buffer.seek(0)
 
-        bucket_output = OUTPUT_BUCKET
+        with span("upload"):
+            s3_client.put_object(Body=csv_file_buffer.getvalue(), Bucket=bucket_output, Key=object_key_output)
 
-        object_key_output = os.path.join(DOCUMENTS_OUTPUT_PREFIX, str(output_basename))
-        s3_client.put_object(Body=csv_file_buffer.getvalue(), Bucket=bucket_output, Key=object_key_output)
+    if DOCUMENTS_VERSION_S3_KEY and records:
+        documents_version = timed(put_s3_version_marker, "version_marker")(OUTPUT_BUCKET, DOCUMENTS_VERSION_S3_KEY)
+        print("DOCUMENTS VERSION: ", documents_version)
 
 
 if __name__ == "__main__":
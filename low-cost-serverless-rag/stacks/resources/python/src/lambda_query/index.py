@@ -1,91 +1,118 @@
 import os
-import boto3
 import sys
+import threading
 import time
 
 import pathlib
-import awswrangler as wr
-import pandas as pd
+from collections.abc import Iterator
 
 src_dir_path = str(pathlib.Path(__file__).parent.parent)
 sys.path.append(src_dir_path)
 
 
-def log_time(function):
-    def logging_time_function(*args, **kwargs):
-        start = time.time()
-        result = function(*args, **kwargs)
-        end = time.time()
-        time_ms = int((end - start) * 1000)
-        print("<time>" * 10, "START", "<time>" * 10)
-        print(f"Timed {time_ms} ms for function <{function.__name__}>")
-        print("<time>" * 10, "END", "<time>" * 10)
-        return result
-
-    return logging_time_function
-
-
 SupportsWrite = object
 
-s3_client = boto3.client("s3")
-athena_client = boto3.client("athena")
-
+from common.clients import get_client
+from common.instrumentation import instrumented_handler, span, timed
 
-# Leave to None in case use want to query endpoints within the same region as the lambda function
-AWS_REGION = "eu-central-1"
-# Create the connection to Bedrock
-bedrock = boto3.client(service_name="bedrock", region_name=AWS_REGION)
-
-bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION)
+s3_client = get_client("s3")
+bedrock_runtime = get_client("bedrock-runtime")
 
+from common.athena import run_query
+from common.cache import AnswerCache
 from common.helpers import (
-    compute_embedding_lsh,
+    compute_lsh,
+    get_embedding,
     get_llm_query_response_text,
+    get_llm_query_response_text_stream,
+    get_s3_prefix_version,
+    get_s3_version_marker,
+)
+from common.config import (
+    ATHENA_RESULT_REUSE_MAX_AGE_MINUTES,
+    CONTEXT_MAX_TOKENS,
+    DOCUMENTS_VERSION_TTL_SECONDS,
+    MAX_TOKEN_OUTPUT,
+    RERANK_CANDIDATES_FACTOR,
+    RERANK_METHOD,
+    RERANK_TOP_N_DOCUMENTS,
 )
-from common.config import MAX_TOKEN_OUTPUT
+from common.context import ChunkRow, assemble_context
+from common.rerank import RERANK_METHOD_MMR, get_lsh_vectors, get_rerank_method, rerank_chunks
 
 ATHENA_TABLE = os.environ.get("ATHENA_TABLE", "documents")
 ATHENA_DATABASE = os.environ.get("ATHENA_DATABASE")
 ATHENA_WORKGROUP = os.environ.get("ATHENA_WORKGROUP")
+# NOTE: Prepared statement registered within the workgroup (see ATHENA_DOCUMENTS_QUERY)
+ATHENA_DOCUMENTS_PREPARED_STATEMENT = os.environ.get("ATHENA_DOCUMENTS_PREPARED_STATEMENT", "rag_documents_query")
+
+DOCUMENTS_S3_BUCKET = os.environ.get("DOCUMENTS_S3_BUCKET")
+DOCUMENTS_S3_PREFIX = os.environ.get("DOCUMENTS_S3_PREFIX")
+# NOTE: Marker object written by the import lambda, the documents prefix is listed only when it is missing
+DOCUMENTS_VERSION_S3_KEY = os.environ.get("DOCUMENTS_VERSION_S3_KEY")
+DOCUMENTS_VERSION_TTL_SECONDS = float(os.environ.get("DOCUMENTS_VERSION_TTL_SECONDS", DOCUMENTS_VERSION_TTL_SECONDS))
+
+# NOTE: Answers are persisted to S3 when a bucket is configured, otherwise they are only cached in memory
+ANSWER_CACHE_S3_BUCKET = os.environ.get("ANSWER_CACHE_S3_BUCKET")
+ANSWER_CACHE_S3_PREFIX = os.environ.get("ANSWER_CACHE_S3_PREFIX", "tmp/answer-cache")
 
 TOP_N_DOCUMENTS = int(os.environ.get("TOP_N_DOCUMENTS", "10"))
 
+# NOTE: Identical queries (same query LSH and documents version) reuse Athena results up to this age, 0 disables it
+ATHENA_RESULT_REUSE_MAX_AGE_MINUTES = int(
+    os.environ.get("ATHENA_RESULT_REUSE_MAX_AGE_MINUTES", ATHENA_RESULT_REUSE_MAX_AGE_MINUTES)
+)
+
 
 # NOTE: score ranges from 0.0 to 100.0
 QUERY_SCORE_THRESHOLD = int(os.environ.get("QUERY_SCORE_THRESHOLD", "60"))
 
-ATHENA_DOCUMENTS_QUERY_TEMPLATE = """
-WITH scored_documents AS (
-    SELECT
-        "uuid", "start", "end", start_unique, end_unique, lsh, document_id, "text",
-        (length(lsh) - hamming_distance(lsh, '{query_lsh}')) * 100.0 / length(lsh) score
-    FROM
-        "awsdatacatalog"."{athena_database}"."{athena_table}"
-)
-
-SELECT * FROM scored_documents
-WHERE
-    score >= {score_threshold}
-ORDER BY score DESC
-LIMIT {top_n_documents}
+# NOTE: How many tokens of chunks text are sent to the LLM at most
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", CONTEXT_MAX_TOKENS))
+
+# NOTE: One of "none", "mmr" (diversity out of the chunks LSH) or "cross_encoder" (local ONNX model):
+# RERANK_CANDIDATES_FACTOR times TOP_N_DOCUMENTS are queried and only the best RERANK_TOP_N_DOCUMENTS are sent
+RERANK_METHOD = get_rerank_method(os.environ.get("RERANK_METHOD", RERANK_METHOD))
+RERANK_CANDIDATES_FACTOR = int(os.environ.get("RERANK_CANDIDATES_FACTOR", RERANK_CANDIDATES_FACTOR))
+RERANK_TOP_N_DOCUMENTS = int(os.environ.get("RERANK_TOP_N_DOCUMENTS", RERANK_TOP_N_DOCUMENTS))
+RETRIEVED_N_DOCUMENTS = TOP_N_DOCUMENTS * RERANK_CANDIDATES_FACTOR if RERANK_METHOD else TOP_N_DOCUMENTS
+
+# NOTE: The query registered as ATHENA_DOCUMENTS_PREPARED_STATEMENT by the stack, parameters are the query LSH,
+# the score threshold and the number of documents. Athena reuses results of the exact same statement only,
+# the documents version comment makes results computed before an import not reusable anymore
+ATHENA_DOCUMENTS_QUERY = """
+-- documents version: {documents_version}
+EXECUTE {prepared_statement}
 """
 
 
+def get_athena_literal(value: str | int | float) -> str:
+    """
+    Format a value as an Athena SQL literal, as expected by execution parameters
+    """
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
 def get_athena_documents_query(
     query_lsh: str,
     score_threshold: float = QUERY_SCORE_THRESHOLD,
-    top_n_documents: int = TOP_N_DOCUMENTS,
-    athena_database: str = ATHENA_DATABASE,
-    athena_table: str = ATHENA_TABLE,
-    template: str = ATHENA_DOCUMENTS_QUERY_TEMPLATE,
-):
-    return template.format(
-        query_lsh=query_lsh,
-        score_threshold=score_threshold,
-        top_n_documents=top_n_documents,
-        athena_table=athena_table,
-        athena_database=athena_database,
+    top_n_documents: int = RETRIEVED_N_DOCUMENTS,
+    prepared_statement: str = ATHENA_DOCUMENTS_PREPARED_STATEMENT,
+    documents_version: str | None = None,
+) -> tuple[str, list[str]]:
+    """
+    Return the statement executing the prepared documents query and its execution parameters
+    """
+    if documents_version is None:
+        documents_version = get_documents_version()
+    execution_parameters = [get_athena_literal(value) for value in (query_lsh, score_threshold, top_n_documents)]
+    documents_sql_query = ATHENA_DOCUMENTS_QUERY.format(
+        prepared_statement=prepared_statement,
+        documents_version=documents_version,
     )
+    return documents_sql_query, execution_parameters
 
 
 LLM_RAG_QUERY_TEMPLATE = """
@@ -106,44 +133,133 @@ def build_llm_query(documents: str, query: str):
     return LLM_RAG_QUERY_TEMPLATE.format(documents=documents, query=query)
 
 
-@log_time
-def get_chunks_df(sql: str, database: str = ATHENA_DATABASE, workgroup: str = ATHENA_WORKGROUP, **kwargs):
-    if "ctas_approach" in kwargs:
-        kwargs.pop("ctas_approach")
-    return wr.athena.read_sql_query(sql=sql, database=database, ctas_approach=False, workgroup=workgroup, **kwargs)
+def get_chunks(
+    sql: str,
+    database: str = ATHENA_DATABASE,
+    workgroup: str = ATHENA_WORKGROUP,
+    execution_parameters: list[str] | None = None,
+) -> list[ChunkRow]:
+    """
+    Run the chunks query and return the chunks fetched directly out of the query results
+    """
+    return timed(run_query, "athena_query")(
+        sql,
+        database=database,
+        workgroup=workgroup,
+        execution_parameters=execution_parameters,
+        result_reuse_max_age_minutes=ATHENA_RESULT_REUSE_MAX_AGE_MINUTES,
+    )
 
 
-def get_text_from_chunks(chunks_df: pd.DataFrame):
-    """)
-    Extract, preprocess and combine text from chunks
+def get_text_from_chunks(chunks: list[ChunkRow], max_tokens: int = CONTEXT_MAX_TOKENS):
     """
-
-    # NOTE: for a real use case we would use a proper strategy to clean and put the text together
-    # e.g. by avoiding overlaps, making sure the final text would fit within the LLM context etc.
-    documents_text = "\n".join(chunks_df["text"].to_list())
+    Extract, preprocess and combine text from chunks:
+    overlapping chunks of the same document are merged and the text is packed by score within max_tokens
+    """
+    # NOTE: chunks are already sorted by descending (re-ranking) score
+    documents_text = assemble_context(chunks, max_tokens=max_tokens)
     return documents_text
 
 
-def lambda_handler(event: dict[str, object], context: dict[str, object]):
-    print(event)
+def rerank_retrieved_chunks(
+    query: str, chunks: list[ChunkRow], query_lsh: str, method: str | None = RERANK_METHOD
+) -> list[ChunkRow]:
+    """
+    Re-rank the retrieved chunks and keep the RERANK_TOP_N_DOCUMENTS best ones, chunks are kept as is
+    without re-ranking method. MMR compares the LSH of the chunks, as their embeddings are not stored.
+    """
+    if method is None or not chunks:
+        return chunks
+    with span("rerank"):
+        query_vector, chunk_vectors = None, None
+        if method == RERANK_METHOD_MMR:
+            query_vector, *chunk_vectors = get_lsh_vectors([query_lsh, *(chunk["lsh"] for chunk in chunks)])
+        return rerank_chunks(
+            query,
+            chunks,
+            RERANK_TOP_N_DOCUMENTS,
+            method,
+            query_vector=query_vector,
+            chunk_vectors=chunk_vectors,
+        )
+
+
+DOCUMENTS_VERSION: dict[str, str | float] = {}
+DOCUMENTS_VERSION_LOCK = threading.Lock()
+
+
+def read_documents_version() -> str:
+    version = None
+    if DOCUMENTS_VERSION_S3_KEY:
+        version = get_s3_version_marker(DOCUMENTS_S3_BUCKET, DOCUMENTS_VERSION_S3_KEY)
+    if version is None:
+        version = get_s3_prefix_version(DOCUMENTS_S3_BUCKET, DOCUMENTS_S3_PREFIX)
+    return version
+
+
+def get_documents_version() -> str:
+    """
+    Return the current version of the documents table, read at most every DOCUMENTS_VERSION_TTL_SECONDS
+    """
+    with DOCUMENTS_VERSION_LOCK:
+        if time.monotonic() - DOCUMENTS_VERSION.get("read", float("-inf")) >= DOCUMENTS_VERSION_TTL_SECONDS:
+            DOCUMENTS_VERSION["version"] = timed(read_documents_version, "s3_version")()
+            DOCUMENTS_VERSION["read"] = time.monotonic()
+        return DOCUMENTS_VERSION["version"]
 
-    query = event["query"]
 
-    query_lsh = log_time(compute_embedding_lsh)(query)
+ANSWER_CACHES: dict[str, AnswerCache] = {}
+
 
-    documents_sql_query = get_athena_documents_query(query_lsh=query_lsh)
+def get_answer_cache() -> AnswerCache:
+    """
+    Return the answer cache scoped to the current version of the documents table
+    """
+    version = get_documents_version()
+    if version not in ANSWER_CACHES:
+        # NOTE: Answers cached for previous versions can not be served anymore
+        ANSWER_CACHES.clear()
+        ANSWER_CACHES[version] = AnswerCache(
+            version=version,
+            s3_client=s3_client,
+            s3_bucket=ANSWER_CACHE_S3_BUCKET,
+            s3_prefix=ANSWER_CACHE_S3_PREFIX,
+        )
+    return ANSWER_CACHES[version]
+
+
+def get_llm_request_body(
+    query: str,
+    query_embedding: list[float] | None = None,
+    documents_version: str | None = None,
+) -> dict:
+    """
+    Retrieve the chunks matching the query (within the documents version) and build the request body for the LLM
+    """
+    if query_embedding is None:
+        query_embedding = get_embedding(query)
+    query_lsh = compute_lsh(query_embedding)
+
+    documents_sql_query, execution_parameters = get_athena_documents_query(
+        query_lsh=query_lsh,
+        documents_version=documents_version,
+    )
 
     print("-" * 100)
     print(documents_sql_query)
-    print("-" * 50, "REPR")
-    print(repr(documents_sql_query))
-
-    chunks_df = get_chunks_df(
-        sql=documents_sql_query, database=ATHENA_DATABASE, ctas_approach=False, workgroup=ATHENA_WORKGROUP
+    print("-" * 50, "PARAMETERS")
+    print(execution_parameters)
+
+    chunks = get_chunks(
+        sql=documents_sql_query,
+        database=ATHENA_DATABASE,
+        workgroup=ATHENA_WORKGROUP,
+        execution_parameters=execution_parameters,
     )
-    print(chunks_df)
+    print(chunks)
 
-    chunks_text = get_text_from_chunks(chunks_df)
+    chunks = rerank_retrieved_chunks(query, chunks, query_lsh)
+    chunks_text = get_text_from_chunks(chunks)
 
     if not chunks_text:
         chunks_text = "not enough information available"
@@ -154,7 +270,65 @@ def lambda_handler(event: dict[str, object], context: dict[str, object]):
     )
 
     llm_request_body = {"inputText": llm_query, "textGenerationConfig": {"maxTokenCount": MAX_TOKEN_OUTPUT}}
-    answer_text = log_time(get_llm_query_response_text)(llm_request_body)
+    return llm_request_body
+
+
+def get_llm_request(query: str, answer_cache: AnswerCache | None = None) -> dict:
+    """
+    Retrieve the chunks matching the query and build the request body for the LLM.
+    Return {"answer": ...} if the answer cache holds an answer of the same or of a similar query,
+    {"body": ..., "embedding": ...} otherwise.
+    """
+    if answer_cache is not None:
+        answer_text = timed(answer_cache.get, "answer_cache")(query)
+        if answer_text is not None:
+            return {"answer": answer_text}
+
+    query_embedding = get_embedding(query)
+    if answer_cache is not None:
+        answer_text = answer_cache.get_similar(query_embedding)
+        if answer_text is not None:
+            return {"answer": answer_text}
+
+    documents_version = answer_cache.version if answer_cache is not None else None
+    llm_request_body = get_llm_request_body(query, query_embedding, documents_version)
+    return {"body": llm_request_body, "embedding": query_embedding}
+
+
+def stream_answer(query: str, client=bedrock_runtime) -> Iterator[str]:
+    """
+    Answer the query and yield the answer text as soon as it is generated by the LLM, a cached answer is yielded
+    at once. The answer is cached once the whole stream is consumed.
+
+    NOTE: Lambda response streaming is not available for the python runtime, so that this generator is meant
+    to be used locally or behind a streaming capable integration.
+    """
+    answer_cache = get_answer_cache()
+    llm_request = get_llm_request(query, answer_cache)
+    if "answer" in llm_request:
+        yield llm_request["answer"]
+        return
+
+    text_pieces = []
+    for text in get_llm_query_response_text_stream(llm_request["body"], client=client):
+        text_pieces.append(text)
+        yield text
+    answer_cache.put(query, "".join(text_pieces), llm_request["embedding"])
+
+
+@instrumented_handler
+def lambda_handler(event: dict[str, object], context: dict[str, object]):
+    print(event)
+
+    query = event["query"]
+
+    answer_cache = get_answer_cache()
+    llm_request = get_llm_request(query, answer_cache)
+    if "answer" in llm_request:
+        return {"text": llm_request["answer"]}
+
+    answer_text = get_llm_query_response_text(llm_request["body"])
+    answer_cache.put(query, answer_text, llm_request["embedding"])
     print("*" * 50, "LLM_ANSWER")
     print(answer_text)
     response = {"text": answer_text}
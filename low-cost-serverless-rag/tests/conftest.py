@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+sys.path.insert(0, str(SRC_DIR_PATH))
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+import common.instrumentation as instrumentation
+from common.config import METRICS_NAMESPACE
+from common.instrumentation import get_breakdown, instrumented_handler, span, timed
+
+
+@pytest.fixture(autouse=True)
+def cold_container(monkeypatch):
+    monkeypatch.setattr(instrumentation, "COLD_START", True)
+    instrumentation.SPANS.clear()
+    instrumentation.LAST_INVOCATION_SPANS.clear()
+
+
+def get_embedding(query: str) -> list[float]:
+    return [float(len(query))]
+
+
+@instrumented_handler
+def lambda_handler(event: dict, context: object):
+    with span("db_wait"):
+        pass
+    embedding = timed(get_embedding, "embedding")(event["query"])
+    if event.get("fail"):
+        raise ValueError("failed")
+    return {"embedding": embedding}
+
+
+def get_emf_lines(output: str) -> list[dict]:
+    """
+    Return the latency metrics of the stages logged in CloudWatch embedded metric format
+    """
+    lines = [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+    return [line for line in lines if "_aws" in line and "Stage" in line]
+
+
+def test_handler_spans_and_breakdown():
+    assert lambda_handler({"query": "abc"}, None) == {"embedding": [3.0]}
+
+    assert [item["stage"] for item in instrumentation.LAST_INVOCATION_SPANS] == ["db_wait", "embedding", "handler"]
+    breakdown = get_breakdown()
+    assert set(breakdown) == {"db_wait", "embedding", "handler"}
+    assert breakdown["handler"] >= breakdown["db_wait"] + breakdown["embedding"]
+    assert instrumentation.SPANS == []
+
+
+def test_handler_emf_lines(capsys):
+    lambda_handler({"query": "abc"}, None)
+    lambda_handler({"query": "abc"}, None)
+
+    emf_lines = get_emf_lines(capsys.readouterr().out)
+    assert [line["Stage"] for line in emf_lines] == ["db_wait", "embedding", "handler"] * 2
+    assert [line["ColdStart"] for line in emf_lines] == ["true"] * 3 + ["false"] * 3
+    for line in emf_lines:
+        (metrics,) = line["_aws"]["CloudWatchMetrics"]
+        assert metrics["Namespace"] == METRICS_NAMESPACE
+        assert metrics["Dimensions"] == [["FunctionName", "Stage"], ["FunctionName", "Stage", "ColdStart"]]
+        assert metrics["Metrics"] == [{"Name": "Latency", "Unit": "Milliseconds"}]
+        assert line["FunctionName"] == instrumentation.FUNCTION_NAME
+        assert line["Latency"] >= 0
+
+
+def test_handler_error_is_reported(capsys):
+    with pytest.raises(ValueError):
+        lambda_handler({"query": "abc", "fail": True}, None)
+
+    emf_lines = get_emf_lines(capsys.readouterr().out)
+    assert [(line["Stage"], line.get("Error")) for line in emf_lines] == [
+        ("db_wait", None),
+        ("embedding", None),
+        ("handler", "ValueError"),
+    ]
+    assert get_breakdown().keys() == {"db_wait", "embedding", "handler"}
@@ -0,0 +1,39 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+SRC_DIR_PATH = pathlib.Path(__file__).resolve().parent.parent.joinpath("stacks", "resources", "python", "src")
+
+# NOTE: Heavy dependencies only needed to import documents or by optional features, loaded on first use
+LAZY_MODULES = ["pandas", "fitz", "onnxruntime", "tokenizers"]
+
+# NOTE: Exits without waiting for the background threads started at import time (e.g. the database download)
+IMPORT_SCRIPT = f"""
+import json, os, sys
+import lambda_query.index
+print(json.dumps(sorted(module for module in {LAZY_MODULES!r} if module in sys.modules)))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+
+def test_query_lambda_does_not_import_heavy_modules():
+    # NOTE: A fresh interpreter, as the modules imported by other tests are within sys.modules
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(SRC_DIR_PATH),
+        "AWS_DEFAULT_REGION": "eu-central-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        # NOTE: AWS calls made at import time fail at once instead of reaching AWS
+        "AWS_ENDPOINT_URL": "http://127.0.0.1:9",
+        "SQLITE_DB_S3_BUCKET": "bucket",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=SRC_DIR_PATH, env=env, capture_output=True, text=True, timeout=60
+    )
+
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert json.loads(result.stdout.splitlines()[-1]) == []
@@ -0,0 +1,49 @@
+import pytest
+
+tokenizers = pytest.importorskip("tokenizers")
+
+import common.tokenizer
+from common.config import CHUNK_OVERLAP_SIZE_TOKENS, CHUNK_SIZE_TOKENS, CHUNK_TOKENS_SAFETY_MARGIN
+from common.helpers import compute_text_token_chunks, get_configured_text_chunks
+from common.tokenizer import count_tokens
+
+TEXT = " ".join(f"word{idx % 97},  sentence {idx}.\n" for idx in range(1000))
+
+
+@pytest.fixture(autouse=True)
+def whitespace_tokenizer(monkeypatch):
+    # NOTE: A local tokenizer, so that the tests do not fetch TOKENIZER_NAME from the hub
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    monkeypatch.setattr(common.tokenizer, "get_tokenizer", lambda *args, **kwargs: tokenizer)
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap_size", [(50, 10), (64, 0), (384, 64)])
+def test_token_chunks_within_budget(chunk_size, chunk_overlap_size):
+    chunks = compute_text_token_chunks(TEXT, chunk_size, chunk_overlap_size)
+
+    assert len(chunks) > 1
+    for _, _, chunk in chunks:
+        assert count_tokens(chunk) <= chunk_size
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap_size", [(50, 10), (64, 0), (384, 64)])
+def test_token_chunks_offsets_map_to_text(chunk_size, chunk_overlap_size):
+    chunks = compute_text_token_chunks(TEXT, chunk_size, chunk_overlap_size)
+
+    for (start, end), _, chunk in chunks:
+        assert TEXT[start:end] == chunk
+    unique_parts = [chunk[unique_start:unique_end] for _, (unique_start, unique_end), chunk in chunks]
+    assert "".join(unique_parts) == TEXT
+
+
+def test_short_text_is_a_single_chunk():
+    assert compute_text_token_chunks("Hello world everyone!", 10, 2) == [((0, 21), (0, 21), "Hello world everyone!")]
+
+
+def test_configured_token_chunks_keep_safety_margin():
+    chunks = get_configured_text_chunks(TEXT, chunk_unit="tokens")
+
+    chunk_size = int(CHUNK_SIZE_TOKENS * (1 - CHUNK_TOKENS_SAFETY_MARGIN))
+    assert CHUNK_OVERLAP_SIZE_TOKENS < chunk_size < CHUNK_SIZE_TOKENS
+    assert max(count_tokens(chunk) for _, _, chunk in chunks) <= chunk_size